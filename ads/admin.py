@@ -1,5 +1,12 @@
+from datetime import timedelta
+
 from django.contrib import admin
-from .models import Ad, ExchangeProposal
+from django.db import DEFAULT_DB_ALIAS
+from django.template.response import TemplateResponse
+from django.utils import timezone
+
+from .models import Ad, Category, Condition, ExchangeProposal, ExchangeRollup, OutboxEvent, RollupPeriod, Task
+from .rollups import get_dashboard
 
 class AdInLine(admin.TabularInline):
     model = Ad
@@ -14,5 +21,57 @@ class ExchangeProposalAdmin(admin.ModelAdmin):
     search_fields = ["ad_sender", "ad_receiver"]
     can_edit = True
 
+    def get_queryset(self, request):
+        # Список админки - одна таблица: при нескольких шардах показываются предложения основной базы
+        return super().get_queryset(request).using(DEFAULT_DB_ALIAS)
+
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ["id", "model", "object_id", "kind", "created_at"]
+    list_filter = ["model", "kind"]
+    readonly_fields = ["model", "object_id", "kind", "payload", "created_at"]
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ["id", "name", "status", "attempts", "run_at", "started_at", "finished_at"]
+    list_filter = ["status", "name"]
+    readonly_fields = ["created_at", "started_at", "finished_at", "last_error"]
+
+class ExchangeRollupAdmin(admin.ModelAdmin):
+    # Вместо списка строк - панель статистики; она читает только сводки, не таблицы объявлений и предложений
+    PERIOD_SPANS = {RollupPeriod.HOUR: timedelta(hours=48), RollupPeriod.DAY: timedelta(days=30)}
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        period = request.GET.get("period")
+        if period not in self.PERIOD_SPANS:
+            period = RollupPeriod.DAY
+        since = timezone.localtime() - self.PERIOD_SPANS[period]
+        context = {
+            **self.admin_site.each_context(request),
+            "title": "Статистика обменов",
+            "opts": self.model._meta,
+            "period": period,
+            "periods": RollupPeriod.choices,
+            **get_dashboard(period, since),
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, "admin/ads/exchange_dashboard.html", context)
+
+class DictionaryAdmin(admin.ModelAdmin):
+    list_display = ["id", "name"]
+    search_fields = ["name"]
+
 admin.site.register(Ad)
+admin.site.register(Category, DictionaryAdmin)
+admin.site.register(Condition, DictionaryAdmin)
 admin.site.register(ExchangeProposal, ExchangeProposalAdmin)
+admin.site.register(ExchangeRollup, ExchangeRollupAdmin)
+admin.site.register(OutboxEvent, OutboxEventAdmin)
+admin.site.register(Task, TaskAdmin)
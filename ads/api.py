@@ -0,0 +1,190 @@
+import base64
+import hashlib
+import json
+
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.views import generic
+
+from .filters import filter_ads, get_ads_ordering, get_catalogue_ads
+from .models import Ad
+from .outbox import changes_since
+from .suggest import SUGGEST_LIMIT, suggest
+
+
+# Поле ответа -> колонка для values()
+AD_API_FIELDS = {
+    "id": "id",
+    "user": "user_id",
+    "title": "title",
+    "description": "description",
+    "image_url": "image_url",
+    "category": "category__name",
+    "condition": "condition__name",
+    "category_id": "category_id",
+    "condition_id": "condition_id",
+    "created_at": "created_at",
+    "views_count": "views_count",
+}
+DATETIME_FIELDS = {"created_at"}
+
+json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def get_api_fields(params):
+    fields = params.get("fields")
+    if not fields:
+        return list(AD_API_FIELDS)
+    fields = [i_field.strip() for i_field in fields.split(",") if i_field.strip()]
+    unknown_fields = [i_field for i_field in fields if i_field not in AD_API_FIELDS]
+    if unknown_fields:
+        raise ValueError("Неизвестные поля: " + ", ".join(unknown_fields))
+    return fields
+
+
+def serialize_rows(rows, fields):
+    # values() отдает dict-ы без создания моделей, остается только привести даты к строкам
+    datetime_fields = DATETIME_FIELDS.intersection(fields)
+    result = []
+    for i_row in rows:
+        item = {i_field: i_row[AD_API_FIELDS[i_field]] for i_field in fields}
+        for i_field in datetime_fields:
+            item[i_field] = item[i_field].isoformat()
+        result.append(item)
+    return result
+
+
+def encode_cursor(value, pk):
+    raw = json_encoder.encode([value, pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, ordering_field):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, pk = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Некорректный курсор")
+    if ordering_field in DATETIME_FIELDS:
+        value = parse_datetime(value) if isinstance(value, str) else None
+    if value is None or not isinstance(pk, int):
+        raise ValueError("Некорректный курсор")
+    return value, pk
+
+
+def json_response(request, data):
+    body = json_encoder.encode(data).encode()
+    etag = '"{}"'.format(hashlib.md5(body, usedforsecurity=False).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    return response
+
+
+class AdsApiView(generic.View):
+    paginate_by = 15
+    max_paginate_by = 100
+
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = get_api_fields(request.GET)
+            limit = min(int(request.GET.get("limit", self.paginate_by)), self.max_paginate_by)
+            ads_queryset = filter_ads(get_catalogue_ads(), request.GET)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        if limit < 1:
+            return HttpResponseBadRequest("limit должен быть положительным")
+
+        ordering = get_ads_ordering(request.GET) or "-created_at"
+        ordering_field = ordering.lstrip("-")
+        is_descending = ordering.startswith("-")
+
+        cursor = request.GET.get("cursor")
+        if cursor:
+            try:
+                value, pk = decode_cursor(cursor, ordering_field)
+            except ValueError as exc:
+                return HttpResponseBadRequest(str(exc))
+            lookup = "lt" if is_descending else "gt"
+            ads_queryset = ads_queryset.filter(
+                Q(**{f"{ordering_field}__{lookup}": value}) |
+                Q(**{ordering_field: value, f"id__{lookup}": pk})
+            )
+
+        columns = {AD_API_FIELDS[i_field] for i_field in fields} | {"id", ordering_field}
+        ads_queryset = ads_queryset.order_by(ordering, "-id" if is_descending else "id")
+        rows = list(ads_queryset.values(*columns)[:limit + 1])
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last_value = rows[-1][ordering_field]
+            if ordering_field in DATETIME_FIELDS:
+                last_value = last_value.isoformat()
+            next_cursor = encode_cursor(last_value, rows[-1]["id"])
+
+        return json_response(request, {"results": serialize_rows(rows, fields), "next": next_cursor})
+
+
+class AdDetailApiView(generic.View):
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = get_api_fields(request.GET)
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+        columns = {AD_API_FIELDS[i_field] for i_field in fields}
+        row = Ad.objects.filter(pk=self.kwargs.get("pk")).values(*columns).first()
+        if row is None:
+            raise Http404("Объявление не найдено")
+        return json_response(request, serialize_rows([row], fields)[0])
+
+
+class ChangesApiView(generic.View):
+    paginate_by = 500
+    max_paginate_by = 5000
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            raise PermissionDenied("Лента изменений доступна только персоналу")
+        try:
+            since = int(request.GET.get("since", 0))
+            limit = min(int(request.GET.get("limit", self.paginate_by)), self.max_paginate_by)
+        except ValueError:
+            return HttpResponseBadRequest("since и limit должны быть числами")
+        if limit < 1:
+            return HttpResponseBadRequest("limit должен быть положительным")
+
+        events = changes_since(since, limit=limit, models=request.GET.getlist("model"))
+        results = [
+            {
+                "id": i_event.id,
+                "model": i_event.model,
+                "object_id": i_event.object_id,
+                "kind": i_event.kind,
+                "created_at": i_event.created_at.isoformat(),
+                "payload": i_event.payload,
+            }
+            for i_event in events
+        ]
+        next_since = events[-1].id if events else since
+        return json_response(request, {"results": results, "next": next_since})
+
+
+class SuggestApiView(generic.View):
+    # Подсказки читаются из снимка индекса в памяти процесса, без запросов к базе данных
+    max_limit = 20
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = min(int(request.GET.get("limit", SUGGEST_LIMIT)), self.max_limit)
+        except ValueError:
+            return HttpResponseBadRequest("limit должен быть числом")
+        if limit < 1:
+            return HttpResponseBadRequest("limit должен быть положительным")
+        response = json_response(request, suggest(request.GET.get("q", "")[:100], limit))
+        response["Cache-Control"] = "public, max-age=60"
+        return response
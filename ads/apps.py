@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class AdsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "ads"
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        from . import percolate, purge, signals, similar
+        from .shards import start_shard_ids
+
+        post_migrate.connect(start_shard_ids, sender=self)
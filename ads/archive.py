@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Ad, ArchivedExchangeProposal, ExchangeProposal, ExchangeStatus
+from .outbox import deletion_kind
+from .shards import atomic, get_shard_aliases
+
+ARCHIVE_BATCH_SIZE = 500
+
+
+def get_archivable_proposals(older_than_days, using=DEFAULT_DB_ALIAS):
+    threshold = timezone.now() - timedelta(days=older_than_days)
+    return ExchangeProposal.objects.using(using).exclude(status=ExchangeStatus.WAITING).filter(closed_at__lt=threshold)
+
+
+def archive_batch(older_than_days, batch_size=ARCHIVE_BATCH_SIZE, using=DEFAULT_DB_ALIAS):
+    # Архив в основной базе, предложения - в шарде: строки переносятся в транзакциях обеих баз
+    with atomic([DEFAULT_DB_ALIAS, using]):
+        proposals = list(get_archivable_proposals(older_than_days, using).order_by("closed_at", "id")[:batch_size])
+        if not proposals:
+            return 0
+        # Названия товаров одним запросом к основной базе: в шарде таблицы товаров нет
+        ads = Ad.all_objects.in_bulk(
+            {i_proposal.ad_sender_id for i_proposal in proposals} | {i_proposal.ad_receiver_id for i_proposal in proposals}
+        )
+        ArchivedExchangeProposal.objects.bulk_create(
+            [
+                ArchivedExchangeProposal(
+                    id=i_proposal.id,
+                    ad_sender_id=i_proposal.ad_sender_id,
+                    ad_receiver_id=i_proposal.ad_receiver_id,
+                    ad_sender_title=ads[i_proposal.ad_sender_id].title,
+                    ad_receiver_title=ads[i_proposal.ad_receiver_id].title,
+                    sender_user_id=i_proposal.sender_user_id,
+                    receiver_user_id=i_proposal.receiver_user_id,
+                    comment=i_proposal.comment,
+                    status=i_proposal.status,
+                    created_at=i_proposal.created_at,
+                    closed_at=i_proposal.closed_at,
+                )
+                for i_proposal in proposals
+            ],
+            ignore_conflicts=True,
+        )
+        token = deletion_kind.set("archived")
+        try:
+            ExchangeProposal.all_objects.using(using).filter(pk__in=[i_proposal.id for i_proposal in proposals]).delete()
+        finally:
+            deletion_kind.reset(token)
+    return len(proposals)
+
+
+def archive_proposals(older_than_days=None, batch_size=ARCHIVE_BATCH_SIZE):
+    # Каждый пакет в своей транзакции, чтобы не держать блокировку записи SQLite на весь перенос
+    if older_than_days is None:
+        older_than_days = settings.EXCHANGE_ARCHIVE_AFTER_DAYS
+    archived_total = 0
+    for i_alias in get_shard_aliases():
+        while True:
+            archived = archive_batch(older_than_days, batch_size, i_alias)
+            archived_total += archived
+            if archived < batch_size:
+                break
+    return archived_total
+
+
+def get_user_archive(user):
+    return ArchivedExchangeProposal.objects.filter(Q(sender_user_id=user.pk) | Q(receiver_user_id=user.pk))
@@ -0,0 +1,126 @@
+from collections import Counter, defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+
+from .models import ExchangeProposal
+from .notifications import broker
+from .outbox import record_changes
+from .shards import atomic, get_pair_shard
+from .summary import apply_summary_deltas
+
+MAX_BATCH_PAIRS = 50
+
+BATCH_RESULTS = {
+    "created": "создано",
+    "exists": "уже существует",
+    "not_found": "товара не существует",
+    "not_owner": "товар вам не принадлежит",
+    "own_ad": "нельзя обмениваться на свои товары",
+}
+
+
+def get_existing_pairs(pair_keys, aliases):
+    # По запросу на шард по уникальному индексу пар без учета направления, лишние сочетания отбрасываются в памяти
+    existing = {}
+    for i_alias in aliases:
+        rows = ExchangeProposal.objects.using(i_alias).filter(
+            pair_low__in={i_low for i_low, _ in pair_keys}, pair_high__in={i_high for _, i_high in pair_keys}
+        ).values_list("pair_low", "pair_high", "id")
+        existing.update({
+            (i_low, i_high): i_id
+            for i_low, i_high, i_id in rows
+            if (i_low, i_high) in pair_keys
+        })
+    return existing
+
+
+def get_pair_result(user, ads, existing, sender_id, receiver_id):
+    ad_sender, ad_receiver = ads[sender_id], ads[receiver_id]
+    if ad_sender is None or ad_receiver is None or ad_sender.deleted_at or ad_receiver.deleted_at:
+        return "not_found", None
+    if ad_sender.user_id != user.pk:
+        return "not_owner", None
+    if ad_receiver.user_id == user.pk:
+        return "own_ad", None
+    pair_key = ExchangeProposal.get_pair_key(sender_id, receiver_id)
+    if pair_key in existing:
+        return "exists", existing[pair_key]
+    return "created", None
+
+
+def create_proposals(user, sender_ids, receiver_ids, comment, loaders):
+    # Все пары проверяются двумя запросами (товары и существующие пары), вставка одним INSERT
+    pairs = [(i_sender_id, i_receiver_id) for i_sender_id in sender_ids for i_receiver_id in receiver_ids]
+    ads = dict(zip(sender_ids + receiver_ids, loaders.ads.load_many(sender_ids + receiver_ids)))
+    # Прямая и встречная пара лежат в одном шарде пары владельцев
+    aliases = list(dict.fromkeys(
+        get_pair_shard(user.pk, ads[i_ad_id].user_id) for i_ad_id in receiver_ids if ads[i_ad_id] is not None
+    ))
+    with atomic([DEFAULT_DB_ALIAS, *aliases]):
+        existing = get_existing_pairs({ExchangeProposal.get_pair_key(*i_pair) for i_pair in pairs}, aliases)
+        results = {}
+        new_proposals = []
+        for i_pair in pairs:
+            results[i_pair] = get_pair_result(user, ads, existing, *i_pair)
+            if results[i_pair][0] == "created":
+                new_proposals.append(
+                    ExchangeProposal(ad_sender=ads[i_pair[0]], ad_receiver=ads[i_pair[1]], comment=comment)
+                )
+        save_new_proposals(new_proposals)
+        for i_proposal in new_proposals:
+            pair = (i_proposal.ad_sender_id, i_proposal.ad_receiver_id)
+            results[pair] = ("created", i_proposal.pk) if i_proposal.pk is not None else ("exists", None)
+    return [
+        {
+            "ad_sender_id": i_sender_id,
+            "ad_receiver_id": i_receiver_id,
+            "ad_sender": ads[i_sender_id],
+            "ad_receiver": ads[i_receiver_id],
+            "result": results[(i_sender_id, i_receiver_id)][0],
+            "exchange_id": results[(i_sender_id, i_receiver_id)][1],
+        }
+        for i_sender_id, i_receiver_id in pairs
+    ]
+
+
+def insert_proposals(proposals, using):
+    # Вставка в точке сохранения: ошибка уникальности не прерывает общую транзакцию
+    try:
+        with transaction.atomic(using=using):
+            ExchangeProposal.objects.using(using).bulk_create(proposals)
+    except IntegrityError:
+        return False
+    return True
+
+
+def save_new_proposals(proposals):
+    if not proposals:
+        return []
+    # Пары шарда вставляются одним INSERT. Если какую-то пару успел вставить параллельный запрос, строки шарда
+    # вставляются по одной, и занятые пропускаются: их объекты остаются без id
+    proposals_by_shard = defaultdict(list)
+    for i_proposal in proposals:
+        i_proposal.set_user_ids()
+        proposals_by_shard[get_pair_shard(i_proposal.sender_user_id, i_proposal.receiver_user_id)].append(i_proposal)
+    created = []
+    for i_alias, i_proposals in proposals_by_shard.items():
+        if insert_proposals(i_proposals, i_alias):
+            created.extend(i_proposals)
+            continue
+        for i_proposal in i_proposals:
+            if insert_proposals([i_proposal], i_alias):
+                created.append(i_proposal)
+            else:
+                i_proposal.pk = None
+    for i_proposal in created:
+        i_proposal.remember_loaded_values()
+
+    # bulk_create не вызывает сигналы: события outbox и счетчики пользователей записываются здесь же
+    record_changes(created, "created")
+    transaction.on_commit(broker.wake)
+    deltas = defaultdict(Counter)
+    for i_proposal in created:
+        deltas[i_proposal.sender_user_id]["outgoing_waiting"] += 1
+        deltas[i_proposal.receiver_user_id]["incoming_waiting"] += 1
+    apply_summary_deltas(deltas)
+    return created
@@ -0,0 +1,114 @@
+import numpy as np
+
+from .models import Ad, ArchivedExchangeProposal, ExchangeProposal, ExchangeStatus
+from .shards import get_shard_aliases
+
+# Тяжелые разовые расчеты идут по выгруженным столбцам в NumPy, а не GROUP BY по рабочей базе.
+# Выгрузка читает таблицы короткими запросами по диапазонам id и не держит SQLite подолгу
+EXPORT_CHUNK_SIZE = 5000
+AD_COLUMNS = ["id", "user_id", "category_id", "created_at"]
+PROPOSAL_COLUMNS = [
+    "id", "ad_sender_id", "ad_receiver_id", "sender_user_id", "receiver_user_id", "status", "created_at", "closed_at",
+]
+TIME_COLUMNS = {"created_at", "closed_at"}
+
+
+def iter_chunks(queryset, fields, chunk_size):
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by("id").values_list(*fields)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def to_array(values, field):
+    if field in TIME_COLUMNS:
+        # Время - секунды Unix, у незакрытого предложения closed_at - NaN
+        return np.array([np.nan if i_value is None else i_value.timestamp() for i_value in values], dtype=np.float64)
+    return np.array(values, dtype=np.int64)
+
+
+def read_columns(querysets, fields, chunk_size):
+    chunks = {i_field: [] for i_field in fields}
+    for i_queryset in querysets:
+        for i_rows in iter_chunks(i_queryset, fields, chunk_size):
+            for i_field, i_values in zip(fields, zip(*i_rows)):
+                chunks[i_field].append(to_array(i_values, i_field))
+    return {
+        i_field: np.concatenate(i_chunks) if i_chunks else to_array([], i_field) for i_field, i_chunks in chunks.items()
+    }
+
+
+def export_columns(path, chunk_size=EXPORT_CHUNK_SIZE):
+    # Предложения собираются из всех шардов и архива
+    proposals_querysets = [ExchangeProposal.objects.using(i_alias) for i_alias in get_shard_aliases()]
+    proposals_querysets.append(ArchivedExchangeProposal.objects.all())
+    tables = {
+        "ads": read_columns([Ad.objects.all()], AD_COLUMNS, chunk_size),
+        "proposals": read_columns(proposals_querysets, PROPOSAL_COLUMNS, chunk_size),
+    }
+    arrays = {
+        f"{i_table}__{i_field}": i_values
+        for i_table, i_columns in tables.items()
+        for i_field, i_values in i_columns.items()
+    }
+    with open(path, "wb") as columns_file:
+        np.savez_compressed(columns_file, **arrays)
+    return {i_table: len(i_columns["id"]) for i_table, i_columns in tables.items()}
+
+
+def load_columns(path):
+    tables = {}
+    with np.load(path) as data:
+        for i_name in data.files:
+            table, field = i_name.split("__", 1)
+            tables.setdefault(table, {})[field] = data[i_name]
+    return tables
+
+
+def get_category_stats(tables):
+    ads = tables["ads"]
+    proposals = tables["proposals"]
+    # Категория предложения - категория товара-получателя: соединение поиском по отсортированным id.
+    # Предложения, чьих товаров уже нет (архив), в разбивку по категориям не попадают
+    order = np.argsort(ads["id"])
+    ad_ids = ads["id"][order]
+    ad_categories = ads["category_id"][order]
+    positions = np.searchsorted(ad_ids, proposals["ad_receiver_id"])
+    found = positions < len(ad_ids)
+    found[found] = ad_ids[positions[found]] == proposals["ad_receiver_id"][found]
+    categories = ad_categories[positions[found]]
+    statuses = proposals["status"][found]
+    seconds = (proposals["closed_at"] - proposals["created_at"])[found]
+
+    size = int(ads["category_id"].max(initial=0)) + 1
+    accepted = statuses == ExchangeStatus.ACCEPTED
+    counts = {
+        "ads": np.bincount(ads["category_id"], minlength=size),
+        "proposals": np.bincount(categories, minlength=size),
+        "accepted": np.bincount(categories[accepted], minlength=size),
+        "rejected": np.bincount(categories[statuses == ExchangeStatus.REJECTED], minlength=size),
+    }
+
+    # Медианы всех категорий за одну сортировку: по категории, внутри - по времени до принятия.
+    # Предложения, принятые до появления closed_at, в медиану не входят
+    timed = accepted & ~np.isnan(seconds)
+    accepted_order = np.lexsort((seconds[timed], categories[timed]))
+    accepted_categories = categories[timed][accepted_order]
+    accepted_seconds = seconds[timed][accepted_order]
+    starts = np.searchsorted(accepted_categories, np.arange(size))
+    ends = np.searchsorted(accepted_categories, np.arange(size), side="right")
+
+    stats = {}
+    for i_category_id in np.flatnonzero(counts["ads"] + counts["proposals"]):
+        start, end = starts[i_category_id], ends[i_category_id]
+        median = None
+        if end > start:
+            median = float((accepted_seconds[(start + end - 1) // 2] + accepted_seconds[(start + end) // 2]) / 2)
+        stats[int(i_category_id)] = {
+            **{i_name: int(i_counts[i_category_id]) for i_name, i_counts in counts.items()},
+            "accept_median": median,
+        }
+    return stats
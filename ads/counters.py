@@ -0,0 +1,106 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, close_old_connections
+from django.db.models import F
+
+from .models import Ad, get_popularity_weight
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounterBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.last_flush = time.monotonic()
+        self.flusher_pid = None
+        self.flusher_stop = None
+
+    def hit(self, ad_id):
+        if self.flusher_pid is not None:
+            self.start_flusher()
+        with self.lock:
+            self.pending[ad_id] += 1
+            should_flush = (
+                len(self.pending) >= settings.AD_VIEWS_MAX_PENDING
+                or time.monotonic() - self.last_flush >= settings.AD_VIEWS_FLUSH_INTERVAL
+            )
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+            self.last_flush = time.monotonic()
+        if not pending:
+            return 0
+
+        weight = get_popularity_weight()
+        ads = []
+        for i_ad_id, i_count in pending.items():
+            ad = Ad(pk=i_ad_id)
+            ad.views_count = F("views_count") + i_count
+            ad.popularity = F("popularity") + i_count * weight
+            ads.append(ad)
+        try:
+            # Один UPDATE ... CASE на весь пакет вместо записи на каждый просмотр
+            return Ad.all_objects.bulk_update(ads, ["views_count", "popularity"])
+        except DatabaseError as exc:
+            logger.warning("Не удалось записать просмотры объявлений, повтор при следующей записи: %s", exc)
+            with self.lock:
+                self.pending.update(pending)
+            return 0
+
+    def start_flusher(self):
+        # Сброс по таймеру (запускается в config/wsgi.py): просмотры записываются, даже если новых не было.
+        # Поток не переживает fork, поэтому запоминается процесс, и дочерний при первом просмотре запускает свой
+        with self.lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+            self.flusher_stop = threading.Event()
+        threading.Thread(target=self.run_flusher, args=(self.flusher_stop,), name="ad-views-flusher", daemon=True).start()
+
+    def stop_flusher(self):
+        with self.lock:
+            if self.flusher_stop is not None:
+                self.flusher_stop.set()
+            self.flusher_pid = self.flusher_stop = None
+
+    def run_flusher(self, stop):
+        while not stop.wait(settings.AD_VIEWS_FLUSH_INTERVAL):
+            if time.monotonic() - self.last_flush >= settings.AD_VIEWS_FLUSH_INTERVAL:
+                self.flush()
+            # Как в конце запроса: соединение потока закрывается, ошибка не оставит его сломанным
+            close_old_connections()
+
+
+def get_client_ip(request):
+    # За nginx адрес клиента - последний в X-Forwarded-For: его дописывает сам nginx, начало заголовка задает клиент
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for:
+        return forwarded_for.rsplit(",", 1)[-1].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def allow_view_hit(client_ip):
+    # Окно в минуту на адрес: счетчик в кеше, общем для процессов
+    cache_key = f"ad_view_hits:{client_ip}:{int(time.time() // 60)}"
+    cache.add(cache_key, 0, 60)
+    try:
+        hits = cache.incr(cache_key)
+    except ValueError:
+        # Окно истекло между add и incr
+        hits = 1
+    return hits <= settings.AD_VIEWS_RATE_LIMIT
+
+
+ad_views = ViewCounterBuffer()
+atexit.register(ad_views.flush)
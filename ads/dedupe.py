@@ -0,0 +1,148 @@
+import hashlib
+import zlib
+from collections import defaultdict
+
+import numpy as np
+from django.db import transaction
+
+from .models import Ad, AdBucket, AdSignature
+from .text import tokenize
+
+DEDUPE_CHUNK_SIZE = 500
+MINHASH_PERMUTATIONS = 64
+# 16 полос по 4 значения: кандидатами становятся пары со сходством примерно от 0.5
+LSH_BANDS = 16
+DUPLICATE_THRESHOLD = 0.7
+
+MINHASH_PRIME = 2 ** 31 - 1
+permutations_random = np.random.default_rng(20250101)
+PERMUTATION_A = permutations_random.integers(1, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+PERMUTATION_B = permutations_random.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def get_shingles(title, description):
+    # Пары соседних слов: перестановка или замена одного слова меняет лишь несколько шинглов
+    terms = tokenize(f"{title} {description}")
+    if len(terms) < 2:
+        return set(terms)
+    return {f"{i_first} {i_second}" for i_first, i_second in zip(terms, terms[1:])}
+
+
+def get_signature(title, description):
+    shingles = get_shingles(title, description)
+    if not shingles:
+        return None
+    hashes = np.array([zlib.crc32(i_shingle.encode()) for i_shingle in shingles], dtype=np.uint64) % MINHASH_PRIME
+    values = (PERMUTATION_A[:, None] * hashes[None, :] + PERMUTATION_B[:, None]) % MINHASH_PRIME
+    return values.min(axis=1).astype(np.uint32)
+
+
+def get_bucket_keys(signature):
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([i_band]) + i_values.tobytes(), digest_size=8).digest(), "big", signed=True)
+        for i_band, i_values in enumerate(np.split(signature, LSH_BANDS))
+    ]
+
+
+def get_similarity(signature, other_signature):
+    return float(np.mean(signature == other_signature))
+
+
+def load_signature(data):
+    return np.frombuffer(bytes(data), dtype=np.uint32)
+
+
+def find_duplicates(title, description, exclude_id=None):
+    # Один запрос по индексу корзин вместо сравнения со всеми объявлениями
+    signature = get_signature(title, description)
+    if signature is None:
+        return []
+    candidates = AdSignature.objects.filter(
+        ad__buckets__key__in=get_bucket_keys(signature), ad__deleted_at__isnull=True
+    ).distinct()
+    if exclude_id is not None:
+        candidates = candidates.exclude(ad_id=exclude_id)
+    duplicates = []
+    for i_ad_id, i_user_id, i_signature in candidates.values_list("ad_id", "ad__user_id", "signature"):
+        similarity = get_similarity(signature, load_signature(i_signature))
+        if similarity >= DUPLICATE_THRESHOLD:
+            duplicates.append((i_ad_id, i_user_id, similarity))
+    return sorted(duplicates)
+
+
+def index_ad(ad):
+    # Сохраняет подпись объявления и помечает его дубликатом самого раннего похожего объявления
+    signature = get_signature(ad.title, ad.description)
+    duplicates = [] if signature is None else find_duplicates(ad.title, ad.description, exclude_id=ad.id)
+    ad.duplicate_of_id = duplicates[0][0] if duplicates else None
+    with transaction.atomic():
+        Ad.all_objects.filter(pk=ad.pk).update(duplicate_of=ad.duplicate_of_id)
+        AdBucket.objects.filter(ad=ad).delete()
+        if signature is None:
+            AdSignature.objects.filter(ad=ad).delete()
+            return ad.duplicate_of_id
+        AdSignature.objects.update_or_create(ad=ad, defaults={"signature": signature.tobytes()})
+        AdBucket.objects.bulk_create([AdBucket(ad=ad, key=i_key) for i_key in get_bucket_keys(signature)])
+    return ad.duplicate_of_id
+
+
+def dedupe_chunk(ads):
+    signatures = {}
+    keys_by_ad = {}
+    for i_ad in ads:
+        signature = get_signature(i_ad.title, i_ad.description)
+        if signature is not None:
+            signatures[i_ad.id] = signature
+            keys_by_ad[i_ad.id] = get_bucket_keys(signature)
+
+    # Кандидаты из уже обработанных пакетов: один запрос корзин и один запрос подписей
+    bucket_ads = defaultdict(list)
+    chunk_keys = {i_key for i_keys in keys_by_ad.values() for i_key in i_keys}
+    for i_key, i_ad_id in AdBucket.objects.filter(key__in=chunk_keys).values_list("key", "ad_id"):
+        bucket_ads[i_key].append(i_ad_id)
+    known_ids = {i_ad_id for i_ad_ids in bucket_ads.values() for i_ad_id in i_ad_ids}
+    known_signatures = {
+        i_ad_id: load_signature(i_signature)
+        for i_ad_id, i_signature in AdSignature.objects.filter(ad_id__in=known_ids).values_list("ad_id", "signature")
+    }
+
+    flagged = 0
+    for i_ad in ads:
+        if i_ad.id not in signatures:
+            i_ad.duplicate_of_id = None
+            continue
+        candidate_ids = {i_ad_id for i_key in keys_by_ad[i_ad.id] for i_ad_id in bucket_ads[i_key]}
+        duplicate_ids = [
+            i_ad_id for i_ad_id in candidate_ids
+            if get_similarity(signatures[i_ad.id], known_signatures[i_ad_id]) >= DUPLICATE_THRESHOLD
+        ]
+        i_ad.duplicate_of_id = min(duplicate_ids) if duplicate_ids else None
+        flagged += bool(duplicate_ids)
+        # Объявления пакета становятся кандидатами для следующих объявлений этого же пакета
+        known_signatures[i_ad.id] = signatures[i_ad.id]
+        for i_key in keys_by_ad[i_ad.id]:
+            bucket_ads[i_key].append(i_ad.id)
+
+    with transaction.atomic():
+        Ad.all_objects.bulk_update(ads, ["duplicate_of"])
+        AdSignature.objects.bulk_create(
+            [AdSignature(ad_id=i_ad_id, signature=i_signature.tobytes()) for i_ad_id, i_signature in signatures.items()]
+        )
+        AdBucket.objects.bulk_create(
+            [AdBucket(ad_id=i_ad_id, key=i_key) for i_ad_id, i_keys in keys_by_ad.items() for i_key in i_keys]
+        )
+    return flagged
+
+
+def dedupe_ads(chunk_size=DEDUPE_CHUNK_SIZE):
+    # Полная перестройка индекса в порядке публикации: дубликатом считается более позднее объявление
+    AdBucket.objects.all().delete()
+    AdSignature.objects.all().delete()
+    flagged = 0
+    last_id = 0
+    while True:
+        ads = list(Ad.objects.filter(id__gt=last_id).order_by("id").only("id", "title", "description")[:chunk_size])
+        if not ads:
+            return flagged
+        flagged += dedupe_chunk(ads)
+        last_id = ads[-1].id
@@ -0,0 +1,46 @@
+from django.db.models import Q
+
+from .models import Ad
+from .search import search_ads
+
+
+AD_ORDERINGS = {"created_at", "-created_at", "title", "-title", "-popularity"}
+
+
+def get_catalogue_ads():
+    # Дубликаты скрыты из каталога, пока исходное объявление не удалено
+    return Ad.objects.filter(Q(duplicate_of__isnull=True) | Q(duplicate_of__deleted_at__isnull=False))
+
+
+def get_dictionary_id(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} должен быть числом")
+
+
+def filter_ads(ads_queryset, params):
+    # Категория и состояние передаются id справочника и сравниваются по целочисленным колонкам
+    category_id = get_dictionary_id(params, "category")
+    if category_id:
+        ads_queryset = ads_queryset.filter(category_id=category_id)
+
+    condition_id = get_dictionary_id(params, "condition")
+    if condition_id:
+        ads_queryset = ads_queryset.filter(condition_id=condition_id)
+
+    search = params.get("search")
+    if search:
+        ads_queryset = search_ads(ads_queryset, search)
+
+    return ads_queryset
+
+
+def get_ads_ordering(params, default="-created_at"):
+    ordering = params.get("ordering", default)
+    if ordering in AD_ORDERINGS:
+        return ordering
+    return None
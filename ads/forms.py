@@ -2,15 +2,81 @@ from django.core.exceptions import ValidationError
 from django import forms
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from .models import Ad, ExchangeProposal
+from .batch import MAX_BATCH_PAIRS
+from .dedupe import find_duplicates
+from .loaders import RequestLoaders
+from .models import Ad, ExchangeProposal, SavedSearch
+from .own_ads import get_own_ads
+from .percolate import get_index_key
+from .shards import get_pair_shard
 
 
-class NewAdForm(forms.ModelForm):
+class VersionedModelForm(forms.ModelForm):
+    # Версия, которую видел пользователь, возвращается скрытым полем и проверяется при сохранении
+    version = forms.IntegerField(min_value=0, required=False, widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["version"].initial = self.instance.version
+
+    def clean(self):
+        # Версия не попадает в cleaned_data: данные формы сохраняются в сессии и передаются в конструктор модели
+        cleaned_data = super().clean()
+        version = cleaned_data.pop("version", None)
+        if version is not None and self.instance.pk:
+            self.instance.version = version
+        return cleaned_data
+
+    def set_current_version(self, version):
+        # После конфликта форма показывается снова с актуальной версией: повторная отправка перезапишет запись
+        self.data = self.data.copy()
+        self.data[self.add_prefix("version")] = version
+
+
+class NewAdForm(VersionedModelForm):
     class Meta:
         model = Ad
         exclude = ["user"]
 
-class NewExchangeProposalForm(forms.ModelForm):
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop("user", None)
+        super().__init__(*args, **kwargs)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        title = cleaned_data.get("title")
+        description = cleaned_data.get("description")
+        if self.user is None or not title or not description:
+            return cleaned_data
+        # Повторная публикация своего же товара блокируется, похожие объявления других пользователей только помечаются
+        own_duplicates = [
+            i_ad_id for i_ad_id, i_user_id, _ in find_duplicates(title, description, exclude_id=self.instance.pk)
+            if i_user_id == self.user.pk
+        ]
+        if own_duplicates:
+            raise ValidationError(
+                f"Вы уже разместили похожее объявление {own_duplicates[0]}. Измените его вместо повторной публикации."
+            )
+        return cleaned_data
+
+
+class SavedSearchForm(forms.ModelForm):
+    class Meta:
+        model = SavedSearch
+        fields = ["search", "category", "condition"]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not any(cleaned_data.get(i_field) for i_field in self.Meta.fields):
+            raise ValidationError("Укажите ключевые слова, категорию или состояние.")
+        return cleaned_data
+
+    def save(self, commit=True):
+        self.instance.index_key = get_index_key(self.instance)
+        return super().save(commit=commit)
+
+
+class NewExchangeProposalForm(VersionedModelForm):
     ad_sender = forms.IntegerField(min_value=1)
     ad_receiver = forms.IntegerField(min_value=1)
 
@@ -21,49 +87,59 @@ class NewExchangeProposalForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         self.is_edit = kwargs.pop("is_edit", None)
         self.user = kwargs.pop("user", None)
+        self.loaders = kwargs.pop("loaders", None) or RequestLoaders()
         super().__init__(*args, **kwargs)
 
         if self.instance and self.instance.pk:
-            self.fields["ad_sender"].initial = self.instance.ad_sender.id
-            self.fields["ad_receiver"].initial = self.instance.ad_receiver.id
+            self.fields["ad_sender"].initial = self.instance.ad_sender_id
+            self.fields["ad_receiver"].initial = self.instance.ad_receiver_id
+        # Свои товары выбираются из кешированного списка, поле остается числовым с прежними сообщениями об ошибках
+        self.own_ads = get_own_ads(getattr(self.user, "pk", None))
+        if self.own_ads:
+            self.fields["ad_sender"].widget = forms.Select(
+                choices=[("", "---------")] + [(i_ad_id, f"{i_ad_id}: {i_title}") for i_ad_id, i_title in self.own_ads]
+            )
+        if self.is_bound:
+            # Оба товара выбираются одним запросом при проверке первого поля
+            self.loaders.ads.prime(self.data.get(self.add_prefix("ad_sender")), self.data.get(self.add_prefix("ad_receiver")))
 
-    def clean_ad_sender(self):
-        try:
-            ad_sender = Ad.objects.get(pk=self.cleaned_data["ad_sender"])
-        except Ad.DoesNotExist:
+    def load_ad(self, pk):
+        ad = self.loaders.ads.load(pk)
+        if ad is None or ad.deleted_at is not None:
             raise ValidationError("Товара не существует.")
-        if ad_sender.user != self.user:
-            list_of_allowed_ads = Ad.objects.filter(user=self.user).all()
-            if list_of_allowed_ads:
-                raise ValidationError(
-                    "Этот товар вам не принадлежит. Список доступных товаров: " + ", ".join(
-                        [str(i_ad.id) for i_ad in list_of_allowed_ads]
-                    )
+        return ad
+
+    def clean_ad_sender(self):
+        ad_sender = self.load_ad(self.cleaned_data["ad_sender"])
+        if ad_sender.user_id != getattr(self.user, "pk", None) and self.own_ads:
+            raise ValidationError(
+                "Этот товар вам не принадлежит. Список доступных товаров: " + ", ".join(
+                    [str(i_ad_id) for i_ad_id, _ in self.own_ads]
                 )
+            )
         return ad_sender
 
     def clean_ad_receiver(self):
-        try:
-            ad_receiver = Ad.objects.get(pk=self.cleaned_data["ad_receiver"])
-        except Ad.DoesNotExist:
-            raise ValidationError("Товара не существует.")
-        if ad_receiver.user == self.user:
+        ad_receiver = self.load_ad(self.cleaned_data["ad_receiver"])
+        if ad_receiver.user_id == getattr(self.user, "pk", None):
             raise ValidationError("Нельзя обмениваться на свои товары.")
         return ad_receiver
 
     def clean(self):
+        super().clean()
         ad_sender = self.cleaned_data.get("ad_sender")
         ad_receiver = self.cleaned_data.get("ad_receiver")
         if not ad_sender or not ad_receiver:
             return self.cleaned_data
         if self.is_edit:
-            try:
-                exchange = ExchangeProposal.objects.get(ad_sender=ad_sender.id, ad_receiver=ad_receiver.id)
-            except ExchangeProposal.DoesNotExist:
-                try:
-                    exchange = ExchangeProposal.objects.get(ad_sender=ad_receiver.id, ad_receiver=ad_sender.id)
-                except ExchangeProposal.DoesNotExist:
-                    return self.cleaned_data
+            # Прямая и встречная пара - один ключ уникального индекса в одном шарде пары владельцев
+            pair_low, pair_high = ExchangeProposal.get_pair_key(ad_sender.id, ad_receiver.id)
+            exchange = (
+                ExchangeProposal.objects.using(get_pair_shard(ad_sender.user_id, ad_receiver.user_id))
+                .filter(pair_low=pair_low, pair_high=pair_high).first()
+            )
+            if exchange is None:
+                return self.cleaned_data
             self.errors["ad_sender"] = [f"Предложение обмена {ad_sender.id} на {ad_receiver.id} уже существует"]
             self.errors["ad_sender"].append(mark_safe(
                 '<a href="{ref}">{exchange}</a>'.format(
@@ -72,3 +148,32 @@ class NewExchangeProposalForm(forms.ModelForm):
                 )
             ))
         return self.cleaned_data
+
+
+class BatchExchangeProposalForm(forms.Form):
+    ad_senders = forms.TypedMultipleChoiceField(coerce=int, label="Ваши товары")
+    ad_receivers = forms.CharField(label="Обменять на (id через запятую или пробел)")
+    comment = forms.CharField(max_length=500, widget=forms.Textarea, label="Комментарий")
+
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop("user", None)
+        super().__init__(*args, **kwargs)
+        self.fields["ad_senders"].choices = [
+            (i_ad_id, f"{i_ad_id}: {i_title}") for i_ad_id, i_title in get_own_ads(getattr(self.user, "pk", None))
+        ]
+
+    def clean_ad_senders(self):
+        return list(dict.fromkeys(self.cleaned_data["ad_senders"]))
+
+    def clean_ad_receivers(self):
+        values = self.cleaned_data["ad_receivers"].replace(",", " ").split()
+        if not all(i_value.isdigit() for i_value in values):
+            raise ValidationError("Укажите id товаров через запятую или пробел.")
+        return list(dict.fromkeys(int(i_value) for i_value in values))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        pairs_count = len(cleaned_data.get("ad_senders", [])) * len(cleaned_data.get("ad_receivers", []))
+        if pairs_count > MAX_BATCH_PAIRS:
+            raise ValidationError(f"За один раз можно отправить не больше {MAX_BATCH_PAIRS} предложений.")
+        return cleaned_data
@@ -0,0 +1,275 @@
+import fcntl
+import hashlib
+import http.client
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import time
+import urllib.request
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.urls import reverse
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+THUMBNAIL_SIZES = {"small": (320, 240), "large": (1024, 768)}
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_CONTENT_TYPE = "image/webp"
+# Неудачная загрузка запоминается, чтобы недоступный сервер не опрашивался на каждый показ страницы
+FAILURE_TTL = 300
+FETCH_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class ImageFetchError(Exception):
+    pass
+
+
+def get_url_version(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:12]
+
+
+def get_image_proxy_url(ad_id, image_url, size):
+    # Версия в адресе меняется вместе с image_url, поэтому ответ можно кешировать в браузере навсегда
+    if not image_url:
+        return ""
+    return reverse("ads:ad_image", kwargs={"pk": ad_id, "size": size}) + "?v=" + get_url_version(image_url)
+
+
+def get_cache_path(url, size):
+    key = hashlib.sha256(f"{size}\0{url}".encode()).hexdigest()
+    return Path(settings.IMAGE_CACHE_DIR) / key[:2] / f"{key}.webp"
+
+
+def check_url(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ImageFetchError(f"Неподдерживаемый адрес изображения: {url}")
+
+
+def get_checked_addresses(host, port):
+    # Адрес задает пользователь: без явного разрешения прокси не ходит во внутреннюю сеть
+    try:
+        addresses = [i_info[4][0] for i_info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    except (socket.gaierror, UnicodeError):
+        raise ImageFetchError(f"Не удалось найти сервер {host}")
+    if not settings.IMAGE_PROXY_ALLOW_PRIVATE and not all(
+        ipaddress.ip_address(i_address).is_global for i_address in addresses
+    ):
+        raise ImageFetchError(f"Сервер {host} находится во внутренней сети")
+    return addresses
+
+
+def create_checked_connection(address, timeout, source_address=None):
+    # Подключение идет к тем адресам, которые прошли проверку: повторное разрешение имени (DNS rebinding)
+    # не уведет запрос во внутреннюю сеть. Host и SNI остаются именем сервера из адреса
+    host, port = address
+    error = None
+    for i_address in get_checked_addresses(host, port):
+        try:
+            return socket.create_connection((i_address, port), timeout, source_address)
+        except OSError as connect_error:
+            error = connect_error
+    raise error
+
+
+class CheckedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_checked_connection
+
+
+class CheckedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = create_checked_connection
+
+
+class CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(CheckedHTTPConnection, req)
+
+
+class CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(CheckedHTTPSConnection, req)
+
+
+class CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# Прокси из окружения отключен: через него адрес сервера проверить нельзя
+url_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), CheckedHTTPHandler, CheckedHTTPSHandler, CheckedRedirectHandler
+)
+
+
+def read_body(url, response, deadline):
+    # Таймаут сокета ограничивает одно чтение, а сервер может отдавать по несколько байт за раз:
+    # общий срок загрузки проверяется между чтениями
+    chunks = []
+    size = 0
+    while size <= settings.IMAGE_FETCH_MAX_BYTES:
+        if time.monotonic() > deadline:
+            raise ImageFetchError(f"Изображение {url} не загрузилось за {settings.IMAGE_FETCH_TIMEOUT} с")
+        chunk = response.read1(FETCH_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b"".join(chunks)
+
+
+def fetch_image(url):
+    check_url(url)
+    deadline = time.monotonic() + settings.IMAGE_FETCH_TIMEOUT
+    request = urllib.request.Request(url, headers={"User-Agent": "django-barter-image-proxy"})
+    try:
+        with url_opener.open(request, timeout=settings.IMAGE_FETCH_TIMEOUT) as response:
+            data = read_body(url, response, deadline)
+    except (OSError, ValueError, http.client.HTTPException) as error:
+        raise ImageFetchError(f"Не удалось загрузить {url}: {error}")
+    if len(data) > settings.IMAGE_FETCH_MAX_BYTES:
+        raise ImageFetchError(f"Изображение {url} больше {settings.IMAGE_FETCH_MAX_BYTES} байт")
+    return data
+
+
+def make_thumbnail(data, size):
+    try:
+        image = Image.open(BytesIO(data))
+        # Для JPEG декодируется сразу уменьшенная копия, большие фото не разворачиваются целиком
+        image.draft("RGB", size)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+        image.thumbnail(size)
+        thumbnail = BytesIO()
+        image.save(thumbnail, THUMBNAIL_FORMAT, quality=80)
+    except (OSError, ValueError, UnidentifiedImageError, Image.DecompressionBombError) as error:
+        raise ImageFetchError(f"Не удалось обработать изображение: {error}")
+    return thumbnail.getvalue()
+
+
+def write_file(path, data):
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as cache_file:
+        cache_file.write(data)
+    os.replace(cache_file.name, path)
+
+
+written_since_eviction = 0
+
+
+def evict_cache(max_bytes):
+    # LRU по mtime: при каждом попадании файл "трогается", удаляются давно не запрошенные до 90% лимита
+    cache_dir = Path(settings.IMAGE_CACHE_DIR)
+    for i_path in cache_dir.glob("*/*.failed"):
+        if not has_recent_failure(i_path):
+            i_path.unlink(missing_ok=True)
+    files = []
+    total = 0
+    for i_path in cache_dir.glob("*/*.webp"):
+        try:
+            stat = i_path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, i_path))
+        total += stat.st_size
+    removed = 0
+    for _, i_size, i_path in sorted(files):
+        if total <= max_bytes * 0.9:
+            break
+        i_path.unlink(missing_ok=True)
+        total -= i_size
+        removed += 1
+    # Файлы блокировки вытесненных миниатюр и истекших неудач не нужны
+    for i_path in cache_dir.glob("*/*.lock"):
+        if not i_path.with_suffix(".webp").exists() and not i_path.with_suffix(".failed").exists():
+            remove_lock_file(i_path)
+    return removed
+
+
+def remove_lock_file(lock_path):
+    # Удаляется только свободный файл и под его же блокировкой: процесс, который ждал на нем,
+    # после захвата увидит, что файла по этому пути больше нет, и откроет новый (open_lock_file)
+    try:
+        lock_file = open(lock_path, "rb")
+    except FileNotFoundError:
+        return
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        lock_path.unlink(missing_ok=True)
+
+
+def open_lock_file(lock_path):
+    while True:
+        lock_file = open(lock_path, "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+def store_thumbnail(path, thumbnail):
+    global written_since_eviction
+    write_file(path, thumbnail)
+    # Каталог обходится не на каждую запись, а когда с прошлой проверки записано 5% лимита
+    written_since_eviction += len(thumbnail)
+    if written_since_eviction >= settings.IMAGE_CACHE_MAX_BYTES // 20:
+        written_since_eviction = 0
+        evict_cache(settings.IMAGE_CACHE_MAX_BYTES)
+
+
+def get_cached(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def has_recent_failure(failure_path):
+    try:
+        return time.time() - failure_path.stat().st_mtime < FAILURE_TTL
+    except FileNotFoundError:
+        return False
+
+
+def get_thumbnail(url, size):
+    # Возвращает путь к миниатюре в кеше или None, если изображение недоступно
+    path = get_cache_path(url, size)
+    if get_cached(path):
+        return path
+    failure_path = path.with_suffix(".failed")
+    if has_recent_failure(failure_path):
+        return None
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Одновременные запросы одного изображения (потоки и процессы gunicorn) ждут на блокировке файла,
+    # загружает первый, остальные после ожидания находят готовую миниатюру
+    with open_lock_file(path.with_suffix(".lock")):
+        if get_cached(path):
+            return path
+        if has_recent_failure(failure_path):
+            return None
+        try:
+            thumbnail = make_thumbnail(fetch_image(url), THUMBNAIL_SIZES[size])
+        except ImageFetchError as error:
+            logger.warning("Миниатюра не создана: %s", error)
+            failure_path.touch()
+            return None
+        store_thumbnail(path, thumbnail)
+        failure_path.unlink(missing_ok=True)
+        return path
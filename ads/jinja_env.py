@@ -0,0 +1,20 @@
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.formats import localize
+from django.utils.timezone import template_localtime
+from jinja2 import Environment
+
+
+def url(name, *args, **kwargs):
+    return reverse(name, args=args or None, kwargs=kwargs or None)
+
+
+def render_value(value):
+    # Как {{ }} в шаблонах Django: даты в текущем часовом поясе и локализованный формат дат и чисел
+    return localize(template_localtime(value))
+
+
+def environment(**options):
+    env = Environment(finalize=render_value, **options)
+    env.globals.update({"static": static, "url": url})
+    return env
@@ -0,0 +1,61 @@
+from django.contrib.auth.models import User
+
+from .models import Ad
+
+
+def get_loader_key(pk):
+    try:
+        return int(pk)
+    except (TypeError, ValueError):
+        return None
+
+
+class Loader:
+    # Ключи копятся в очереди и выбираются одним запросом при первом обращении, результаты запоминаются до конца запроса
+    def __init__(self, queryset, on_fetch=None):
+        self.queryset = queryset
+        self.on_fetch = on_fetch
+        self.cache = {}
+        self.queue = set()
+
+    def prime(self, *pks):
+        for i_pk in pks:
+            key = get_loader_key(i_pk)
+            if key is not None and key not in self.cache:
+                self.queue.add(key)
+
+    def load_many(self, pks):
+        keys = [get_loader_key(i_pk) for i_pk in pks]
+        self.prime(*keys)
+        if self.queue:
+            found = self.queryset.in_bulk(self.queue)
+            for i_key in self.queue:
+                self.cache[i_key] = found.get(i_key)
+            self.queue = set()
+            if self.on_fetch is not None:
+                self.on_fetch(found.values())
+        return [self.cache.get(i_key) for i_key in keys]
+
+    def load(self, pk):
+        return self.load_many([pk])[0]
+
+
+class RequestLoaders:
+    def __init__(self):
+        # Мягко удаленные объявления тоже загружаются, как при обращении через внешний ключ
+        self.ads = Loader(Ad.all_objects.select_related("category", "condition"), on_fetch=self.prime_owners)
+        self.users = Loader(User.objects.all())
+
+    def prime_owners(self, ads):
+        self.users.prime(*[i_ad.user_id for i_ad in ads])
+
+    def load_ads(self, pks):
+        # Объявления и их владельцы: по одному запросу на всю очередь ключей
+        ads = self.ads.load_many(pks)
+        owners = self.users.load_many([i_ad.user_id for i_ad in ads if i_ad is not None])
+        for i_ad, i_owner in zip([i_ad for i_ad in ads if i_ad is not None], owners):
+            i_ad.user = i_owner
+        return ads
+
+    def load_ad(self, pk):
+        return self.load_ads([pk])[0]
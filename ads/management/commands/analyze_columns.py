@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from ads.columns import get_category_stats, load_columns
+from ads.models import Category
+from ads.rollups import format_duration
+
+
+class Command(BaseCommand):
+    help = "Считает по выгрузке export_columns статистику обменов по категориям товара-получателя"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Файл выгрузки")
+
+    def handle(self, *args, **options):
+        stats = get_category_stats(load_columns(options["path"]))
+        names = Category.objects.in_bulk(list(stats))
+        for i_category_id, i_stats in stats.items():
+            name = names[i_category_id].name if i_category_id in names else i_category_id
+            closed = i_stats["accepted"] + i_stats["rejected"]
+            accept_rate = f"{i_stats['accepted'] / closed:.0%}" if closed else "—"
+            self.stdout.write(
+                f"{name}: объявлений {i_stats['ads']}, предложений {i_stats['proposals']}, "
+                f"принято {i_stats['accepted']}, отклонено {i_stats['rejected']}, доля принятых {accept_rate}, "
+                f"медиана до принятия {format_duration(i_stats['accept_median'])}"
+            )
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ads.archive import ARCHIVE_BATCH_SIZE, archive_proposals
+
+
+class Command(BaseCommand):
+    help = "Переносит давно закрытые предложения обмена в архивную таблицу"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None, help="Возраст закрытых предложений в днях")
+        parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        archived = archive_proposals(options["days"], options["batch_size"])
+        self.stdout.write(f"Перенесено в архив: {archived}")
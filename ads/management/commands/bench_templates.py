@@ -0,0 +1,56 @@
+import time
+from statistics import median
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django.test import RequestFactory
+from django.urls import reverse
+
+from ads.views import AllAddsView, ExchangeProposalListView
+
+BENCH_PAGES = [
+    ("ads:ads", AllAddsView),
+    ("ads:exchanges", ExchangeProposalListView),
+]
+
+
+class Command(BaseCommand):
+    help = "Сравнивает время отрисовки списков объявлений и предложений в шаблонах Django и Jinja2"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=50, help="Сколько раз отрисовать каждую страницу")
+        parser.add_argument("--user", help="Пользователь, от имени которого открываются страницы")
+
+    def get_user(self, username):
+        if username is None:
+            return AnonymousUser()
+        try:
+            return User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(f"Пользователь {username} не найден")
+
+    def get_response(self, url_name, view_class, user):
+        request = RequestFactory().get(reverse(url_name))
+        request.user = user
+        return request, view_class.as_view()(request)
+
+    def handle(self, *args, **options):
+        user = self.get_user(options["user"])
+        for i_url_name, i_view_class in BENCH_PAGES:
+            request, response = self.get_response(i_url_name, i_view_class, user)
+            if not hasattr(response, "context_data"):
+                self.stdout.write(f"{i_url_name}: пропущено, нужен --user")
+                continue
+            for i_engine in ["django", "jinja2"]:
+                template = engines[i_engine].get_template(response.template_name[0])
+                # Первая отрисовка выполняет запросы к БД, дальше измеряется только шаблон
+                template.render(response.context_data, request)
+                timings = []
+                for _ in range(options["repeat"]):
+                    start = time.perf_counter()
+                    template.render(response.context_data, request)
+                    timings.append((time.perf_counter() - start) * 1000)
+                self.stdout.write(
+                    f"{i_url_name} [{i_engine}]: медиана {median(timings):.2f} мс, минимум {min(timings):.2f} мс"
+                )
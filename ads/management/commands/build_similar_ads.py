@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ads.similar import SIMILAR_ADS_LIMIT, SIMILARITY_CHUNK_SIZE, build_similar_ads
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает похожие объявления для всех объявлений"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=SIMILARITY_CHUNK_SIZE)
+        parser.add_argument("--limit", type=int, default=SIMILAR_ADS_LIMIT, help="Количество похожих объявлений")
+
+    def handle(self, *args, **options):
+        processed = build_similar_ads(options["chunk_size"], options["limit"])
+        self.stdout.write(f"Обработано объявлений: {processed}")
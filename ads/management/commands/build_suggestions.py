@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads.suggest import rebuild_suggestions, update_suggestions
+
+
+class Command(BaseCommand):
+    help = "Обновляет снимок префиксного индекса подсказок поиска по ленте изменений"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true", help="Пересчитать частоты по всей таблице объявлений")
+        parser.add_argument("--interval", type=float, default=0, help="Повторять обновление каждые N секунд")
+
+    def handle(self, *args, **options):
+        if options["full"]:
+            self.stdout.write(f"Ключей в индексе: {rebuild_suggestions()}")
+        while True:
+            update_suggestions()
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
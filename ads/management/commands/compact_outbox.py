@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ads.outbox import compact_outbox
+
+
+class Command(BaseCommand):
+    help = "Удаляет из outbox старые события, уже прочитанные всеми потребителями"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=7, help="Срок хранения событий в днях")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = compact_outbox(options["days"], options["batch_size"])
+        self.stdout.write(f"Удалено событий: {deleted}")
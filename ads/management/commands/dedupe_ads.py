@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ads.dedupe import DEDUPE_CHUNK_SIZE, dedupe_ads
+
+
+class Command(BaseCommand):
+    help = "Перестраивает индекс MinHash и помечает дубликаты среди существующих объявлений"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=DEDUPE_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        flagged = dedupe_ads(options["chunk_size"])
+        self.stdout.write(f"Помечено дубликатов: {flagged}")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ads.columns import EXPORT_CHUNK_SIZE, export_columns
+
+
+class Command(BaseCommand):
+    help = "Выгружает объявления и предложения обмена по столбцам в файл NumPy (.npz) для анализа вне базы"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Файл выгрузки")
+        parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE, help="Строк в одном запросе")
+
+    def handle(self, *args, **options):
+        counts = export_columns(options["path"], options["chunk_size"])
+        self.stdout.write(f"Выгружено объявлений: {counts['ads']}, предложений: {counts['proposals']}")
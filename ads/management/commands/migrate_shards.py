@@ -0,0 +1,14 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from ads.shards import get_shard_aliases
+
+
+class Command(BaseCommand):
+    help = "Применяет миграции к основной базе и ко всем шардам предложений обмена"
+
+    def handle(self, *args, **options):
+        for i_alias in get_shard_aliases():
+            if options["verbosity"] > 0:
+                self.stdout.write(f"База {i_alias}:")
+            call_command("migrate", database=i_alias, interactive=False, verbosity=options["verbosity"], stdout=self.stdout)
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from ads.outbox import get_cursor, iter_change_batches, save_cursor
+
+
+class Command(BaseCommand):
+    help = "Выводит изменения объявлений и предложений обмена из outbox в формате JSON Lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=int, default=None, help="Номер события, после которого читать изменения")
+        parser.add_argument("--consumer", default=None, help="Имя потребителя, позиция которого сохраняется в БД")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--model", action="append", dest="models", help="ad или exchangeproposal")
+
+    def handle(self, *args, **options):
+        consumer = options["consumer"]
+        position = options["since"]
+        if position is None:
+            position = get_cursor(consumer) if consumer else 0
+
+        encoder = DjangoJSONEncoder(ensure_ascii=False)
+        for i_batch in iter_change_batches(position, options["batch_size"], options["models"]):
+            for i_event in i_batch:
+                self.stdout.write(encoder.encode({
+                    "id": i_event.id,
+                    "model": i_event.model,
+                    "object_id": i_event.object_id,
+                    "kind": i_event.kind,
+                    "created_at": i_event.created_at,
+                    "payload": i_event.payload,
+                }))
+            if consumer:
+                save_cursor(consumer, i_batch[-1].id)
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads.prerender import prerender_all, update_prerendered
+
+
+class Command(BaseCommand):
+    help = "Отрисовывает страницы каталога и объявлений в HTML-файлы для раздачи через nginx"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true", help="Перерисовать все страницы")
+        parser.add_argument("--interval", type=float, default=0, help="Повторять обновление каждые N секунд")
+
+    def handle(self, *args, **options):
+        if options["full"]:
+            self.stdout.write(f"Отрисовано страниц: {prerender_all()}")
+        while True:
+            rendered = update_prerendered()
+            if rendered and options["verbosity"] > 1:
+                self.stdout.write(f"Перерисовано страниц: {rendered}")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from ads.purge import soft_delete_user
+
+
+class Command(BaseCommand):
+    help = "Скрывает пользователя и его объявления и ставит их удаление в очередь фоновых задач"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError("Пользователь не найден")
+        soft_delete_user(user)
+        self.stdout.write(f"Пользователь {user.username} скрыт, удаление поставлено в очередь")
@@ -0,0 +1,36 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from ads.models import ExchangeProposal
+from ads.shards import atomic, get_pair_shard, get_shard_aliases
+
+
+def move_proposals(ids, source, target):
+    # Строки переносятся как есть, с теми же id и версией: данные не меняются, события в outbox не пишутся
+    with atomic([source, target]):
+        rows = list(ExchangeProposal.all_objects.using(source).filter(pk__in=ids))
+        ExchangeProposal.all_objects.using(target).bulk_create(rows)
+        ExchangeProposal.all_objects.using(source).filter(pk__in=ids)._raw_delete(source)
+    return len(rows)
+
+
+class Command(BaseCommand):
+    help = "Переносит предложения обмена в шарды их пар после изменения DJANGO_EXCHANGE_SHARDS или правила размещения"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Сколько предложений переносить за транзакцию")
+
+    def handle(self, *args, **options):
+        moved = 0
+        for i_source in get_shard_aliases():
+            misplaced = defaultdict(list)
+            rows = ExchangeProposal.all_objects.using(i_source).values_list("id", "sender_user_id", "receiver_user_id")
+            for i_id, i_sender_user_id, i_receiver_user_id in rows.iterator():
+                target = get_pair_shard(i_sender_user_id, i_receiver_user_id)
+                if target != i_source:
+                    misplaced[target].append(i_id)
+            for i_target, i_ids in misplaced.items():
+                for i_start in range(0, len(i_ids), options["batch_size"]):
+                    moved += move_proposals(i_ids[i_start:i_start + options["batch_size"]], i_source, i_target)
+        self.stdout.write(f"Перенесено предложений: {moved}")
@@ -0,0 +1,21 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from ads.summary import rebuild_user_summary
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает счетчики объявлений и предложений обмена пользователей"
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="По умолчанию - все пользователи")
+
+    def handle(self, *args, **options):
+        users_queryset = User.objects.all()
+        if options["usernames"]:
+            users_queryset = users_queryset.filter(username__in=options["usernames"])
+        rebuilt = 0
+        for i_user_id in users_queryset.values_list("id", flat=True).iterator():
+            rebuild_user_summary(i_user_id)
+            rebuilt += 1
+        self.stdout.write(f"Пересчитано пользователей: {rebuilt}")
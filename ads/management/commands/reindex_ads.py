@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ads.search import REINDEX_BATCH_SIZE, reindex_ads
+
+
+class Command(BaseCommand):
+    help = "Перестраивает поисковый индекс объявлений (например, после изменения нормализации текста)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=REINDEX_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        indexed = reindex_ads(options["batch_size"])
+        self.stdout.write(f"Проиндексировано объявлений: {indexed}")
@@ -0,0 +1,37 @@
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads.tasks import claim_task, delete_finished_tasks, run_task
+
+
+class Command(BaseCommand):
+    help = "Обработчик фоновых задач, хранящихся в базе данных проекта"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--worker-id", default=f"{socket.gethostname()}:{os.getpid()}")
+        parser.add_argument("--lease", type=int, default=300, help="Время аренды задачи в секундах")
+        parser.add_argument("--sleep", type=float, default=1.0, help="Пауза при пустой очереди в секундах")
+        parser.add_argument("--once", action="store_true", help="Обработать доступные задачи и завершиться")
+        parser.add_argument("--keep-days", type=int, default=7, help="Сколько дней хранить завершенные задачи")
+
+    def handle(self, *args, **options):
+        processed = 0
+        last_cleanup = 0
+        while True:
+            if time.monotonic() - last_cleanup > 3600:
+                delete_finished_tasks(options["keep_days"])
+                last_cleanup = time.monotonic()
+
+            task_record = claim_task(options["worker_id"], lease_seconds=options["lease"])
+            if task_record is not None:
+                run_task(task_record)
+                processed += 1
+            elif options["once"]:
+                break
+            else:
+                time.sleep(options["sleep"])
+
+        self.stdout.write(f"Обработано задач: {processed}")
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils import timezone
+
+from ads.models import Task
+from ads.tasks import get_task_latency_stats
+
+
+class Command(BaseCommand):
+    help = "Показывает размер очереди и задержку запуска фоновых задач"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=int, default=24, help="За сколько последних часов считать задержку")
+
+    def handle(self, *args, **options):
+        for i_row in Task.objects.values("name", "status").annotate(count=Count("id")).order_by("name", "status"):
+            self.stdout.write(f"{i_row['name']}: {i_row['status']} = {i_row['count']}")
+
+        since = timezone.now() - timedelta(hours=options["hours"])
+        for i_name, i_stats in get_task_latency_stats(since).items():
+            self.stdout.write(
+                f"{i_name}: выполнено {i_stats['count']}, задержка медиана {i_stats['median']:.3f} с, "
+                f"p95 {i_stats['p95']:.3f} с, максимум {i_stats['max']:.3f} с"
+            )
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ads.rollups import update_rollups
+
+
+class Command(BaseCommand):
+    help = "Дописывает в часовые и суточные сводки новые события объявлений и предложений из outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--interval", type=float, default=0, help="Повторять обновление каждые N секунд")
+
+    def handle(self, *args, **options):
+        while True:
+            processed = update_rollups(options["batch_size"])
+            if processed and options["verbosity"] > 1:
+                self.stdout.write(f"Учтено событий: {processed}")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,11 @@
+from .loaders import RequestLoaders
+
+
+class RequestLoadersMiddleware:
+    # Загрузчики живут один запрос: формы и представления делят между собой уже выбранные объекты
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.loaders = RequestLoaders()
+        return self.get_response(request)
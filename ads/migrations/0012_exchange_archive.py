@@ -0,0 +1,49 @@
+# Generated by Django 5.2 on 2026-10-19 12:45
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_closed_at(apps, schema_editor):
+    # Дата закрытия старых предложений неизвестна, берется дата публикации
+    ExchangeProposal = apps.get_model("ads", "ExchangeProposal")
+    proposals = ExchangeProposal.objects.using(schema_editor.connection.alias)
+    proposals.exclude(status="waiting").update(closed_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0011_soft_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedExchangeProposal',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='ID предложения')),
+                ('ad_sender_id', models.BigIntegerField(verbose_name='ID товара отправителя')),
+                ('ad_receiver_id', models.BigIntegerField(verbose_name='ID товара получателя')),
+                ('ad_sender_title', models.CharField(max_length=200, verbose_name='Ваш товар')),
+                ('ad_receiver_title', models.CharField(max_length=200, verbose_name='Обменять на')),
+                ('sender_user_id', models.BigIntegerField(db_index=True, verbose_name='ID отправителя')),
+                ('receiver_user_id', models.BigIntegerField(db_index=True, verbose_name='ID получателя')),
+                ('comment', models.CharField(max_length=500, verbose_name='Комментарий')),
+                ('status', models.CharField(choices=[('waiting', 'ожидает'), ('accepted', 'принят'), ('rejected', 'отклонен')], verbose_name='Статус предложения')),
+                ('created_at', models.DateTimeField(verbose_name='Дата публикации предложения')),
+                ('closed_at', models.DateTimeField(verbose_name='Дата закрытия предложения')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата переноса в архив')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='exchangeproposal',
+            name='closed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Дата закрытия предложения'),
+        ),
+        migrations.AlterField(
+            model_name='outboxevent',
+            name='kind',
+            field=models.CharField(choices=[('created', 'создание'), ('updated', 'изменение'), ('status', 'смена статуса'), ('deleted', 'удаление'), ('archived', 'перенос в архив')], max_length=20, verbose_name='Тип изменения'),
+        ),
+        migrations.RunPython(fill_closed_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-19 12:51
+
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_popularity(apps, schema_editor):
+    # Существующие объявления получают вес одного просмотра на дату публикации
+    Ad = apps.get_model("ads", "Ad")
+    epoch = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    half_life = settings.AD_POPULARITY_HALF_LIFE_DAYS * 86400
+    ads = list(Ad.objects.only("id", "created_at"))
+    for i_ad in ads:
+        i_ad.popularity = 2 ** ((i_ad.created_at - epoch).total_seconds() / half_life)
+    Ad.objects.bulk_update(ads, ["popularity"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0013_deleted_at_not_editable'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='popularity',
+            field=models.FloatField(db_index=True, default=0, editable=False, verbose_name='Популярность'),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='views_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Просмотров'),
+        ),
+        migrations.RunPython(fill_popularity, migrations.RunPython.noop),
+    ]
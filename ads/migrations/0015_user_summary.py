@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-19 12:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0014_ad_views'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ads_summary', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('ads_count', models.IntegerField(default=0, verbose_name='Объявлений')),
+                ('incoming_waiting', models.IntegerField(default=0, verbose_name='Входящих ожидают')),
+                ('incoming_accepted', models.IntegerField(default=0, verbose_name='Входящих принято')),
+                ('incoming_rejected', models.IntegerField(default=0, verbose_name='Входящих отклонено')),
+                ('outgoing_waiting', models.IntegerField(default=0, verbose_name='Исходящих ожидают')),
+                ('outgoing_accepted', models.IntegerField(default=0, verbose_name='Исходящих принято')),
+                ('outgoing_rejected', models.IntegerField(default=0, verbose_name='Исходящих отклонено')),
+            ],
+        ),
+    ]
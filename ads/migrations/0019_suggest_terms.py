@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-19 13:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0018_ad_duplicates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SuggestTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('term', 'слово заголовка'), ('category', 'категория')], max_length=20, verbose_name='Тип')),
+                ('key', models.CharField(max_length=400, verbose_name='Ключ')),
+                ('weight', models.IntegerField(default=0, verbose_name='Количество объявлений')),
+            ],
+            options={
+                'unique_together': {('kind', 'key')},
+            },
+        ),
+    ]
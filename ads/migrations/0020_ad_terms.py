@@ -0,0 +1,59 @@
+# Generated by Django 5.2 on 2026-10-19 13:10
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+
+from ads.text import get_search_terms
+
+BATCH_SIZE = 500
+
+
+def fill_ad_terms(apps, schema_editor):
+    # Миграция не атомарная: каждый пакет объявлений индексируется в своей транзакции
+    Ad = apps.get_model("ads", "Ad")
+    AdTerm = apps.get_model("ads", "AdTerm")
+    SavedSearch = apps.get_model("ads", "SavedSearch")
+    last_id = 0
+    while True:
+        ads = list(Ad.objects.filter(id__gt=last_id).order_by("id").only("id", "title", "description", "category")[:BATCH_SIZE])
+        if not ads:
+            break
+        with transaction.atomic():
+            AdTerm.objects.bulk_create(
+                [
+                    AdTerm(ad_id=i_ad.id, term=i_term[:100])
+                    for i_ad in ads
+                    for i_term in set(get_search_terms(" ".join([i_ad.title, i_ad.description, i_ad.category])))
+                ],
+                ignore_conflicts=True,
+            )
+        last_id = ads[-1].id
+
+    # Ключи сохраненных поисков теперь строятся из основ слов
+    saved_searches = list(SavedSearch.objects.exclude(search=""))
+    for i_saved_search in saved_searches:
+        i_saved_search.index_key = max(get_search_terms(i_saved_search.search), key=len, default=i_saved_search.index_key)
+    SavedSearch.objects.bulk_update(saved_searches, ["index_key"], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('ads', '0019_suggest_terms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100)),
+                ('ad', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='ads.ad')),
+            ],
+            options={
+                'unique_together': {('term', 'ad')},
+            },
+        ),
+        migrations.RunPython(fill_ad_terms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,144 @@
+import django.db.models.deletion
+from collections import Counter
+
+from django.db import migrations, models
+
+DICTIONARY_FIELDS = {"category": "Category", "condition": "Condition"}
+
+
+def get_dictionary_key(name):
+    # Строки, отличающиеся только регистром и пробелами, попадают в одну запись справочника
+    return " ".join(name.split()).casefold()
+
+
+def fill_dictionaries(apps, schema_editor):
+    Ad = apps.get_model("ads", "Ad")
+    SavedSearch = apps.get_model("ads", "SavedSearch")
+    for i_field, i_model_name in DICTIONARY_FIELDS.items():
+        Dictionary = apps.get_model("ads", i_model_name)
+        counts = Counter(dict(Ad.objects.values_list(i_field).annotate(count=models.Count("id"))))
+        counts.update(SavedSearch.objects.exclude(**{i_field: ""}).values_list(i_field, flat=True))
+        spellings = {}
+        for i_name, _ in counts.most_common():
+            # Для группы написаний берется самое частое
+            spellings.setdefault(get_dictionary_key(i_name), " ".join(i_name.split()))
+        entries = {
+            i_key: Dictionary.objects.create(name=i_name) for i_key, i_name in sorted(spellings.items(), key=lambda i_item: i_item[1])
+        }
+        for i_name in counts:
+            entry = entries[get_dictionary_key(i_name)]
+            Ad.objects.filter(**{i_field: i_name}).update(**{f"{i_field}_ref": entry})
+            SavedSearch.objects.filter(**{i_field: i_name}).update(**{f"{i_field}_ref": entry})
+
+    # Ключ обратного индекса сохраненных поисков по фильтрам теперь содержит id справочника
+    for i_saved_search in SavedSearch.objects.filter(index_key__regex=r"^(category|condition):"):
+        field = i_saved_search.index_key.partition(":")[0]
+        i_saved_search.index_key = f"{field}:{getattr(i_saved_search, f'{field}_ref_id')}"
+        i_saved_search.save(update_fields=["index_key"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0020_ad_terms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=200, unique=True, verbose_name='Название категории')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Condition',
+            fields=[
+                ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=200, unique=True, verbose_name='Название состояния')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='category_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='ads', to='ads.category'),
+        ),
+        migrations.AddField(
+            model_name='ad',
+            name='condition_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='ads', to='ads.condition'),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='category_ref',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ads.category'),
+        ),
+        migrations.AddField(
+            model_name='savedsearch',
+            name='condition_ref',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ads.condition'),
+        ),
+        migrations.RunPython(fill_dictionaries, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='ad',
+            name='category',
+        ),
+        migrations.RemoveField(
+            model_name='ad',
+            name='condition',
+        ),
+        migrations.RemoveField(
+            model_name='savedsearch',
+            name='category',
+        ),
+        migrations.RemoveField(
+            model_name='savedsearch',
+            name='condition',
+        ),
+        migrations.RenameField(
+            model_name='ad',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.RenameField(
+            model_name='ad',
+            old_name='condition_ref',
+            new_name='condition',
+        ),
+        migrations.RenameField(
+            model_name='savedsearch',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.RenameField(
+            model_name='savedsearch',
+            old_name='condition_ref',
+            new_name='condition',
+        ),
+        migrations.AlterField(
+            model_name='ad',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ads', to='ads.category', verbose_name='Категория товара'),
+        ),
+        migrations.AlterField(
+            model_name='ad',
+            name='condition',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ads', to='ads.condition', verbose_name='Состояние товара'),
+        ),
+        migrations.AlterField(
+            model_name='savedsearch',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ads.category', verbose_name='Категория товара'),
+        ),
+        migrations.AlterField(
+            model_name='savedsearch',
+            name='condition',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ads.condition', verbose_name='Состояние товара'),
+        ),
+    ]
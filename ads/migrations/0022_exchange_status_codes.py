@@ -0,0 +1,94 @@
+# Generated by Django 5.2 on 2026-10-19 13:18
+
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 500
+STATUS_CODES = {"waiting": 0, "accepted": 1, "rejected": 2}
+
+
+def fill_status_codes(apps, schema_editor):
+    # Миграция не атомарная: строки переводятся пакетами по диапазонам id, каждый пакет в своей транзакции.
+    # Старый строковый столбец остается на месте, строки, измененные старым кодом после прохода,
+    # догоняет миграция 0029 после установки триггеров
+    alias = schema_editor.connection.alias
+    # Модель, строковое поле, числовое поле
+    tables = [("ExchangeProposal", "legacy_status", "status"), ("ArchivedExchangeProposal", "status", "status_code")]
+    for i_model_name, i_key_field, i_code_field in tables:
+        model_queryset = apps.get_model("ads", i_model_name).objects.using(alias)
+        last_id = 0
+        while True:
+            batch_ids = list(model_queryset.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:BATCH_SIZE])
+            if not batch_ids:
+                break
+            with transaction.atomic(using=alias):
+                batch_queryset = model_queryset.filter(id__gte=batch_ids[0], id__lte=batch_ids[-1])
+                for i_status, i_code in STATUS_CODES.items():
+                    batch_queryset.filter(**{i_key_field: i_status}).update(**{i_code_field: i_code})
+            last_id = batch_ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('ads', '0021_category_condition'),
+    ]
+
+    operations = [
+        # Строковый столбец status остается до миграции 0030: старый код, работающий во время выкладки,
+        # пишет только его. Новые строки пишут только число, поэтому строковый столбец становится необязательным
+        migrations.AlterField(
+            model_name='exchangeproposal',
+            name='status',
+            field=models.CharField(choices=[('waiting', 'ожидает'), ('accepted', 'принят'), ('rejected', 'отклонен')], editable=False, null=True, verbose_name='Статус предложения (строкой)'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='exchangeproposal',
+                    old_name='status',
+                    new_name='legacy_status',
+                ),
+                migrations.AlterField(
+                    model_name='exchangeproposal',
+                    name='legacy_status',
+                    field=models.CharField(choices=[('waiting', 'ожидает'), ('accepted', 'принят'), ('rejected', 'отклонен')], db_column='status', editable=False, null=True, verbose_name='Статус предложения (строкой)'),
+                ),
+            ],
+        ),
+        # Числовой столбец добавляется пустым: ALTER TABLE без пересоздания таблицы
+        migrations.AddField(
+            model_name='exchangeproposal',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'ожидает'), (1, 'принят'), (2, 'отклонен')], db_column='status_code', null=True, verbose_name='Статус предложения'),
+        ),
+        # Архив появился в этой же серии изменений, старый код в него не пишет: столбец заменяется сразу
+        migrations.AddField(
+            model_name='archivedexchangeproposal',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_status_codes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='archivedexchangeproposal',
+            name='status',
+        ),
+        migrations.RenameField(
+            model_name='archivedexchangeproposal',
+            old_name='status_code',
+            new_name='status',
+        ),
+        migrations.AlterField(
+            model_name='archivedexchangeproposal',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'ожидает'), (1, 'принят'), (2, 'отклонен')], verbose_name='Статус предложения'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(condition=models.Q(('status', 0)), fields=['ad_receiver', '-created_at'], name='exchange_waiting_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(condition=models.Q(('status', 0)), fields=['ad_sender', '-created_at'], name='exchange_waiting_sender_idx'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2 on 2026-10-19 13:43
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+from django.utils import timezone
+
+STATUS_KEYS = {0: "waiting", 1: "accepted", 2: "rejected"}
+
+
+def resolve_reversed_pairs(apps, schema_editor):
+    # Встречные пары, созданные до общего ключа: остается более раннее предложение, позднее помечается удаленным
+    ExchangeProposal = apps.get_model("ads", "ExchangeProposal")
+    UserSummary = apps.get_model("ads", "UserSummary")
+    proposals = ExchangeProposal.objects.using(schema_editor.connection.alias)
+    live_proposals = proposals.filter(deleted_at__isnull=True)
+    reversed_proposals = live_proposals.filter(
+        models.Exists(
+            live_proposals.filter(
+                ad_sender=models.OuterRef("ad_receiver"),
+                ad_receiver=models.OuterRef("ad_sender"),
+                id__lt=models.OuterRef("id"),
+            )
+        )
+    )
+    rows = list(reversed_proposals.values_list("id", "ad_sender__user_id", "ad_receiver__user_id", "status"))
+    if not rows:
+        return
+    proposals.filter(id__in=[i_row[0] for i_row in rows]).update(deleted_at=timezone.now())
+    # Удаленные предложения не входят в счетчики пользователей
+    for _, i_sender_user_id, i_receiver_user_id, i_status in rows:
+        for i_user_id, i_field in [
+            (i_sender_user_id, f"outgoing_{STATUS_KEYS[i_status]}"),
+            (i_receiver_user_id, f"incoming_{STATUS_KEYS[i_status]}"),
+        ]:
+            UserSummary.objects.filter(pk=i_user_id).update(**{i_field: models.F(i_field) - 1})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0023_versions'),
+    ]
+
+    operations = [
+        migrations.RunPython(resolve_reversed_pairs, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='exchangeproposal',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='exchangeproposal',
+            name='pair_high',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Greatest('ad_sender', 'ad_receiver'), output_field=models.BigIntegerField()),
+        ),
+        migrations.AddField(
+            model_name='exchangeproposal',
+            name='pair_low',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Least('ad_sender', 'ad_receiver'), output_field=models.BigIntegerField()),
+        ),
+        migrations.AddConstraint(
+            model_name='exchangeproposal',
+            constraint=models.UniqueConstraint(condition=models.Q(('deleted_at__isnull', True)), fields=('pair_low', 'pair_high'), name='exchange_unordered_pair_unique'),
+        ),
+    ]
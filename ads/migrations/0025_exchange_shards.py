@@ -0,0 +1,63 @@
+# Generated by Django 5.2 on 2026-10-19 18:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_user_ids(apps, schema_editor):
+    # До шардов все предложения в основной базе: владельцы товаров берутся одним UPDATE с подзапросами
+    Ad = apps.get_model("ads", "Ad")
+    ExchangeProposal = apps.get_model("ads", "ExchangeProposal")
+    ExchangeProposal.objects.using(schema_editor.connection.alias).update(
+        sender_user_id=models.Subquery(Ad.objects.filter(pk=models.OuterRef("ad_sender")).values("user_id")),
+        receiver_user_id=models.Subquery(Ad.objects.filter(pk=models.OuterRef("ad_receiver")).values("user_id")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0024_unordered_pairs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exchangeproposal',
+            name='ad_receiver',
+            field=models.ForeignKey(db_constraint=False, default='', on_delete=django.db.models.deletion.CASCADE, related_name='receiver', to='ads.ad', verbose_name='Обменять на'),
+        ),
+        migrations.AlterField(
+            model_name='exchangeproposal',
+            name='ad_sender',
+            field=models.ForeignKey(db_constraint=False, default='', on_delete=django.db.models.deletion.CASCADE, related_name='sender', to='ads.ad', verbose_name='Ваш товар'),
+        ),
+        migrations.AddField(
+            model_name='exchangeproposal',
+            name='receiver_user_id',
+            field=models.BigIntegerField(editable=False, null=True, verbose_name='ID получателя'),
+        ),
+        migrations.AddField(
+            model_name='exchangeproposal',
+            name='sender_user_id',
+            field=models.BigIntegerField(editable=False, null=True, verbose_name='ID отправителя'),
+        ),
+        migrations.RunPython(fill_user_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='exchangeproposal',
+            name='receiver_user_id',
+            field=models.BigIntegerField(editable=False, verbose_name='ID получателя'),
+        ),
+        migrations.AlterField(
+            model_name='exchangeproposal',
+            name='sender_user_id',
+            field=models.BigIntegerField(editable=False, verbose_name='ID отправителя'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(fields=['receiver_user_id', '-created_at'], name='exchange_receiver_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchangeproposal',
+            index=models.Index(fields=['sender_user_id', '-created_at'], name='exchange_sender_user_idx'),
+        ),
+    ]
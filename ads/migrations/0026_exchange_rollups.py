@@ -0,0 +1,41 @@
+# Generated by Django 5.2 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0025_exchange_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'час'), ('day', 'сутки')], max_length=10, verbose_name='Период')),
+                ('start', models.DateTimeField(verbose_name='Начало периода')),
+                ('category_id', models.PositiveSmallIntegerField(verbose_name='ID категории')),
+                ('ads_created', models.PositiveIntegerField(default=0, verbose_name='Новых объявлений')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('period', 'start', 'category_id'), name='ad_rollup_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ExchangeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'час'), ('day', 'сутки')], max_length=10, verbose_name='Период')),
+                ('start', models.DateTimeField(verbose_name='Начало периода')),
+                ('proposals_created', models.PositiveIntegerField(default=0, verbose_name='Создано предложений')),
+                ('proposals_accepted', models.PositiveIntegerField(default=0, verbose_name='Принято')),
+                ('proposals_rejected', models.PositiveIntegerField(default=0, verbose_name='Отклонено')),
+                ('accept_histogram', models.JSONField(default=dict, verbose_name='Время до принятия')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('period', 'start'), name='exchange_rollup_unique')],
+            },
+        ),
+    ]
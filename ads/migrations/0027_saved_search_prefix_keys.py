@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-19 20:05
+
+from django.db import migrations
+
+from ads.text import get_index_key, get_search_terms
+
+BATCH_SIZE = 500
+
+
+def fill_prefix_keys(apps, schema_editor):
+    # Ключи сохраненных поисков теперь - транслитерированное начало самого длинного слова
+    SavedSearch = apps.get_model("ads", "SavedSearch")
+    saved_searches = list(SavedSearch.objects.exclude(search=""))
+    for i_saved_search in saved_searches:
+        terms = get_search_terms(i_saved_search.search)
+        if terms:
+            i_saved_search.index_key = get_index_key(max(terms, key=len))
+    SavedSearch.objects.bulk_update(saved_searches, ["index_key"], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0026_exchange_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_prefix_keys, migrations.RunPython.noop),
+    ]
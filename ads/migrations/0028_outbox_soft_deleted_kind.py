@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 15:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0027_saved_search_prefix_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxevent',
+            name='kind',
+            field=models.CharField(choices=[('created', 'создание'), ('updated', 'изменение'), ('status', 'смена статуса'), ('deleted', 'удаление'), ('soft_deleted', 'мягкое удаление'), ('archived', 'перенос в архив')], max_length=20, verbose_name='Тип изменения'),
+        ),
+    ]
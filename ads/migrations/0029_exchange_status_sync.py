@@ -0,0 +1,73 @@
+# Generated by Django 5.2 on 2026-10-19 16:05
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 500
+STATUS_CODES = {"waiting": 0, "accepted": 1, "rejected": 2}
+KEY_TO_CODE = "CASE NEW.status WHEN 'waiting' THEN 0 WHEN 'accepted' THEN 1 WHEN 'rejected' THEN 2 END"
+CODE_TO_KEY = "CASE NEW.status_code WHEN 0 THEN 'waiting' WHEN 1 THEN 'accepted' WHEN 2 THEN 'rejected' END"
+
+# Пока рядом работают старая и новая версии, любая запись в один из столбцов статуса дописывает второй:
+# старый код пишет только строку, новый - только число. Триггеры ставятся после миграций, пересоздающих
+# таблицу (0023-0025): SQLite удаляет триггеры вместе со старой таблицей
+CREATE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER exchange_status_sync_insert AFTER INSERT ON ads_exchangeproposal
+    WHEN NEW.status IS NULL OR NEW.status_code IS NULL
+    BEGIN
+        UPDATE ads_exchangeproposal
+        SET status = coalesce(NEW.status, {CODE_TO_KEY}), status_code = coalesce(NEW.status_code, {KEY_TO_CODE})
+        WHERE id = NEW.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER exchange_status_sync_key AFTER UPDATE OF status ON ads_exchangeproposal
+    WHEN NEW.status IS NOT NULL AND NEW.status_code IS NOT {KEY_TO_CODE}
+    BEGIN
+        UPDATE ads_exchangeproposal SET status_code = {KEY_TO_CODE} WHERE id = NEW.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER exchange_status_sync_code AFTER UPDATE OF status_code ON ads_exchangeproposal
+    WHEN NEW.status_code IS NOT NULL AND NEW.status IS NOT {CODE_TO_KEY}
+    BEGIN
+        UPDATE ads_exchangeproposal SET status = {CODE_TO_KEY} WHERE id = NEW.id;
+    END
+    """,
+]
+DROP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS exchange_status_sync_insert",
+    "DROP TRIGGER IF EXISTS exchange_status_sync_key",
+    "DROP TRIGGER IF EXISTS exchange_status_sync_code",
+]
+
+
+def sync_status_codes(apps, schema_editor):
+    # Повторный проход после установки триггеров: догоняет строки, которые старый код изменил
+    # во время миграций 0022-0028. Пакеты по диапазонам id, каждый в своей транзакции
+    alias = schema_editor.connection.alias
+    proposals = apps.get_model("ads", "ExchangeProposal").objects.using(alias)
+    last_id = 0
+    while True:
+        batch_ids = list(proposals.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:BATCH_SIZE])
+        if not batch_ids:
+            break
+        with transaction.atomic(using=alias):
+            batch_queryset = proposals.filter(id__gte=batch_ids[0], id__lte=batch_ids[-1])
+            for i_status, i_code in STATUS_CODES.items():
+                batch_queryset.filter(legacy_status=i_status).exclude(status=i_code).update(status=i_code)
+        last_id = batch_ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('ads', '0028_outbox_soft_deleted_kind'),
+    ]
+
+    # Старый код работает только с основной базой: в шардах триггеры и повторный проход не нужны
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+        migrations.RunPython(sync_status_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-19 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Применяется, когда процессов старой версии не осталось: строковый статус больше никто не читает и не пишет
+    # (README, раздел 12). Удаление столбца пересоздает таблицу, но терять уже нечего
+
+    dependencies = [
+        ('ads', '0029_exchange_status_sync'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [
+                "DROP TRIGGER IF EXISTS exchange_status_sync_insert",
+                "DROP TRIGGER IF EXISTS exchange_status_sync_key",
+                "DROP TRIGGER IF EXISTS exchange_status_sync_code",
+            ],
+            migrations.RunSQL.noop,
+        ),
+        migrations.RemoveField(
+            model_name='exchangeproposal',
+            name='legacy_status',
+        ),
+        migrations.AlterField(
+            model_name='exchangeproposal',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'ожидает'), (1, 'принят'), (2, 'отклонен')], db_column='status_code', default=0, verbose_name='Статус предложения'),
+        ),
+    ]
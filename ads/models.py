@@ -1,39 +1,526 @@
-from django.db import models
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, models, router
+from django.db.models.functions import Greatest, Least
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .images import get_image_proxy_url
+from .shards import atomic, get_pair_shard
+
+POPULARITY_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def get_popularity_weight(moment=None):
+    # Вес просмотра растет вдвое за каждый период полураспада: сумма весов упорядочивает объявления
+    # так же, как затухающий счетчик, но обновляется прибавлением без пересчета старых значений.
+    # Запаса float хватает примерно на 1000 периодов (около 19 лет при периоде в неделю).
+    moment = moment or timezone.now()
+    half_life = settings.AD_POPULARITY_HALF_LIFE_DAYS * 86400
+    return 2 ** ((moment - POPULARITY_EPOCH).total_seconds() / half_life)
+
+
+# Запоминает загруженные из БД значения, чтобы outbox мог записать, что именно изменилось
+class ChangeTrackedModel(models.Model):
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_loaded_values()
+        return instance
+
+    def remember_loaded_values(self):
+        deferred_fields = self.get_deferred_fields()
+        # Генерируемые столбцы вычисляет база, после сохранения Django их не знает до повторной загрузки
+        self._loaded_values = {
+            i_field.attname: getattr(self, i_field.attname)
+            for i_field in self._meta.concrete_fields
+            if i_field.attname not in deferred_fields and not i_field.generated
+        }
+
+    def get_changed_fields(self):
+        loaded_values = getattr(self, "_loaded_values", None)
+        if loaded_values is None:
+            return None
+        return {
+            i_name: (i_old_value, getattr(self, i_name))
+            for i_name, i_old_value in loaded_values.items()
+            if getattr(self, i_name) != i_old_value
+        }
+
+    def save(self, *args, **kwargs):
+        # post_save (и запись в outbox) выполняется внутри той же транзакции, для шарда - вместе с основной базой
+        using = kwargs.get("using") or router.db_for_write(type(self), instance=self)
+        with atomic([DEFAULT_DB_ALIAS, using]):
+            super().save(*args, **kwargs)
+
+
+class VersionConflictError(Exception):
+    pass
+
+
+class VersionedModel(ChangeTrackedModel):
+    # Оптимистическая блокировка: UPDATE проходит, только если версия в строке совпадает с загруженной
+    version = models.PositiveIntegerField(default=0, editable=False, verbose_name="Версия")
+
+    class Meta:
+        abstract = True
+
+    def get_changed_fields(self):
+        changes = super().get_changed_fields()
+        if changes is not None:
+            changes.pop("version", None)
+        return changes
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        version_field = self._meta.get_field("version")
+        expected_version = self.version
+        values = [i_value for i_value in values if i_value[0] is not version_field]
+        values.append((version_field, None, expected_version + 1))
+        updated = super()._do_update(
+            base_qs.filter(version=expected_version), using, pk_val, values, update_fields, forced_update
+        )
+        if updated:
+            self.version = expected_version + 1
+        elif base_qs.filter(pk=pk_val).exists():
+            raise VersionConflictError(f"{self._meta.verbose_name} {pk_val} изменен другим запросом")
+        return updated
+
+
+class ActiveManager(models.Manager):
+    # Помеченные на удаление записи скрыты, пока фоновая задача не удалит их окончательно
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
+class ShardedQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # Шард новой строки выбирает save() по правилу размещения: база менеджера здесь не нужна
+        instance = self.model(**kwargs)
+        instance.save(force_insert=True)
+        return instance
+
+
+# Справочники категорий и состояний: объявления хранят только короткий целочисленный ключ
+class Category(models.Model):
+    id = models.SmallAutoField(primary_key=True)
+    name = models.CharField(max_length=200, unique=True, verbose_name="Название категории")
+
+    def __str__(self):
+        return f"{self.name}"
+
+    class Meta:
+        ordering = ["name"]
+
+
+class Condition(models.Model):
+    id = models.SmallAutoField(primary_key=True)
+    name = models.CharField(max_length=200, unique=True, verbose_name="Название состояния")
+
+    def __str__(self):
+        return f"{self.name}"
+
+    class Meta:
+        ordering = ["name"]
 
 
-class Ad(models.Model):
+class Ad(VersionedModel):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     title = models.CharField(max_length=200, verbose_name="Заголовок объявления")
     description = models.CharField(max_length=500, verbose_name="Описание товара")
     image_url = models.URLField(blank=True, null=True, verbose_name="URL изображения")
-    category = models.CharField(max_length=200, verbose_name="Категория товара")
-    condition = models.CharField(max_length=200, verbose_name="Состояние товара")
+    category = models.ForeignKey(Category, on_delete=models.PROTECT, related_name="ads", verbose_name="Категория товара")
+    condition = models.ForeignKey(Condition, on_delete=models.PROTECT, related_name="ads", verbose_name="Состояние товара")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата публикации")
+    deleted_at = models.DateTimeField(blank=True, null=True, db_index=True, editable=False, verbose_name="Дата удаления")
+    views_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Просмотров")
+    popularity = models.FloatField(default=0, db_index=True, editable=False, verbose_name="Популярность")
+    duplicate_of = models.ForeignKey(
+        "self", on_delete=models.SET_NULL, blank=True, null=True, editable=False, related_name="duplicates",
+        verbose_name="Дубликат объявления",
+    )
+
+    objects = ActiveManager()
+    all_objects = models.Manager()
+
+    COUNTER_FIELDS = {"views_count", "popularity"}
 
     def __str__(self):
         return f"{self.title}"
 
+    def get_image_url(self, size):
+        # Несохраненное объявление (страница подтверждения) показывает изображение по исходному адресу
+        if self._state.adding:
+            return self.image_url
+        return get_image_proxy_url(self.pk, self.image_url, size)
 
-class ExchangeProposal(models.Model):
-    ALLOWED_STATUSES = {"waiting": "ожидает", "accepted": "принят", "rejected": "отклонен"}
+    @property
+    def thumbnail_url(self):
+        return self.get_image_url("small")
 
-    status_choices = tuple(ALLOWED_STATUSES.items())
-    ad_sender = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name="sender", default="", verbose_name="Ваш товар")
-    ad_receiver = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name="receiver", default="", verbose_name="Обменять на")
+    @property
+    def image_proxy_url(self):
+        return self.get_image_url("large")
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # Просмотры и популярность пишет только сброс счетчиков (UPDATE с F()): сохранение строки из формы,
+        # загруженной до сброса, не должно возвращать старые значения
+        values = [i_value for i_value in values if i_value[0].attname not in self.COUNTER_FIELDS]
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and not self.popularity:
+            # Новое объявление стартует с веса одного просмотра, чтобы не оказаться в конце списка
+            self.popularity = get_popularity_weight()
+        super().save(*args, **kwargs)
+
+
+class ExchangeStatus(models.IntegerChoices):
+    # В таблице статус хранится числом, в URL, шаблонах и счетчиках используются строковые ключи
+    WAITING = 0, "ожидает"
+    ACCEPTED = 1, "принят"
+    REJECTED = 2, "отклонен"
+
+
+class ExchangeProposal(VersionedModel):
+    STATUS_CODES = {
+        "waiting": ExchangeStatus.WAITING,
+        "accepted": ExchangeStatus.ACCEPTED,
+        "rejected": ExchangeStatus.REJECTED,
+    }
+    STATUS_KEYS = {i_code: i_key for i_key, i_code in STATUS_CODES.items()}
+    ALLOWED_STATUSES = {i_key: i_code.label for i_key, i_code in STATUS_CODES.items()}
+
+    # Товары лежат в основной базе, предложение - в шарде пары владельцев: внешний ключ без ограничения в БД
+    ad_sender = models.ForeignKey(
+        Ad, on_delete=models.CASCADE, related_name="sender", default="", db_constraint=False, verbose_name="Ваш товар"
+    )
+    ad_receiver = models.ForeignKey(
+        Ad, on_delete=models.CASCADE, related_name="receiver", default="", db_constraint=False, verbose_name="Обменять на"
+    )
+    # Владельцы товаров: по ним выбирается шард и строятся списки без соединения с таблицей товаров
+    sender_user_id = models.BigIntegerField(editable=False, verbose_name="ID отправителя")
+    receiver_user_id = models.BigIntegerField(editable=False, verbose_name="ID получателя")
     comment = models.CharField(max_length=500, verbose_name="Комментарий")
-    status = models.CharField(choices=status_choices, default="waiting", verbose_name="Статус предложения")
+    # Столбец status_code: строковый status удаляется отдельной миграцией после выкладки (README, раздел 12)
+    status = models.PositiveSmallIntegerField(
+        choices=ExchangeStatus.choices, default=ExchangeStatus.WAITING, db_column="status_code",
+        verbose_name="Статус предложения",
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата публикации предложения")
+    closed_at = models.DateTimeField(blank=True, null=True, db_index=True, verbose_name="Дата закрытия предложения")
+    deleted_at = models.DateTimeField(blank=True, null=True, db_index=True, editable=False, verbose_name="Дата удаления")
+    # Пара товаров без учета направления: прямое и встречное предложение попадают в один ключ уникальности
+    pair_low = models.GeneratedField(
+        expression=Least("ad_sender", "ad_receiver"), output_field=models.BigIntegerField(), db_persist=True
+    )
+    pair_high = models.GeneratedField(
+        expression=Greatest("ad_sender", "ad_receiver"), output_field=models.BigIntegerField(), db_persist=True
+    )
+
+    objects = ActiveManager.from_queryset(ShardedQuerySet)()
+    all_objects = models.Manager.from_queryset(ShardedQuerySet)()
 
     def __str__(self):
         return f"{self.ad_sender} - {self.ad_receiver}"
 
+    @staticmethod
+    def get_pair_key(ad_id, other_ad_id):
+        return min(ad_id, other_ad_id), max(ad_id, other_ad_id)
+
     class Meta:
-        unique_together = ("ad_sender", "ad_receiver")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["pair_low", "pair_high"],
+                condition=models.Q(deleted_at__isnull=True),
+                name="exchange_unordered_pair_unique",
+            ),
+        ]
+        indexes = [
+            # Частичные индексы только по ожидающим предложениям: закрытые в них не попадают
+            models.Index(
+                fields=["ad_receiver", "-created_at"],
+                condition=models.Q(status=ExchangeStatus.WAITING),
+                name="exchange_waiting_receiver_idx",
+            ),
+            models.Index(
+                fields=["ad_sender", "-created_at"],
+                condition=models.Q(status=ExchangeStatus.WAITING),
+                name="exchange_waiting_sender_idx",
+            ),
+            models.Index(fields=["receiver_user_id", "-created_at"], name="exchange_receiver_user_idx"),
+            models.Index(fields=["sender_user_id", "-created_at"], name="exchange_sender_user_idx"),
+        ]
+
+    def set_user_ids(self):
+        # Владелец берется из загруженного товара; без него остается id, переданный при создании
+        for i_ad_field, i_user_field in [("ad_sender", "sender_user_id"), ("ad_receiver", "receiver_user_id")]:
+            if self._meta.get_field(i_ad_field).is_cached(self) or getattr(self, i_user_field) is None:
+                setattr(self, i_user_field, getattr(self, i_ad_field).user_id)
+
+    def save(self, *args, **kwargs):
+        self.set_user_ids()
+        # Шард задается правилом размещения, а не менеджером: objects.create() передает основную базу
+        shard = get_pair_shard(self.sender_user_id, self.receiver_user_id)
+        kwargs["using"] = shard
+        old_shard = self._state.db
+        if self._state.adding or old_shard in (None, shard):
+            return super().save(*args, **kwargs)
+        # Предложение перенаправили на товар другого владельца: строка переезжает в шард новой пары с тем же id,
+        # затем сохраняется обычным UPDATE с проверкой версии и записью изменений в outbox
+        with atomic([DEFAULT_DB_ALIAS, old_shard, shard]):
+            row = type(self).all_objects.using(old_shard).get(pk=self.pk)
+            type(self).all_objects.using(old_shard).filter(pk=self.pk)._raw_delete(old_shard)
+            type(self).all_objects.using(shard).bulk_create([row])
+            try:
+                self._state.db = shard
+                super().save(*args, **kwargs)
+            except Exception:
+                self._state.db = old_shard
+                raise
+
+    @property
+    def status_key(self):
+        return self.STATUS_KEYS[self.status]
 
     def set_status(self, new_status):
-        if new_status in self.ALLOWED_STATUSES:
-            self.status = new_status
+        if new_status in self.STATUS_CODES:
+            self.status = self.STATUS_CODES[new_status]
+            self.closed_at = None if new_status == "waiting" else timezone.now()
             self.save()
         else:
-            raise ValueError("Недопустимый статус")
\ No newline at end of file
+            raise ValueError("Недопустимый статус")
+
+
+class AdTerm(models.Model):
+    # Обратный индекс поиска: нормализованные основы слов заголовка, описания и категории
+    ad = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name="terms")
+    term = models.CharField(max_length=100)
+
+    def __str__(self):
+        return f"{self.term}: {self.ad_id}"
+
+    class Meta:
+        unique_together = ("term", "ad")
+
+
+class SavedSearch(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="saved_searches")
+    search = models.CharField(max_length=200, blank=True, verbose_name="Ключевые слова")
+    category = models.ForeignKey(
+        Category, on_delete=models.CASCADE, blank=True, null=True, related_name="+", verbose_name="Категория товара"
+    )
+    condition = models.ForeignKey(
+        Condition, on_delete=models.CASCADE, blank=True, null=True, related_name="+", verbose_name="Состояние товара"
+    )
+    # Ключ обратного индекса: одно обязательное условие поиска, по нему новое объявление находит кандидатов
+    index_key = models.CharField(max_length=250, db_index=True, editable=False, verbose_name="Ключ индекса")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    def __str__(self):
+        return " / ".join(str(i_part) for i_part in (self.search, self.category, self.condition) if i_part)
+
+
+class SavedSearchMatch(models.Model):
+    saved_search = models.ForeignKey(SavedSearch, on_delete=models.CASCADE, related_name="matches")
+    ad = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name="saved_search_matches")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата совпадения")
+
+    def __str__(self):
+        return f"{self.saved_search} - {self.ad}"
+
+    class Meta:
+        unique_together = ("saved_search", "ad")
+
+
+class SimilarAd(models.Model):
+    # Заранее посчитанные ближайшие соседи объявления, обновляются фоновой задачей и командой build_similar_ads
+    ad = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name="similar_ads")
+    similar = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField(verbose_name="Сходство")
+    rank = models.PositiveSmallIntegerField(verbose_name="Место")
+
+    def __str__(self):
+        return f"{self.ad_id} -> {self.similar_id}"
+
+    class Meta:
+        unique_together = ("ad", "rank")
+
+
+class AdSignature(models.Model):
+    # MinHash-подпись заголовка и описания, по ней оценивается сходство кандидатов из AdBucket
+    ad = models.OneToOneField(Ad, on_delete=models.CASCADE, primary_key=True, related_name="signature")
+    signature = models.BinaryField()
+
+    def __str__(self):
+        return f"{self.ad_id}"
+
+
+class AdBucket(models.Model):
+    # Корзины LSH: объявления с общей корзиной считаются кандидатами в дубликаты
+    ad = models.ForeignKey(Ad, on_delete=models.CASCADE, related_name="buckets")
+    key = models.BigIntegerField(db_index=True)
+
+    def __str__(self):
+        return f"{self.ad_id}: {self.key}"
+
+
+class SuggestTerm(models.Model):
+    # Частоты для подсказок поиска, из них собирается снимок префиксного индекса (manage.py build_suggestions)
+    KINDS = {"term": "слово заголовка", "category": "категория"}
+
+    kind = models.CharField(max_length=20, choices=KINDS, verbose_name="Тип")
+    key = models.CharField(max_length=400, verbose_name="Ключ")
+    weight = models.IntegerField(default=0, verbose_name="Количество объявлений")
+
+    def __str__(self):
+        return f"{self.kind}: {self.key}"
+
+    class Meta:
+        unique_together = ("kind", "key")
+
+
+class UserSummary(models.Model):
+    # Счетчики для бейджей и флагов, обновляются в той же транзакции, что и объявления/предложения
+    COUNTER_FIELDS = [
+        "ads_count",
+        "incoming_waiting",
+        "incoming_accepted",
+        "incoming_rejected",
+        "outgoing_waiting",
+        "outgoing_accepted",
+        "outgoing_rejected",
+    ]
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="ads_summary")
+    ads_count = models.IntegerField(default=0, verbose_name="Объявлений")
+    incoming_waiting = models.IntegerField(default=0, verbose_name="Входящих ожидают")
+    incoming_accepted = models.IntegerField(default=0, verbose_name="Входящих принято")
+    incoming_rejected = models.IntegerField(default=0, verbose_name="Входящих отклонено")
+    outgoing_waiting = models.IntegerField(default=0, verbose_name="Исходящих ожидают")
+    outgoing_accepted = models.IntegerField(default=0, verbose_name="Исходящих принято")
+    outgoing_rejected = models.IntegerField(default=0, verbose_name="Исходящих отклонено")
+
+    def __str__(self):
+        return f"{self.user}"
+
+
+class ArchivedExchangeProposal(models.Model):
+    # Закрытые предложения переносятся сюда из горячей таблицы вместе со снимком названий товаров
+    id = models.BigIntegerField(primary_key=True, verbose_name="ID предложения")
+    ad_sender_id = models.BigIntegerField(verbose_name="ID товара отправителя")
+    ad_receiver_id = models.BigIntegerField(verbose_name="ID товара получателя")
+    ad_sender_title = models.CharField(max_length=200, verbose_name="Ваш товар")
+    ad_receiver_title = models.CharField(max_length=200, verbose_name="Обменять на")
+    sender_user_id = models.BigIntegerField(db_index=True, verbose_name="ID отправителя")
+    receiver_user_id = models.BigIntegerField(db_index=True, verbose_name="ID получателя")
+    comment = models.CharField(max_length=500, verbose_name="Комментарий")
+    status = models.PositiveSmallIntegerField(choices=ExchangeStatus.choices, verbose_name="Статус предложения")
+    created_at = models.DateTimeField(verbose_name="Дата публикации предложения")
+    closed_at = models.DateTimeField(verbose_name="Дата закрытия предложения")
+    archived_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата переноса в архив")
+
+    def __str__(self):
+        return f"{self.ad_sender_title} - {self.ad_receiver_title}"
+
+
+class OutboxEvent(models.Model):
+    KINDS = {
+        "created": "создание",
+        "updated": "изменение",
+        "status": "смена статуса",
+        "deleted": "удаление",
+        "soft_deleted": "мягкое удаление",
+        "archived": "перенос в архив",
+    }
+
+    # На SQLite BigAutoField создается с AUTOINCREMENT: номера событий только растут и не переиспользуются
+    id = models.BigAutoField(primary_key=True, verbose_name="Номер события")
+    model = models.CharField(max_length=100, verbose_name="Модель")
+    object_id = models.BigIntegerField(verbose_name="ID объекта")
+    kind = models.CharField(max_length=20, choices=tuple(KINDS.items()), verbose_name="Тип изменения")
+    payload = models.JSONField(encoder=DjangoJSONEncoder, default=dict, verbose_name="Данные")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="Дата события")
+
+    def __str__(self):
+        return f"{self.id}: {self.model} {self.object_id} {self.kind}"
+
+    class Meta:
+        indexes = [models.Index(fields=["model", "object_id"])]
+
+
+class OutboxCursor(models.Model):
+    name = models.CharField(max_length=100, primary_key=True, verbose_name="Потребитель")
+    position = models.BigIntegerField(default=0, verbose_name="Последнее обработанное событие")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+
+class RollupPeriod(models.TextChoices):
+    HOUR = "hour", "час"
+    DAY = "day", "сутки"
+
+
+class AdRollup(models.Model):
+    # Сводки считает задача по событиям outbox, панель в админке читает только их, а не таблицы объявлений
+    period = models.CharField(max_length=10, choices=RollupPeriod.choices, verbose_name="Период")
+    start = models.DateTimeField(verbose_name="Начало периода")
+    category_id = models.PositiveSmallIntegerField(verbose_name="ID категории")
+    ads_created = models.PositiveIntegerField(default=0, verbose_name="Новых объявлений")
+
+    def __str__(self):
+        return f"{self.period} {self.start}: {self.category_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["period", "start", "category_id"], name="ad_rollup_unique"),
+        ]
+
+
+class ExchangeRollup(models.Model):
+    period = models.CharField(max_length=10, choices=RollupPeriod.choices, verbose_name="Период")
+    start = models.DateTimeField(verbose_name="Начало периода")
+    proposals_created = models.PositiveIntegerField(default=0, verbose_name="Создано предложений")
+    proposals_accepted = models.PositiveIntegerField(default=0, verbose_name="Принято")
+    proposals_rejected = models.PositiveIntegerField(default=0, verbose_name="Отклонено")
+    # Гистограмма времени до принятия по логарифмическим корзинам: {номер корзины: число предложений}.
+    # Гистограммы складываются, поэтому медиану можно получить за любой набор периодов
+    accept_histogram = models.JSONField(default=dict, verbose_name="Время до принятия")
+
+    def __str__(self):
+        return f"{self.period} {self.start}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["period", "start"], name="exchange_rollup_unique"),
+        ]
+
+
+class Task(models.Model):
+    ALLOWED_STATUSES = {"queued": "в очереди", "running": "выполняется", "done": "выполнена", "failed": "ошибка"}
+
+    status_choices = tuple(ALLOWED_STATUSES.items())
+    name = models.CharField(max_length=200, verbose_name="Задача")
+    payload = models.JSONField(encoder=DjangoJSONEncoder, default=dict, verbose_name="Параметры")
+    status = models.CharField(max_length=20, choices=status_choices, default="queued", verbose_name="Статус задачи")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Попыток")
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name="Максимум попыток")
+    run_at = models.DateTimeField(default=timezone.now, verbose_name="Запустить после")
+    locked_by = models.CharField(max_length=200, blank=True, default="", verbose_name="Обработчик")
+    locked_until = models.DateTimeField(blank=True, null=True, verbose_name="Аренда до")
+    last_error = models.TextField(blank=True, default="", verbose_name="Последняя ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата постановки")
+    started_at = models.DateTimeField(blank=True, null=True, verbose_name="Дата запуска")
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name="Дата завершения")
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_at"])]
@@ -0,0 +1,178 @@
+import asyncio
+import json
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Max
+
+from .models import Ad, ExchangeProposal, OutboxEvent
+from .outbox import changes_since
+
+# Очередь сообщений одного соединения; медленный клиент теряет лишнее и досылает его по Last-Event-ID
+QUEUE_SIZE = 100
+RETRY_MILLISECONDS = 3000
+REPLAY_BATCH_SIZE = 500
+# Досылаются только последние REPLAY_WINDOW событий outbox: с более старого id клиент получает reset
+REPLAY_WINDOW = 5000
+# Правка предложения без смены статуса, о которой стоит сообщить получателю
+EDITED_FIELDS = {"comment", "ad_sender_id"}
+
+json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def format_event(event_id, name, data):
+    return f"id: {event_id}\nevent: {name}\ndata: {json_encoder.encode(data)}\n\n"
+
+
+def get_event_message(event, owners):
+    # Получателю приходят новые, повторные и измененные предложения, отправителю - ответ на его предложение.
+    # Предложение, перенаправленное на другой товар, для нового получателя - новое
+    fields = event.payload.get("fields", {})
+    changes = event.payload.get("changes", {})
+    status = ExchangeProposal.STATUS_KEYS.get(fields.get("status"))
+    if event.kind == "created" or (event.kind == "status" and status == "waiting"):
+        name, user_id = "incoming", owners.get(fields.get("ad_receiver_id"))
+    elif event.kind == "status":
+        name, user_id = "status", owners.get(fields.get("ad_sender_id"))
+    elif event.kind == "updated" and "ad_receiver_id" in changes:
+        name, user_id = "incoming", owners.get(fields.get("ad_receiver_id"))
+    elif event.kind == "updated" and EDITED_FIELDS & set(changes):
+        name, user_id = "updated", owners.get(fields.get("ad_receiver_id"))
+    else:
+        return None
+    if user_id is None:
+        return None
+    data = {
+        "exchange_id": event.object_id,
+        "status": status,
+        "ad_sender_id": fields.get("ad_sender_id"),
+        "ad_receiver_id": fields.get("ad_receiver_id"),
+    }
+    return user_id, event.id, format_event(event.id, name, data)
+
+
+def get_proposal_messages(position, limit=500, user_id=None):
+    # Пачка событий outbox и владельцы товаров из нее - два запроса на все соединения процесса
+    events = changes_since(position, limit=limit, models=[ExchangeProposal._meta.model_name])
+    if not events:
+        return position, []
+    ad_ids = set()
+    for i_event in events:
+        fields = i_event.payload.get("fields", {})
+        ad_ids.update([fields.get("ad_sender_id"), fields.get("ad_receiver_id")])
+    owners = dict(Ad.all_objects.filter(id__in=ad_ids).values_list("id", "user_id"))
+    messages = []
+    for i_event in events:
+        message = get_event_message(i_event, owners)
+        if message is not None and (user_id is None or message[0] == user_id):
+            messages.append(message)
+    return events[-1].id, messages
+
+
+def get_outbox_position():
+    return OutboxEvent.objects.aggregate(position=Max("id"))["position"] or 0
+
+
+class NotificationBroker:
+    # Подписки процесса: соединения ждут в своих очередях, outbox читает одна задача на весь процесс
+    def __init__(self):
+        self.loop = None
+        self.subscribers = defaultdict(set)
+        self.wakeup = None
+        self.tailer = None
+        self.tail_started = None
+
+    def subscribe(self, user_id):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # Новый цикл событий (перезапуск сервера, тесты): прежние очереди и задача к нему не относятся
+            self.loop, self.subscribers, self.wakeup, self.tailer = loop, defaultdict(set), asyncio.Event(), None
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.subscribers[user_id].add(queue)
+        if self.tailer is None:
+            self.tail_started = asyncio.Event()
+            self.tailer = loop.create_task(self.tail())
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+        if not self.subscribers and self.tailer is not None:
+            self.tailer.cancel()
+            self.tailer = None
+
+    def publish(self, user_id, message):
+        for i_queue in self.subscribers.get(user_id, ()):
+            if not i_queue.full():
+                i_queue.put_nowait(message)
+
+    def wake(self):
+        # Вызывается после коммита из любого потока процесса: outbox читается сразу, не дожидаясь интервала
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def tail(self):
+        # Записи других процессов (gunicorn, обработчик задач) приходят через outbox не позже интервала опроса
+        position = await sync_to_async(get_outbox_position)()
+        self.tail_started.set()
+        while True:
+            self.wakeup.clear()
+            new_position, messages = await sync_to_async(get_proposal_messages)(position)
+            for i_user_id, i_event_id, i_text in messages:
+                self.publish(i_user_id, (i_event_id, i_text))
+            if new_position == position:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), settings.EXCHANGE_EVENTS_POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+            position = new_position
+
+
+broker = NotificationBroker()
+
+
+async def stream_events(user_id, last_event_id=None):
+    queue = broker.subscribe(user_id)
+    try:
+        # Событие, записанное после ответа с retry, уже попадет в очередь: позиция outbox к этому моменту прочитана
+        await broker.tail_started.wait()
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        last_sent_id = 0
+        if last_event_id is not None:
+            end_position = await sync_to_async(get_outbox_position)()
+            if not end_position - REPLAY_WINDOW <= last_event_id <= end_position:
+                # Пропущено слишком много (или id не из этого outbox): клиент перечитывает список целиком,
+                # следующее переподключение начнется с текущей позиции
+                last_sent_id = end_position
+                yield format_event(end_position, "reset", {})
+            else:
+                # Пропущенное за время переподключения досылается из outbox пачками до позиции на момент
+                # подключения, более новые события уже в очереди
+                last_sent_id = position = last_event_id
+                while position < end_position:
+                    new_position, missed = await sync_to_async(get_proposal_messages)(
+                        position, limit=REPLAY_BATCH_SIZE, user_id=user_id
+                    )
+                    for _, i_event_id, i_text in missed:
+                        last_sent_id = i_event_id
+                        yield i_text
+                    if new_position == position:
+                        break
+                    position = new_position
+        while True:
+            try:
+                event_id, text = await asyncio.wait_for(queue.get(), settings.EXCHANGE_EVENTS_KEEPALIVE)
+            except TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            # Событие могло попасть и в очередь, и в досылку: второй раз оно не отправляется
+            if event_id > last_sent_id:
+                last_sent_id = event_id
+                yield text
+    finally:
+        broker.unsubscribe(user_id, queue)
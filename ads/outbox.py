@@ -0,0 +1,79 @@
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import OutboxCursor, OutboxEvent
+
+# Тип события для удалений: архивирование удаляет строки, но потребителям это не удаление
+deletion_kind = ContextVar("deletion_kind", default="deleted")
+
+
+def get_model_label(model):
+    return model._meta.model_name
+
+
+def serialize_instance(instance):
+    return {
+        i_field.attname: i_field.value_from_object(instance)
+        for i_field in instance._meta.concrete_fields
+        if not i_field.generated
+    }
+
+
+def build_event(instance, kind, changes=None):
+    payload = {"fields": serialize_instance(instance)}
+    if changes:
+        payload["changes"] = {i_name: list(i_values) for i_name, i_values in changes.items()}
+    return OutboxEvent(model=get_model_label(type(instance)), object_id=instance.pk, kind=kind, payload=payload)
+
+
+def record_change(instance, kind, changes=None):
+    event = build_event(instance, kind, changes)
+    event.save()
+    return event
+
+
+def record_changes(instances, kind, using="default"):
+    return OutboxEvent.objects.using(using).bulk_create([build_event(i_instance, kind) for i_instance in instances])
+
+
+def changes_since(position=0, limit=500, models=None):
+    events_queryset = OutboxEvent.objects.filter(id__gt=position)
+    if models:
+        events_queryset = events_queryset.filter(model__in=models)
+    return list(events_queryset.order_by("id")[:limit])
+
+
+def iter_change_batches(position=0, batch_size=500, models=None):
+    while True:
+        batch = changes_since(position, limit=batch_size, models=models)
+        if not batch:
+            return
+        yield batch
+        position = batch[-1].id
+
+
+def get_cursor(name):
+    cursor, _ = OutboxCursor.objects.get_or_create(name=name)
+    return cursor.position
+
+
+def save_cursor(name, position):
+    OutboxCursor.objects.update_or_create(name=name, defaults={"position": position})
+
+
+def compact_outbox(retention_days=7, batch_size=1000):
+    # Удаляются только события старше срока хранения, уже прочитанные всеми зарегистрированными потребителями
+    events_queryset = OutboxEvent.objects.filter(created_at__lt=timezone.now() - timedelta(days=retention_days))
+    min_position = OutboxCursor.objects.aggregate(min_position=Min("position"))["min_position"]
+    if min_position is not None:
+        events_queryset = events_queryset.filter(id__lte=min_position)
+
+    deleted_total = 0
+    while True:
+        batch_ids = list(events_queryset.order_by("id").values_list("id", flat=True)[:batch_size])
+        if not batch_ids:
+            return deleted_total
+        deleted_total += OutboxEvent.objects.filter(id__in=batch_ids).delete()[0]
@@ -0,0 +1,43 @@
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from .models import Ad
+
+OWN_ADS_CACHE_TIMEOUT = 60 * 60
+
+
+def get_own_ads_cache_key(user_id):
+    return f"own_ads:{user_id}"
+
+
+def is_cache_shared():
+    # Сброс кеша в памяти одного процесса не дойдет до остальных (gunicorn, обработчик задач)
+    return not isinstance(caches["default"], LocMemCache)
+
+
+def load_own_ads(user_id):
+    return list(Ad.objects.filter(user_id=user_id).order_by("id").values_list("id", "title"))
+
+
+def get_own_ads(user_id):
+    # Компактный список (id, заголовок) активных объявлений пользователя для выбора товара в предложении обмена
+    if user_id is None:
+        return []
+    if not is_cache_shared():
+        return load_own_ads(user_id)
+    cache_key = get_own_ads_cache_key(user_id)
+    own_ads = cache.get(cache_key)
+    if own_ads is None:
+        own_ads = load_own_ads(user_id)
+        cache.set(cache_key, own_ads, OWN_ADS_CACHE_TIMEOUT)
+    return own_ads
+
+
+def invalidate_own_ads(*user_ids):
+    # Сброс сразу и повторно после коммита: иначе параллельный запрос успеет закешировать старый список
+    cache_keys = [get_own_ads_cache_key(i_user_id) for i_user_id in user_ids if i_user_id is not None]
+    if not cache_keys:
+        return
+    cache.delete_many(cache_keys)
+    transaction.on_commit(lambda: cache.delete_many(cache_keys))
@@ -0,0 +1,51 @@
+from .models import Ad, SavedSearch, SavedSearchMatch
+from .search import get_ad_index_terms, get_query_terms, get_search_index_key, match_query_terms
+from .tasks import task
+from .text import get_term_index_keys
+
+
+def get_filter_key(name, value):
+    return f"{name}:{value}"
+
+
+def get_index_key(saved_search):
+    search_key = get_search_index_key(saved_search.search)
+    if search_key:
+        return search_key
+    if saved_search.category_id:
+        return get_filter_key("category", saved_search.category_id)
+    return get_filter_key("condition", saved_search.condition_id)
+
+
+def get_ad_terms(ad):
+    # Слова объявления те же, что в поисковом индексе AdTerm
+    return get_ad_index_terms(ad.title, ad.description, ad.category.name)
+
+
+def is_match(saved_search, ad, ad_terms):
+    if saved_search.category_id and saved_search.category_id != ad.category_id:
+        return False
+    if saved_search.condition_id and saved_search.condition_id != ad.condition_id:
+        return False
+    return match_query_terms(get_query_terms(saved_search.search), ad_terms)
+
+
+def percolate(ad):
+    ad_terms = get_ad_terms(ad)
+    index_keys = {i_key for i_term in ad_terms for i_key in get_term_index_keys(i_term)}
+    index_keys |= {get_filter_key("category", ad.category_id), get_filter_key("condition", ad.condition_id)}
+    candidates = SavedSearch.objects.filter(index_key__in=index_keys).exclude(user_id=ad.user_id)
+    matches = [
+        SavedSearchMatch(saved_search=i_saved_search, ad=ad)
+        for i_saved_search in candidates
+        if is_match(i_saved_search, ad, ad_terms)
+    ]
+    SavedSearchMatch.objects.bulk_create(matches, ignore_conflicts=True)
+    return matches
+
+
+@task("percolate_ad")
+def percolate_ad(ad_id):
+    ad = Ad.objects.select_related("category").filter(pk=ad_id).first()
+    if ad is not None:
+        percolate(ad)
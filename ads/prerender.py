@@ -0,0 +1,167 @@
+import math
+import os
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db.models import Max, Q
+from django.http import HttpRequest, QueryDict
+from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode
+
+from .filters import get_catalogue_ads
+from .models import Ad, Category, OutboxEvent, SimilarAd
+from .outbox import get_cursor, iter_change_batches, save_cursor
+from .views import AdDetailView, AllAddsView
+
+PRERENDER_CURSOR = "prerender"
+# Поля, которые видны на страницах каталога и объявления; просмотры и популярность страницы не меняют
+PAGE_FIELDS = {"title", "description", "image_url", "category_id", "condition_id", "deleted_at", "duplicate_of_id"}
+# Изменения, после которых объявление появляется в списке, пропадает из него или переходит в другой
+MEMBERSHIP_FIELDS = {"category_id", "deleted_at", "duplicate_of_id"}
+ALL_PAGES = 0
+
+catalogue_view = AllAddsView.as_view()
+detail_view = AdDetailView.as_view(count_view=False)
+
+
+def get_listing_dir(category_id):
+    listing_dir = Path(settings.PRERENDER_DIR) / "ads"
+    return listing_dir if category_id is None else listing_dir / f"category-{category_id}"
+
+
+def get_listing_path(category_id, page):
+    # Имена совпадают с map $args в nginx: ?page=N&category=C -> ads/category-C/page-N.html
+    return get_listing_dir(category_id) / f"page-{page}.html"
+
+
+def get_detail_path(ad_id):
+    return Path(settings.PRERENDER_DIR) / "ads" / str(ad_id) / "index.html"
+
+
+def render_page(view, path, params=None, **kwargs):
+    # Страница собирается тем же представлением, что и для анонимного посетителя, без middleware
+    request = HttpRequest()
+    request.method = "GET"
+    request.path = request.path_info = path
+    request.GET = QueryDict(urlencode(params or {}))
+    request.user = AnonymousUser()
+    response = view(request, **kwargs)
+    return response.render().content
+
+
+def write_page(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as page_file:
+        page_file.write(content)
+    os.chmod(page_file.name, 0o644)
+    os.replace(page_file.name, path)
+
+
+def get_listing_ads(category_id):
+    ads_queryset = get_catalogue_ads()
+    if category_id is not None:
+        ads_queryset = ads_queryset.filter(category_id=category_id)
+    return ads_queryset
+
+
+def get_page_count(category_id):
+    # Пустой список тоже отрисовывается: на первой странице сообщение, что вещей нет
+    pages = math.ceil(get_listing_ads(category_id).count() / AllAddsView.paginate_by)
+    return max(1, min(pages, settings.PRERENDER_MAX_PAGES))
+
+
+def get_ad_page(category_id, created_at, ad_id):
+    # Каталог по умолчанию отсортирован по дате: страница объявления - число более новых перед ним
+    newer = get_listing_ads(category_id).filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=ad_id))
+    return newer.count() // AllAddsView.paginate_by + 1
+
+
+def render_listing(category_id, pages):
+    page_count = get_page_count(category_id)
+    if ALL_PAGES in pages:
+        pages = range(1, page_count + 1)
+        # Страницы за новым концом списка больше не существуют
+        for i_path in get_listing_dir(category_id).glob("page-*.html"):
+            if int(i_path.stem.removeprefix("page-")) > page_count:
+                i_path.unlink(missing_ok=True)
+    params = {} if category_id is None else {"category": category_id}
+    rendered = 0
+    for i_page in sorted(pages):
+        if i_page > page_count:
+            continue
+        content = render_page(catalogue_view, reverse("ads:ads"), {**params, "page": i_page})
+        write_page(get_listing_path(category_id, i_page), content)
+        rendered += 1
+    return rendered
+
+
+def render_details(ad_ids):
+    visible_ids = set(Ad.objects.filter(id__in=ad_ids).values_list("id", flat=True))
+    for i_ad_id in ad_ids:
+        if i_ad_id in visible_ids:
+            content = render_page(detail_view, reverse("ads:ad_detail", kwargs={"pk": i_ad_id}), pk=i_ad_id)
+            write_page(get_detail_path(i_ad_id), content)
+        else:
+            # Удаленное объявление снова отдает Django (404)
+            get_detail_path(i_ad_id).unlink(missing_ok=True)
+    return len(visible_ids)
+
+
+def collect_event(event, detail_ids, listings):
+    fields = event.payload.get("fields", {})
+    changes = event.payload.get("changes", {})
+    if event.kind == "updated" and not PAGE_FIELDS & set(changes):
+        return
+    detail_ids.add(event.object_id)
+    category_ids = {fields.get("category_id")}
+    if "category_id" in changes:
+        category_ids.add(changes["category_id"][0])
+    for i_listing in [None, *category_ids]:
+        if event.kind != "updated" or MEMBERSHIP_FIELDS & set(changes):
+            # Объявление добавилось или пропало: страницы после него сдвинулись
+            listings[i_listing].add(ALL_PAGES)
+        else:
+            created_at = parse_datetime(fields["created_at"])
+            listings[i_listing].add(get_ad_page(i_listing, created_at, event.object_id))
+
+
+def render_changes(events):
+    detail_ids = set()
+    listings = defaultdict(set)
+    for i_event in events:
+        collect_event(i_event, detail_ids, listings)
+    # В блоке «Можно обменять на» у соседей показан заголовок измененного объявления
+    detail_ids.update(SimilarAd.objects.filter(similar_id__in=detail_ids).values_list("ad_id", flat=True))
+    rendered = render_details(detail_ids)
+    for i_listing, i_pages in listings.items():
+        rendered += render_listing(i_listing, i_pages)
+    return rendered
+
+
+def update_prerendered(batch_size=500):
+    # Перерисовываются только страницы, которых касаются новые события outbox по объявлениям
+    if not get_listing_path(None, 1).exists():
+        return prerender_all()
+    rendered = 0
+    for i_batch in iter_change_batches(get_cursor(PRERENDER_CURSOR), batch_size, models=[Ad._meta.model_name]):
+        rendered += render_changes(i_batch)
+        save_cursor(PRERENDER_CURSOR, i_batch[-1].id)
+    return rendered
+
+
+def prerender_all():
+    position = OutboxEvent.objects.aggregate(position=Max("id"))["position"] or 0
+    rendered = 0
+    for i_listing in [None, *Category.objects.values_list("id", flat=True)]:
+        rendered += render_listing(i_listing, {ALL_PAGES})
+    ad_ids = set(Ad.objects.values_list("id", flat=True))
+    stale_ids = {
+        int(i_path.name) for i_path in (Path(settings.PRERENDER_DIR) / "ads").glob("*/") if i_path.name.isdigit()
+    }
+    rendered += render_details(ad_ids | stale_ids)
+    save_cursor(PRERENDER_CURSOR, position)
+    return rendered
@@ -0,0 +1,111 @@
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Ad, ExchangeProposal
+from .outbox import record_changes
+from .own_ads import invalidate_own_ads
+from .shards import atomic, get_shard_aliases
+from .summary import apply_summary_deltas, get_soft_delete_deltas
+from .tasks import enqueue, task
+
+PURGE_BATCH_SIZE = 500
+
+
+def get_ads_proposals(ads_queryset):
+    # В основной базе товары выбираются подзапросом, в других шардах таблицы товаров нет - там список id
+    aliases = get_shard_aliases()
+    ad_ids = list(ads_queryset.values_list("id", flat=True)) if len(aliases) > 1 else None
+    proposals_querysets = []
+    for i_alias in aliases:
+        i_ads = ads_queryset if i_alias == DEFAULT_DB_ALIAS else ad_ids
+        proposals_querysets.append(
+            ExchangeProposal.all_objects.using(i_alias).filter(Q(ad_sender__in=i_ads) | Q(ad_receiver__in=i_ads))
+        )
+    return proposals_querysets
+
+
+def soft_delete_batches(queryset, now, batch_size):
+    # Пакеты по возрастанию id: в памяти не больше batch_size строк. Помеченные строки выпадают из queryset,
+    # поэтому каждый следующий пакет начинается с первой непомеченной
+    deleted = 0
+    while True:
+        batch = list(queryset.order_by("id")[:batch_size])
+        if not batch:
+            return deleted
+        queryset.model.all_objects.using(queryset.db).filter(pk__in=[i_instance.pk for i_instance in batch]).update(
+            deleted_at=now
+        )
+        for i_instance in batch:
+            i_instance.deleted_at = now
+        # UPDATE не вызывает сигналы: события outbox пишутся явно, в той же транзакции
+        record_changes(batch, "soft_deleted")
+        deleted += len(batch)
+
+
+def soft_delete_ads(ads_queryset, batch_size=PURGE_BATCH_SIZE):
+    # UPDATE вместо каскада в памяти: данные сразу скрыты, удаление продолжит фоновая задача
+    now = timezone.now()
+    ads_queryset = ads_queryset.filter(deleted_at__isnull=True)
+    proposals_querysets = [
+        i_queryset.filter(deleted_at__isnull=True) for i_queryset in get_ads_proposals(ads_queryset)
+    ]
+    summary_deltas = get_soft_delete_deltas(ads_queryset, proposals_querysets)
+    # Предложения помечаются до объявлений: в основной базе они выбираются подзапросом по непомеченным объявлениям
+    for i_queryset in proposals_querysets:
+        soft_delete_batches(i_queryset, now, batch_size)
+    deleted = soft_delete_batches(ads_queryset, now, batch_size)
+    apply_summary_deltas(summary_deltas)
+    invalidate_own_ads(*[i_user_id for i_user_id, i_fields in summary_deltas.items() if i_fields["ads_count"]])
+    return deleted
+
+
+def soft_delete_ad(ad):
+    with atomic(get_shard_aliases()):
+        soft_delete_ads(Ad.all_objects.filter(pk=ad.pk))
+        enqueue("purge_ad", ad_id=ad.pk)
+
+
+def soft_delete_user(user):
+    with atomic(get_shard_aliases()):
+        user.is_active = False
+        user.save(update_fields=["is_active"])
+        soft_delete_ads(Ad.all_objects.filter(user=user))
+        enqueue("purge_user", user_id=user.pk)
+
+
+def delete_batch(queryset, batch_size):
+    batch_ids = list(queryset.values_list("id", flat=True)[:batch_size])
+    if batch_ids:
+        queryset.model.all_objects.using(queryset.db).filter(pk__in=batch_ids).delete()
+    return len(batch_ids)
+
+
+def purge_ads_batch(ads_queryset, batch_size=PURGE_BATCH_SIZE):
+    # Сначала предложения обмена во всех шардах, затем сами объявления: каскад каждого пакета остается пустым
+    deleted = 0
+    for i_queryset in get_ads_proposals(ads_queryset):
+        if deleted < batch_size:
+            deleted += delete_batch(i_queryset, batch_size - deleted)
+    if deleted < batch_size:
+        deleted += delete_batch(ads_queryset, batch_size - deleted)
+    return deleted
+
+
+@task("purge_ad")
+def purge_ad(ad_id, batch_size=PURGE_BATCH_SIZE):
+    ads_queryset = Ad.all_objects.filter(pk=ad_id, deleted_at__isnull=False)
+    with atomic(get_shard_aliases()):
+        if purge_ads_batch(ads_queryset, batch_size) == batch_size:
+            enqueue("purge_ad", ad_id=ad_id, batch_size=batch_size)
+
+
+@task("purge_user")
+def purge_user(user_id, batch_size=PURGE_BATCH_SIZE):
+    ads_queryset = Ad.all_objects.filter(user_id=user_id, deleted_at__isnull=False)
+    with atomic(get_shard_aliases()):
+        if purge_ads_batch(ads_queryset, batch_size) == batch_size:
+            enqueue("purge_user", user_id=user_id, batch_size=batch_size)
+        elif not Ad.all_objects.filter(user_id=user_id).exists():
+            User.objects.filter(pk=user_id).delete()
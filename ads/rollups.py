@@ -0,0 +1,208 @@
+import math
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Ad, AdRollup, Category, ExchangeProposal, ExchangeRollup, ExchangeStatus, RollupPeriod
+from .outbox import get_cursor, iter_change_batches, save_cursor
+
+ROLLUPS_CURSOR = "rollups"
+# Корзины времени до принятия: первая - меньше минуты, дальше каждая в 2 ** (1/4) раза шире предыдущей.
+# 100 корзин покрывают больше 30 лет, медиана внутри корзины ошибается не больше чем на 19%
+HISTOGRAM_BASE = 60
+HISTOGRAM_STEPS_PER_DOUBLING = 4
+STATUS_COUNTERS = {ExchangeStatus.ACCEPTED: "proposals_accepted", ExchangeStatus.REJECTED: "proposals_rejected"}
+EXCHANGE_COUNTERS = ["proposals_created", "proposals_accepted", "proposals_rejected"]
+
+
+def get_period_start(moment, period):
+    moment = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    if period == RollupPeriod.DAY:
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def get_period_starts(moment):
+    return [(i_period, get_period_start(moment, i_period)) for i_period in RollupPeriod.values]
+
+
+def get_histogram_bucket(seconds):
+    if seconds < HISTOGRAM_BASE:
+        return 0
+    return int(math.log2(seconds / HISTOGRAM_BASE) * HISTOGRAM_STEPS_PER_DOUBLING) + 1
+
+
+def get_bucket_bounds(bucket):
+    if bucket == 0:
+        return 0, HISTOGRAM_BASE
+    return (
+        HISTOGRAM_BASE * 2 ** ((bucket - 1) / HISTOGRAM_STEPS_PER_DOUBLING),
+        HISTOGRAM_BASE * 2 ** (bucket / HISTOGRAM_STEPS_PER_DOUBLING),
+    )
+
+
+def merge_histograms(histograms):
+    # Ключи корзин - строки, как их хранит JSONField
+    merged = Counter()
+    for i_histogram in histograms:
+        merged.update(i_histogram)
+    return merged
+
+
+def get_histogram_median(histogram):
+    # Середина распределения ищется по накопленным счетчикам, внутри корзины - линейно между ее границами
+    total = sum(histogram.values())
+    if not total:
+        return None
+    middle = total / 2
+    seen = 0
+    for i_bucket in sorted(histogram, key=int):
+        count = histogram[i_bucket]
+        if count and seen + count >= middle:
+            low, high = get_bucket_bounds(int(i_bucket))
+            return low + (high - low) * (middle - seen) / count
+        seen += count
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "—"
+    minutes = round(seconds / 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    if minutes < 24 * 60:
+        return f"{minutes // 60} ч {minutes % 60} мин"
+    hours = minutes // 60
+    return f"{hours // 24} д {hours % 24} ч"
+
+
+def get_status_code(status):
+    # События, записанные до перевода статусов в числа (миграция 0022), хранят строковые ключи
+    return ExchangeProposal.STATUS_CODES.get(status, status)
+
+
+def get_category_id(fields, category_ids):
+    # До справочника категорий (миграция 0021) событие хранит название категории, а не ключ
+    if "category_id" in fields:
+        return fields["category_id"]
+    return category_ids.get(fields.get("category"))
+
+
+def collect_event(event, ad_deltas, exchange_deltas, histograms, category_ids):
+    fields = event.payload.get("fields", {})
+    starts = get_period_starts(event.created_at)
+    if event.model == Ad._meta.model_name:
+        category_id = get_category_id(fields, category_ids)
+        if event.kind == "created" and category_id is not None:
+            for i_period, i_start in starts:
+                ad_deltas[i_period, i_start, category_id] += 1
+        return
+
+    if event.kind == "created":
+        counter = "proposals_created"
+    elif event.kind == "status":
+        counter = STATUS_COUNTERS.get(get_status_code(event.payload["changes"]["status"][1]))
+    else:
+        counter = None
+    if counter is None:
+        return
+    for i_key in starts:
+        exchange_deltas[i_key][counter] += 1
+    if counter == "proposals_accepted":
+        closed_at = parse_datetime(fields["closed_at"]) if fields.get("closed_at") else event.created_at
+        seconds = (closed_at - parse_datetime(fields["created_at"])).total_seconds()
+        for i_key in starts:
+            histograms[i_key][str(get_histogram_bucket(seconds))] += 1
+
+
+def save_ad_rollups(ad_deltas):
+    rows = {
+        (i_row.period, i_row.start, i_row.category_id): i_row
+        for i_row in AdRollup.objects.filter(start__in={i_start for _, i_start, _ in ad_deltas})
+    }
+    updated_rows = []
+    new_rows = []
+    for (i_period, i_start, i_category_id), i_count in ad_deltas.items():
+        row = rows.get((i_period, i_start, i_category_id))
+        if row is None:
+            new_rows.append(AdRollup(period=i_period, start=i_start, category_id=i_category_id, ads_created=i_count))
+        else:
+            row.ads_created += i_count
+            updated_rows.append(row)
+    AdRollup.objects.bulk_update(updated_rows, ["ads_created"])
+    AdRollup.objects.bulk_create(new_rows)
+
+
+def save_exchange_rollups(exchange_deltas, histograms):
+    keys = exchange_deltas.keys() | histograms.keys()
+    rows = {
+        (i_row.period, i_row.start): i_row
+        for i_row in ExchangeRollup.objects.filter(start__in={i_start for _, i_start in keys})
+    }
+    updated_rows = []
+    new_rows = []
+    for i_key in keys:
+        row = rows.get(i_key)
+        if row is None:
+            row = ExchangeRollup(period=i_key[0], start=i_key[1])
+            new_rows.append(row)
+        else:
+            updated_rows.append(row)
+        for i_counter, i_count in exchange_deltas[i_key].items():
+            setattr(row, i_counter, getattr(row, i_counter) + i_count)
+        row.accept_histogram = dict(merge_histograms([row.accept_histogram, histograms[i_key]]))
+    ExchangeRollup.objects.bulk_update(updated_rows, [*EXCHANGE_COUNTERS, "accept_histogram"])
+    ExchangeRollup.objects.bulk_create(new_rows)
+
+
+def update_rollups(batch_size=500):
+    # Водяной знак - курсор outbox: пачка событий и новый курсор сохраняются в одной транзакции,
+    # поэтому каждое событие попадает в сводки ровно один раз, а живые таблицы не читаются вовсе
+    processed = 0
+    models = [Ad._meta.model_name, ExchangeProposal._meta.model_name]
+    category_ids = dict(Category.objects.values_list("name", "id"))
+    for i_batch in iter_change_batches(get_cursor(ROLLUPS_CURSOR), batch_size, models=models):
+        ad_deltas = Counter()
+        exchange_deltas = defaultdict(Counter)
+        histograms = defaultdict(Counter)
+        for i_event in i_batch:
+            collect_event(i_event, ad_deltas, exchange_deltas, histograms, category_ids)
+        with transaction.atomic():
+            save_ad_rollups(ad_deltas)
+            save_exchange_rollups(exchange_deltas, histograms)
+            save_cursor(ROLLUPS_CURSOR, i_batch[-1].id)
+        processed += len(i_batch)
+    return processed
+
+
+def get_dashboard(period, since):
+    rows = defaultdict(lambda: {"ads_created": 0, **dict.fromkeys(EXCHANGE_COUNTERS, 0), "accept_histogram": {}})
+    category_counts = Counter()
+    for i_start, i_category_id, i_count in AdRollup.objects.filter(period=period, start__gte=since).values_list(
+        "start", "category_id", "ads_created"
+    ):
+        rows[i_start]["ads_created"] += i_count
+        category_counts[i_category_id] += i_count
+    for i_rollup in ExchangeRollup.objects.filter(period=period, start__gte=since):
+        row = rows[i_rollup.start]
+        for i_counter in EXCHANGE_COUNTERS:
+            row[i_counter] = getattr(i_rollup, i_counter)
+        row["accept_histogram"] = i_rollup.accept_histogram
+
+    totals = {i_name: sum(i_row[i_name] for i_row in rows.values()) for i_name in ["ads_created", *EXCHANGE_COUNTERS]}
+    totals["accept_median"] = format_duration(
+        get_histogram_median(merge_histograms(i_row["accept_histogram"] for i_row in rows.values()))
+    )
+    for i_row in rows.values():
+        i_row["accept_median"] = format_duration(get_histogram_median(i_row.pop("accept_histogram")))
+    categories = Category.objects.in_bulk(list(category_counts))
+    return {
+        "rows": [{"start": i_start, **rows[i_start]} for i_start in sorted(rows, reverse=True)],
+        "totals": totals,
+        "categories": [
+            (categories[i_category_id].name if i_category_id in categories else i_category_id, i_count)
+            for i_category_id, i_count in category_counts.most_common()
+        ],
+    }
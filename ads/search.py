@@ -0,0 +1,87 @@
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Ad, AdTerm
+from .text import get_index_key, get_query_variants, get_search_terms
+
+SEARCH_FIELDS = ("title", "description", "category_id")
+REINDEX_BATCH_SIZE = 500
+MAX_TERM_LENGTH = AdTerm._meta.get_field("term").max_length
+
+
+def get_ad_index_terms(title, description, category):
+    return {i_term[:MAX_TERM_LENGTH] for i_term in get_search_terms(" ".join([title, description, category]))}
+
+
+def build_ad_terms(ads):
+    return [
+        AdTerm(ad_id=i_ad.id, term=i_term)
+        for i_ad in ads
+        for i_term in get_ad_index_terms(i_ad.title, i_ad.description, i_ad.category.name)
+    ]
+
+
+def index_ad_terms(ad):
+    with transaction.atomic():
+        AdTerm.objects.filter(ad_id=ad.id).delete()
+        AdTerm.objects.bulk_create(build_ad_terms([ad]))
+
+
+def reindex_ads(batch_size=REINDEX_BATCH_SIZE):
+    # Пакетами по id, каждый пакет в своей транзакции
+    indexed = 0
+    last_id = 0
+    while True:
+        ads = list(Ad.all_objects.filter(id__gt=last_id).order_by("id").select_related("category")[:batch_size])
+        if not ads:
+            return indexed
+        with transaction.atomic():
+            AdTerm.objects.filter(ad_id__in=[i_ad.id for i_ad in ads]).delete()
+            AdTerm.objects.bulk_create(build_ad_terms(ads))
+        indexed += len(ads)
+        last_id = ads[-1].id
+
+
+def get_term_lookup(variants, is_prefix):
+    # Префикс ищется диапазоном по индексу: LIKE в SQLite не чувствителен к регистру и индекс не использует
+    lookup = Q(term__in=variants)
+    if is_prefix:
+        for i_variant in variants:
+            lookup |= Q(term__gte=i_variant, term__lt=i_variant + "\uffff")
+    return lookup
+
+
+def get_query_terms(search):
+    # Каждое слово запроса должно встретиться в объявлении, последнее может быть началом слова
+    query_variants = get_query_variants(search)
+    is_open = not search[-1:].isspace()
+    return [
+        (i_variants, is_open and i_position == len(query_variants) - 1)
+        for i_position, i_variants in enumerate(query_variants)
+    ]
+
+
+def search_ads(ads_queryset, search):
+    for i_variants, i_is_prefix in get_query_terms(search):
+        ads_queryset = ads_queryset.filter(
+            id__in=AdTerm.objects.filter(get_term_lookup(i_variants, i_is_prefix)).values("ad_id")
+        )
+    return ads_queryset
+
+
+def match_query_terms(query_terms, ad_terms):
+    # Те же правила, что в search_ads, для слов одного объявления в памяти (сохраненные поиски)
+    return all(
+        i_variants & ad_terms
+        or (i_is_prefix and any(i_term.startswith(tuple(i_variants)) for i_term in ad_terms))
+        for i_variants, i_is_prefix in query_terms
+    )
+
+
+def get_search_index_key(search):
+    # Объявление должно содержать все слова запроса, поэтому кандидатов достаточно искать по одному.
+    # Длинные слова обычно реже встречаются и дают меньше кандидатов для проверки
+    terms = get_search_terms(search)
+    if not terms:
+        return None
+    return get_index_key(max(terms, key=len))
@@ -0,0 +1,126 @@
+import heapq
+import zlib
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+SHARDED_MODEL = "ads.exchangeproposal"
+SHARDED_TABLE = "ads_exchangeproposal"
+SHARD_ALIAS_PREFIX = "exchange_"
+# id в шарде N начинаются с N << 40: предложения не повторяют id друг друга при переносе и в архиве
+SHARD_ID_BITS = 40
+
+
+class ShardNotSelectedError(Exception):
+    pass
+
+
+def get_shard_aliases():
+    # Шард 0 - основная база, остальные - отдельные файлы exchange_N.sqlite3
+    return [DEFAULT_DB_ALIAS] + [f"{SHARD_ALIAS_PREFIX}{i_index}" for i_index in range(1, settings.EXCHANGE_SHARDS)]
+
+
+def get_shard_index(alias):
+    if alias == DEFAULT_DB_ALIAS:
+        return 0
+    return int(alias.removeprefix(SHARD_ALIAS_PREFIX))
+
+
+def get_user_shard(user_id):
+    if settings.EXCHANGE_SHARDS == 1 or user_id is None:
+        return DEFAULT_DB_ALIAS
+    return get_shard_aliases()[zlib.crc32(str(user_id).encode()) % settings.EXCHANGE_SHARDS]
+
+
+def get_pair_shard(user_id, other_user_id):
+    # Правило размещения: предложение лежит в шарде пары владельцев товаров, выбранном по меньшему id.
+    # Прямое и встречное предложение попадают в один шард, и уникальный индекс пары действует на обе стороны
+    user_ids = [i_user_id for i_user_id in (user_id, other_user_id) if i_user_id is not None]
+    return get_user_shard(min(user_ids, default=None))
+
+
+def get_lookup_shards(pk):
+    # Предложение обычно лежит в шарде, где получило id, после перенаправления - в одном из остальных
+    aliases = get_shard_aliases()
+    home_shard = aliases[pk >> SHARD_ID_BITS] if pk >> SHARD_ID_BITS < len(aliases) else DEFAULT_DB_ALIAS
+    return [home_shard] + [i_alias for i_alias in aliases if i_alias != home_shard]
+
+
+def start_shard_ids(using, **kwargs):
+    # post_migrate: SQLite пересоздает таблицу при изменении схемы, и счетчик пустой таблицы начинается заново
+    # Шарды сверх текущего EXCHANGE_SHARDS тоже получают свой диапазон: их можно подключить позже
+    if not using.startswith(SHARD_ALIAS_PREFIX) or connections[using].vendor != "sqlite":
+        return
+    start = get_shard_index(using) << SHARD_ID_BITS
+    with connections[using].cursor() as cursor:
+        cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s", [start, SHARDED_TABLE, start])
+        cursor.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)",
+            [SHARDED_TABLE, start, SHARDED_TABLE],
+        )
+
+
+@contextmanager
+def atomic(aliases):
+    # Основная база открывается первой и фиксируется последней: outbox и счетчики пишутся после строк шардов
+    aliases = sorted(set(aliases), key=get_shard_index)
+    with ExitStack() as stack:
+        for i_alias in aliases:
+            stack.enter_context(transaction.atomic(using=i_alias))
+        yield
+
+
+class MergedQuerySets:
+    # Список для Paginator из нескольких шардов: count() складывает шарды, срез сливает первые строки каждого
+    def __init__(self, querysets, ordering):
+        self.querysets = querysets
+        self.key = attrgetter(ordering.lstrip("-"), "id")
+        self.reverse = ordering.startswith("-")
+
+    def count(self):
+        return sum(i_queryset.count() for i_queryset in self.querysets)
+
+    def __getitem__(self, index):
+        rows = heapq.merge(*[i_queryset[:index.stop] for i_queryset in self.querysets], key=self.key, reverse=self.reverse)
+        return list(islice(rows, index.start, index.stop))
+
+
+class ExchangeShardRouter:
+    def db_for_read(self, model, **hints):
+        return self.get_shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        # Товар в подсказке задает только предварительную базу нового предложения: шард выберет save()
+        instance = hints.get("instance")
+        if instance is not None and instance._meta.label_lower != SHARDED_MODEL:
+            return DEFAULT_DB_ALIAS
+        return self.get_shard(model, hints)
+
+    def get_shard(self, model, hints):
+        if model._meta.label_lower != SHARDED_MODEL:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get("instance")
+        if instance is not None and instance._meta.label_lower == SHARDED_MODEL:
+            return get_pair_shard(instance.sender_user_id, instance.receiver_user_id)
+        # Запрос без шарда (ExchangeProposal.objects...) при нескольких шардах прочитал бы только основную базу
+        if settings.EXCHANGE_SHARDS > 1:
+            raise ShardNotSelectedError(
+                "Предложения обмена хранятся в нескольких шардах: выберите базу через using() или обойдите get_shard_aliases()"
+            )
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Предложение в шарде ссылается на товары основной базы
+        if SHARDED_MODEL in {obj1._meta.label_lower, obj2._meta.label_lower}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS:
+            return None
+        # В шардах только таблица предложений
+        return f"{app_label}.{model_name}" == SHARDED_MODEL
@@ -0,0 +1,60 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .models import Ad, ExchangeProposal
+from .notifications import broker
+from .outbox import deletion_kind, record_change
+from .own_ads import invalidate_own_ads
+from .search import SEARCH_FIELDS, index_ad_terms
+from .shards import get_shard_aliases
+from .summary import get_summary_values, update_summaries_on_change, update_summaries_on_save
+
+
+@receiver(post_save, sender=Ad)
+@receiver(post_save, sender=ExchangeProposal)
+def record_saved_instance(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    changes = None if created else instance.get_changed_fields()
+    if created:
+        record_change(instance, "created")
+    elif changes is None or changes:
+        kind = "status" if changes and "status" in changes else "updated"
+        record_change(instance, kind, changes)
+    update_summaries_on_save(instance, created, changes)
+    if sender is Ad and (changes is None or set(SEARCH_FIELDS) & set(changes)):
+        index_ad_terms(instance)
+    if sender is Ad and (changes is None or "title" in changes):
+        invalidate_own_ads(instance.user_id)
+    if sender is ExchangeProposal:
+        transaction.on_commit(broker.wake)
+    instance.remember_loaded_values()
+
+
+@receiver(post_delete, sender=Ad)
+@receiver(post_delete, sender=ExchangeProposal)
+def record_deleted_instance(sender, instance, **kwargs):
+    kind = deletion_kind.get()
+    record_change(instance, kind)
+    if sender is Ad:
+        invalidate_own_ads(instance.user_id)
+    if kind != "archived":
+        # Архивные предложения остаются в истории пользователя и в его счетчиках
+        update_summaries_on_change(instance, old_values=get_summary_values(instance))
+
+
+@receiver(pre_delete, sender=Ad)
+def delete_sharded_proposals(sender, instance, **kwargs):
+    # Каскад Django удаляет предложения только в базе товара, в остальных шардах - здесь
+    for i_alias in get_shard_aliases()[1:]:
+        ExchangeProposal.all_objects.using(i_alias).filter(Q(ad_sender=instance) | Q(ad_receiver=instance)).delete()
+
+
+@receiver(post_save, sender=User)
+def reset_new_user_ads(sender, instance, created, raw=False, **kwargs):
+    # id пользователя может достаться от удаленного: его список в кеше не должен пережить удаление
+    if created and not raw:
+        invalidate_own_ads(instance.pk)
@@ -0,0 +1,141 @@
+import zlib
+from collections import Counter
+
+import numpy as np
+from django.db import transaction
+
+from .models import Ad, SimilarAd
+from .tasks import task
+from .text import tokenize
+
+SIMILAR_ADS_LIMIT = 6
+SIMILARITY_CHUNK_SIZE = 500
+# Размерность хешированных признаков: матрица на 10 000 объявлений занимает около 40 МБ
+FEATURES_DIM = 1024
+TITLE_WEIGHT = 2
+CATEGORY_WEIGHT = 3
+
+AD_TEXT_FIELDS = ("id", "title", "description", "category_id")
+
+
+def get_ad_features(title, description, category_id):
+    features = Counter(tokenize(description))
+    for i_term in tokenize(title):
+        features[i_term] += TITLE_WEIGHT
+    features[f"category:{category_id}"] += CATEGORY_WEIGHT
+    return features
+
+
+def vectorize(rows):
+    # Хешированные признаки со знаком: коллизии не смещают сходство в одну сторону
+    matrix = np.zeros((len(rows), FEATURES_DIM), dtype=np.float32)
+    for i_row, (_, i_title, i_description, i_category_id) in enumerate(rows):
+        for i_term, i_count in get_ad_features(i_title, i_description, i_category_id).items():
+            term_hash = zlib.crc32(i_term.encode())
+            sign = 1 if term_hash & 1 else -1
+            matrix[i_row, (term_hash >> 1) % FEATURES_DIM] += sign * (1 + np.log(i_count))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def get_top_neighbours(scores, candidate_ids, limit=SIMILAR_ADS_LIMIT):
+    # Для каждой строки scores возвращает список (id, сходство) по убыванию сходства
+    limit = min(limit, scores.shape[1])
+    if not limit:
+        return [[] for _ in range(scores.shape[0])]
+    top = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+    neighbours = []
+    for i_row, i_top in enumerate(top):
+        i_top = i_top[np.argsort(-scores[i_row, i_top], kind="stable")]
+        neighbours.append(
+            [(int(candidate_ids[i_index]), float(scores[i_row, i_index])) for i_index in i_top if scores[i_row, i_index] > 0]
+        )
+    return neighbours
+
+
+def save_neighbours(neighbours_by_ad):
+    with transaction.atomic():
+        SimilarAd.objects.filter(ad_id__in=list(neighbours_by_ad)).delete()
+        SimilarAd.objects.bulk_create(
+            [
+                SimilarAd(ad_id=i_ad_id, similar_id=i_similar_id, score=i_score, rank=i_rank)
+                for i_ad_id, i_neighbours in neighbours_by_ad.items()
+                for i_rank, (i_similar_id, i_score) in enumerate(i_neighbours)
+            ]
+        )
+
+
+def iter_ad_chunks(chunk_size=SIMILARITY_CHUNK_SIZE, exclude_id=None):
+    ads_queryset = Ad.objects.order_by("id")
+    if exclude_id is not None:
+        ads_queryset = ads_queryset.exclude(pk=exclude_id)
+    last_id = 0
+    while True:
+        rows = list(ads_queryset.filter(id__gt=last_id).values_list(*AD_TEXT_FIELDS)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def build_similar_ads(chunk_size=SIMILARITY_CHUNK_SIZE, limit=SIMILAR_ADS_LIMIT):
+    # Все векторы в памяти, сходство считается блоками строк: один матричный продукт на блок
+    ids = []
+    chunks = []
+    for i_rows in iter_ad_chunks(chunk_size):
+        ids.extend(i_row[0] for i_row in i_rows)
+        chunks.append(vectorize(i_rows))
+    if not chunks:
+        return 0
+    ids = np.array(ids)
+    matrix = np.concatenate(chunks)
+    for i_start in range(0, len(ids), chunk_size):
+        scores = matrix[i_start:i_start + chunk_size] @ matrix.T
+        rows_count = scores.shape[0]
+        scores[np.arange(rows_count), np.arange(i_start, i_start + rows_count)] = -1
+        neighbours = get_top_neighbours(scores, ids, limit)
+        save_neighbours(dict(zip(ids[i_start:i_start + rows_count].tolist(), neighbours)))
+    return len(ids)
+
+
+def merge_neighbours(neighbours, limit=SIMILAR_ADS_LIMIT):
+    best = {}
+    for i_id, i_score in neighbours:
+        best[i_id] = i_score
+    return sorted(best.items(), key=lambda i_item: -i_item[1])[:limit]
+
+
+def refresh_similar_ads(ad, chunk_size=SIMILARITY_CHUNK_SIZE, limit=SIMILAR_ADS_LIMIT):
+    vector = vectorize([(ad.id, ad.title, ad.description, ad.category_id)])[0]
+    neighbours = []
+    for i_rows in iter_ad_chunks(chunk_size, exclude_id=ad.id):
+        scores = vectorize(i_rows) @ vector
+        chunk_ids = [i_row[0] for i_row in i_rows]
+        neighbours = merge_neighbours(neighbours + get_top_neighbours(scores[None, :], chunk_ids, limit)[0], limit)
+
+    # Сходство симметрично: объявление добавляется в списки своих соседей, полный пересчет делает команда
+    neighbours_by_ad = {ad.id: neighbours}
+    stored = {i_id: [] for i_id, _ in neighbours}
+    for i_similar in SimilarAd.objects.filter(ad_id__in=list(stored)).exclude(similar_id=ad.id):
+        stored[i_similar.ad_id].append((i_similar.similar_id, i_similar.score))
+    for i_id, i_score in neighbours:
+        neighbours_by_ad[i_id] = merge_neighbours(stored[i_id] + [(ad.id, i_score)], limit)
+    save_neighbours(neighbours_by_ad)
+    return neighbours
+
+
+def get_similar_ads(ad, limit=SIMILAR_ADS_LIMIT):
+    return [
+        i_similar.similar
+        for i_similar in SimilarAd.objects.filter(ad=ad, similar__deleted_at__isnull=True)
+        .select_related("similar__category", "similar__condition")
+        .order_by("rank")[:limit]
+    ]
+
+
+@task("refresh_similar_ads")
+def refresh_similar_ads_task(ad_id):
+    ad = Ad.objects.filter(pk=ad_id).first()
+    if ad is not None:
+        refresh_similar_ads(ad)
@@ -0,0 +1,209 @@
+import mmap
+import os
+import struct
+import tempfile
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from .models import Ad, Category, OutboxEvent, SuggestTerm
+from .outbox import get_cursor, iter_change_batches, save_cursor
+from .text import tokenize
+
+SUGGEST_CURSOR = "suggest"
+SUGGEST_LIMIT = 10
+MIN_TERM_LENGTH = 2
+
+# Формат снимка: заголовок, смещения ключей (uint32), веса (uint32), отсортированные ключи в UTF-8
+INDEX_MAGIC = b"SGI1"
+index_header = struct.Struct("<4sI")
+
+
+def get_ad_suggest_keys(title, category):
+    keys = {("term", i_term) for i_term in tokenize(title) if len(i_term) >= MIN_TERM_LENGTH}
+    if category:
+        # Поиск по категории без учета регистра, после \0 хранится исходное написание
+        keys.add(("category", f"{category.casefold()}\0{category}"))
+    return keys
+
+
+def get_display_value(key):
+    return key.rpartition("\0")[2]
+
+
+class PrefixIndex:
+    def __init__(self, path):
+        with open(path, "rb") as index_file:
+            self.buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = index_header.unpack_from(self.buffer)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} не является снимком индекса подсказок")
+        offset = index_header.size
+        self.offsets = np.frombuffer(self.buffer, dtype="<u4", count=self.count + 1, offset=offset)
+        offset += self.offsets.nbytes
+        self.weights = np.frombuffer(self.buffer, dtype="<u4", count=self.count, offset=offset)
+        self.keys_start = offset + self.weights.nbytes
+
+    def get_key(self, position):
+        return self.buffer[
+            self.keys_start + int(self.offsets[position]):self.keys_start + int(self.offsets[position + 1])
+        ]
+
+    def search(self, prefix, limit=SUGGEST_LIMIT):
+        # Ключи с префиксом занимают непрерывный диапазон, его границы находятся двоичным поиском
+        prefix = prefix.encode()
+        positions = range(self.count)
+        start = bisect_left(positions, prefix, key=self.get_key)
+        end = bisect_left(positions, prefix + b"\xff", lo=start, key=self.get_key)
+        weights = self.weights[start:end].astype(np.int64)
+        top = np.arange(len(weights))
+        if len(weights) > limit:
+            top = np.argpartition(-weights, limit - 1)[:limit]
+        top = top[np.lexsort((top, -weights[top]))]
+        return [(self.get_key(start + int(i_position)).decode(), int(weights[i_position])) for i_position in top]
+
+
+def write_index(path, items):
+    items = sorted((i_key.encode(), i_weight) for i_key, i_weight in items)
+    offsets = np.zeros(len(items) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum([len(i_key) for i_key, _ in items], dtype=np.uint64)
+    weights = np.array([i_weight for _, i_weight in items], dtype="<u4")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Новый снимок подменяет старый атомарно, уже открытые mmap продолжают читать прежний файл
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as index_file:
+        index_file.write(index_header.pack(INDEX_MAGIC, len(items)))
+        index_file.write(offsets.tobytes())
+        index_file.write(weights.tobytes())
+        index_file.write(b"".join(i_key for i_key, _ in items))
+    os.replace(index_file.name, path)
+
+
+def get_index_path(kind):
+    return Path(settings.SUGGEST_INDEX_DIR) / f"{kind}.idx"
+
+
+loaded_indexes = {}
+
+
+def get_index(kind):
+    # Один stat на запрос: процесс переоткрывает снимок, только когда файл заменен
+    path = get_index_path(kind)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    version = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    loaded = loaded_indexes.get(kind)
+    if loaded is None or loaded[0] != version:
+        loaded = (version, PrefixIndex(path))
+        loaded_indexes[kind] = loaded
+    return loaded[1]
+
+
+def search_index(kind, prefix, limit):
+    index = get_index(kind)
+    if index is None or not prefix:
+        return []
+    return [get_display_value(i_key) for i_key, _ in index.search(prefix, limit)]
+
+
+def suggest(query, limit=SUGGEST_LIMIT):
+    # Дополняется последнее слово запроса, категории сравниваются со всей строкой
+    terms = tokenize(query)
+    term_prefix = terms[-1] if terms and not query[-1:].isspace() else ""
+    return {
+        "terms": search_index("term", term_prefix, limit),
+        "categories": search_index("category", query.strip().casefold(), limit),
+    }
+
+
+def write_snapshots():
+    for i_kind in SuggestTerm.KINDS:
+        write_index(
+            get_index_path(i_kind),
+            SuggestTerm.objects.filter(kind=i_kind, weight__gt=0).values_list("key", "weight").iterator(),
+        )
+
+
+def get_event_deltas(event, deltas, category_names):
+    # В событиях категория хранится id справочника, названия берутся из category_names
+    fields = event.payload.get("fields", {})
+    new_keys = get_ad_suggest_keys(fields.get("title", ""), category_names.get(fields.get("category_id"), ""))
+    if event.kind == "created":
+        old_keys = set()
+    elif event.kind == "soft_deleted" or (event.kind == "deleted" and not fields.get("deleted_at")):
+        # Мягко удаленное объявление вычитается при пометке, окончательное удаление его уже не трогает
+        old_keys, new_keys = new_keys, set()
+    elif event.kind == "deleted":
+        return
+    else:
+        changes = event.payload.get("changes", {})
+        if "title" not in changes and "category_id" not in changes:
+            return
+        old_keys = get_ad_suggest_keys(
+            changes.get("title", [fields.get("title", "")])[0],
+            category_names.get(changes.get("category_id", [fields.get("category_id")])[0], ""),
+        )
+    for i_key in new_keys - old_keys:
+        deltas[i_key] += 1
+    for i_key in old_keys - new_keys:
+        deltas[i_key] -= 1
+
+
+def apply_deltas(deltas):
+    deltas = {i_key: i_delta for i_key, i_delta in deltas.items() if i_delta}
+    existing = {
+        (i_term.kind, i_term.key): i_term
+        for i_term in SuggestTerm.objects.filter(key__in={i_key for _, i_key in deltas})
+    }
+    updated_terms = []
+    new_terms = []
+    for (i_kind, i_key), i_delta in deltas.items():
+        suggest_term = existing.get((i_kind, i_key))
+        if suggest_term is None:
+            new_terms.append(SuggestTerm(kind=i_kind, key=i_key, weight=i_delta))
+        else:
+            suggest_term.weight += i_delta
+            updated_terms.append(suggest_term)
+    SuggestTerm.objects.bulk_update(updated_terms, ["weight"])
+    SuggestTerm.objects.bulk_create(new_terms)
+    SuggestTerm.objects.filter(weight__lte=0).delete()
+
+
+def update_suggestions(batch_size=500):
+    # Частоты пересчитываются только по новым событиям outbox, снимок перезаписывается при изменениях
+    changed = False
+    for i_batch in iter_change_batches(get_cursor(SUGGEST_CURSOR), batch_size, models=[Ad._meta.model_name]):
+        deltas = Counter()
+        category_names = dict(Category.objects.values_list("id", "name"))
+        for i_event in i_batch:
+            get_event_deltas(i_event, deltas, category_names)
+        with transaction.atomic():
+            apply_deltas(deltas)
+            save_cursor(SUGGEST_CURSOR, i_batch[-1].id)
+        changed = True
+    if changed or any(not get_index_path(i_kind).exists() for i_kind in SuggestTerm.KINDS):
+        write_snapshots()
+    return changed
+
+
+def rebuild_suggestions():
+    with transaction.atomic():
+        position = OutboxEvent.objects.aggregate(position=Max("id"))["position"] or 0
+        weights = Counter()
+        # Мягко удаленные объявления не учитываются: события soft_deleted по ним уже прочитаны
+        for i_title, i_category in Ad.objects.values_list("title", "category__name").iterator(chunk_size=2000):
+            weights.update(get_ad_suggest_keys(i_title, i_category))
+        SuggestTerm.objects.all().delete()
+        SuggestTerm.objects.bulk_create(
+            [SuggestTerm(kind=i_kind, key=i_key, weight=i_weight) for (i_kind, i_key), i_weight in weights.items()],
+            batch_size=1000,
+        )
+        save_cursor(SUGGEST_CURSOR, position)
+    write_snapshots()
+    return len(weights)
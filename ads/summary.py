@@ -0,0 +1,114 @@
+from collections import Counter, defaultdict
+
+from django.db.models import Count, F
+
+from .models import Ad, ArchivedExchangeProposal, ExchangeProposal, UserSummary
+from .shards import get_shard_aliases
+
+
+def get_user_summary(user):
+    # Один запрос по первичному ключу; для анонимов и новых пользователей - нулевые счетчики
+    if not user.is_authenticated:
+        return UserSummary()
+    summary = UserSummary.objects.filter(pk=user.pk).first()
+    if summary is None:
+        summary = rebuild_user_summary(user.pk)
+    return summary
+
+
+def rebuild_user_summary(user_id):
+    counters = {"ads_count": Ad.objects.filter(user_id=user_id).count()}
+    for i_direction, i_user_field in [("outgoing", "sender_user_id"), ("incoming", "receiver_user_id")]:
+        status_counts = Counter()
+        for i_alias in get_shard_aliases():
+            status_counts.update(dict(
+                ExchangeProposal.objects.using(i_alias).filter(**{i_user_field: user_id})
+                .values_list("status").annotate(count=Count("id")).order_by()
+            ))
+        status_counts.update(dict(
+            ArchivedExchangeProposal.objects.filter(**{i_user_field: user_id})
+            .values_list("status").annotate(count=Count("id")).order_by()
+        ))
+        for i_status, i_code in ExchangeProposal.STATUS_CODES.items():
+            counters[f"{i_direction}_{i_status}"] = status_counts[i_code]
+    summary, _ = UserSummary.objects.update_or_create(user_id=user_id, defaults=counters)
+    return summary
+
+
+def apply_summary_deltas(deltas):
+    for i_user_id, i_fields in deltas.items():
+        i_fields = {i_name: i_delta for i_name, i_delta in i_fields.items() if i_delta}
+        if not i_fields:
+            continue
+        updated = UserSummary.objects.filter(pk=i_user_id).update(
+            **{i_name: F(i_name) + i_delta for i_name, i_delta in i_fields.items()}
+        )
+        if not updated:
+            # Строки еще нет: пересчет уже учтет текущее изменение, оно в той же транзакции
+            rebuild_user_summary(i_user_id)
+
+
+def get_contributions(model, values):
+    if values["deleted_at"] is not None:
+        return []
+    if model is Ad:
+        return [(values["user_id"], "ads_count")]
+    status = ExchangeProposal.STATUS_KEYS[values["status"]]
+    return [
+        (values["sender_user_id"], f"outgoing_{status}"),
+        (values["receiver_user_id"], f"incoming_{status}"),
+    ]
+
+
+def update_summaries_on_change(instance, old_values=None, new_values=None):
+    model = type(instance)
+    deltas = defaultdict(Counter)
+    if old_values:
+        for i_user_id, i_field in get_contributions(model, old_values):
+            deltas[i_user_id][i_field] -= 1
+    if new_values:
+        for i_user_id, i_field in get_contributions(model, new_values):
+            deltas[i_user_id][i_field] += 1
+    deltas.pop(None, None)
+    apply_summary_deltas(deltas)
+
+
+def get_summary_values(instance):
+    return {
+        i_field.attname: getattr(instance, i_field.attname)
+        for i_field in instance._meta.concrete_fields
+        if not i_field.generated
+    }
+
+
+def get_affected_users(values, model):
+    if model is Ad:
+        return {values["user_id"]}
+    return {values["sender_user_id"], values["receiver_user_id"]}
+
+
+def update_summaries_on_save(instance, created, changes):
+    new_values = get_summary_values(instance)
+    if created:
+        update_summaries_on_change(instance, new_values=new_values)
+    elif changes is None:
+        # Исходные значения неизвестны (объект создан не из БД) - пересчитываем затронутых пользователей
+        for i_user_id in get_affected_users(new_values, type(instance)):
+            rebuild_user_summary(i_user_id)
+    elif changes:
+        old_values = dict(new_values)
+        old_values.update({i_name: i_values[0] for i_name, i_values in changes.items()})
+        update_summaries_on_change(instance, old_values=old_values, new_values=new_values)
+
+
+def get_soft_delete_deltas(ads_queryset, proposals_querysets):
+    # Считается агрегатами в SQL до пометки строк, применяется после нее через apply_summary_deltas
+    deltas = defaultdict(Counter)
+    for i_user_id, i_count in ads_queryset.values_list("user_id").annotate(count=Count("id")).order_by():
+        deltas[i_user_id]["ads_count"] -= i_count
+    for i_direction, i_user_field in [("outgoing", "sender_user_id"), ("incoming", "receiver_user_id")]:
+        for i_proposals_queryset in proposals_querysets:
+            rows = i_proposals_queryset.values_list(i_user_field, "status").annotate(count=Count("id")).order_by()
+            for i_user_id, i_code, i_count in rows:
+                deltas[i_user_id][f"{i_direction}_{ExchangeProposal.STATUS_KEYS[i_code]}"] -= i_count
+    return deltas
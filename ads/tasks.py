@@ -0,0 +1,206 @@
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from statistics import median
+
+from django.db import DatabaseError, connections
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TaskSpec:
+    func: object
+    concurrency: int | None
+    max_attempts: int
+    retry_delay: int
+
+
+TASKS = {}
+
+
+def task(name=None, concurrency=None, max_attempts=5, retry_delay=10):
+    def decorator(func):
+        TASKS[name or func.__name__] = TaskSpec(func, concurrency, max_attempts, retry_delay)
+        return func
+    return decorator
+
+
+def enqueue(name, delay=0, **payload):
+    # Задача сохраняется в текущей транзакции: обработчик увидит ее только после коммита
+    if name not in TASKS:
+        raise ValueError(f"Неизвестная задача: {name}")
+    return Task.objects.create(
+        name=name,
+        payload=payload,
+        max_attempts=TASKS[name].max_attempts,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def get_available_tasks(now):
+    # Попытка засчитывается при выдаче: задача с истекшей арендой выдается снова, только пока попытки не кончились
+    return Task.objects.filter(
+        Q(status="queued") | Q(status="running", locked_until__lt=now, attempts__lt=F("max_attempts")),
+        run_at__lte=now,
+    )
+
+
+def fail_exhausted_tasks(now):
+    # Обработчик пропал посреди последней попытки: аренда истекла, и задача завершается ошибкой
+    return Task.objects.filter(status="running", locked_until__lt=now, attempts__gte=F("max_attempts")).update(
+        status="failed", finished_at=now, locked_until=None, last_error="Аренда истекла на последней попытке",
+    )
+
+
+def claim_task(worker_id, lease_seconds=300, scan_limit=20):
+    now = timezone.now()
+    fail_exhausted_tasks(now)
+    candidates = get_available_tasks(now).order_by("run_at", "id").values_list("id", "name")[:scan_limit]
+    for i_task_id, i_name in candidates:
+        spec = TASKS.get(i_name)
+        if spec is None:
+            continue
+        claim_queryset = get_available_tasks(now).filter(pk=i_task_id)
+        if spec.concurrency:
+            # Лимит проверяется в том же UPDATE, поэтому два обработчика не превысят его одновременно
+            running_count = Task.objects.filter(
+                name=OuterRef("name"), status="running", locked_until__gte=now,
+            ).values("name").annotate(count=Count("id")).values("count")
+            claim_queryset = claim_queryset.alias(
+                running_count=Coalesce(Subquery(running_count), 0)
+            ).filter(running_count__lt=spec.concurrency)
+        claimed = claim_queryset.update(
+            status="running",
+            locked_by=worker_id,
+            locked_until=now + timedelta(seconds=lease_seconds),
+            attempts=F("attempts") + 1,
+            started_at=now,
+        )
+        if claimed:
+            return Task.objects.get(pk=i_task_id)
+    return None
+
+
+def get_owned_tasks(task_record):
+    return Task.objects.filter(pk=task_record.pk, locked_by=task_record.locked_by, status="running")
+
+
+def renew_lease(task_record, lease, stop):
+    # Аренда продлевается на полный срок каждую треть срока. Если задачу уже забрал другой обработчик
+    # (продление не успело до конца аренды), продлевать больше нечего
+    while not stop.wait(lease.total_seconds() / 3):
+        try:
+            renewed = get_owned_tasks(task_record).update(locked_until=timezone.now() + lease)
+        except DatabaseError as error:
+            logger.warning("Аренда задачи %s (%s) не продлена: %s", task_record.name, task_record.pk, error)
+            continue
+        if not renewed:
+            logger.warning("Задача %s (%s) больше не принадлежит обработчику", task_record.name, task_record.pk)
+            return
+
+
+@contextmanager
+def lease_renewal(task_record):
+    # Пока задача выполняется, отдельный поток продлевает аренду: долгую задачу не заберет второй обработчик
+    lease = task_record.locked_until - task_record.started_at
+    stop = threading.Event()
+
+    def renew():
+        try:
+            renew_lease(task_record, lease, stop)
+        finally:
+            connections.close_all()
+
+    renewer = threading.Thread(target=renew, name=f"lease-{task_record.pk}", daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        renewer.join()
+
+
+def run_task(task_record):
+    spec = TASKS[task_record.name]
+    owned_queryset = get_owned_tasks(task_record)
+    try:
+        with lease_renewal(task_record):
+            spec.func(**task_record.payload)
+    except Exception:
+        error = traceback.format_exc()
+        if task_record.attempts < task_record.max_attempts:
+            delay = spec.retry_delay * 2 ** (task_record.attempts - 1)
+            owned_queryset.update(
+                status="queued",
+                run_at=timezone.now() + timedelta(seconds=delay),
+                locked_by="",
+                locked_until=None,
+                last_error=error,
+            )
+            logger.warning("Задача %s (%s) завершилась ошибкой, повтор через %s с", task_record.name, task_record.pk, delay)
+        else:
+            owned_queryset.update(status="failed", finished_at=timezone.now(), locked_until=None, last_error=error)
+            logger.error("Задача %s (%s) не выполнена после %s попыток", task_record.name, task_record.pk, task_record.attempts)
+        return False
+
+    finished_at = timezone.now()
+    owned_queryset.update(status="done", finished_at=finished_at, locked_until=None)
+    logger.info(
+        "Задача %s (%s) выполнена: ожидание %.3f с, выполнение %.3f с",
+        task_record.name,
+        task_record.pk,
+        (task_record.started_at - task_record.run_at).total_seconds(),
+        (finished_at - task_record.started_at).total_seconds(),
+    )
+    return True
+
+
+def run_pending_tasks(worker_id="inline", limit=None):
+    processed = 0
+    while limit is None or processed < limit:
+        task_record = claim_task(worker_id)
+        if task_record is None:
+            break
+        run_task(task_record)
+        processed += 1
+    return processed
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def get_task_latency_stats(since=None):
+    # Задержка: от момента, когда задачу можно было запускать, до фактического запуска
+    tasks_queryset = Task.objects.filter(status="done")
+    if since is not None:
+        tasks_queryset = tasks_queryset.filter(finished_at__gte=since)
+
+    latencies = {}
+    for i_name, i_run_at, i_started_at in tasks_queryset.values_list("name", "run_at", "started_at").iterator():
+        latencies.setdefault(i_name, []).append((i_started_at - i_run_at).total_seconds())
+
+    return {
+        i_name: {
+            "count": len(i_values),
+            "median": median(i_values),
+            "p95": percentile(i_values, 0.95),
+            "max": max(i_values),
+        }
+        for i_name, i_values in latencies.items()
+    }
+
+
+def delete_finished_tasks(older_than_days=7):
+    threshold = timezone.now() - timedelta(days=older_than_days)
+    return Task.objects.filter(status__in=["done", "failed"], finished_at__lt=threshold).delete()[0]
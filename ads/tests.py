@@ -1,14 +1,120 @@
-from django.test import TestCase
+import asyncio
+import fcntl
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from operator import attrgetter
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+from asgiref.sync import sync_to_async
+from PIL import Image
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
 from ads.forms import NewAdForm, NewExchangeProposalForm
-from ads.models import Ad, ExchangeProposal
+from ads.archive import archive_proposals
+from ads.batch import create_proposals
+from ads.columns import get_category_stats, load_columns
+from ads.counters import ad_views
+from ads.dedupe import dedupe_ads, index_ad
+from ads.images import evict_cache, get_thumbnail
+from ads.loaders import RequestLoaders
+from ads.notifications import broker, stream_events
+from ads.models import (
+    Ad, AdRollup, AdTerm, ArchivedExchangeProposal, Category, Condition, ExchangeProposal, ExchangeRollup, ExchangeStatus,
+    OutboxEvent, RollupPeriod, SavedSearch, SavedSearchMatch, SimilarAd, SuggestTerm, Task, UserSummary,
+    VersionConflictError, get_popularity_weight,
+)
+from ads.own_ads import get_own_ads
+from ads.prerender import prerender_all, update_prerendered
+from ads.outbox import changes_since, compact_outbox, get_cursor, record_changes, save_cursor
+from ads.purge import soft_delete_ad, soft_delete_ads, soft_delete_user
+from ads.rollups import (
+    format_duration, get_histogram_bucket, get_histogram_median, get_period_start, merge_histograms, update_rollups,
+)
+from ads.search import search_ads
+from ads.shards import (
+    SHARD_ID_BITS, ShardNotSelectedError, atomic, get_pair_shard, get_shard_aliases, get_shard_index, get_user_shard,
+)
+from ads.suggest import rebuild_suggestions, update_suggestions
+from ads.views import AdEditView
+from ads.similar import build_similar_ads, get_similar_ads
+from ads.summary import rebuild_user_summary
+from ads.tasks import claim_task, enqueue, get_task_latency_stats, renew_lease, run_pending_tasks, run_task, task
 from django.urls import reverse
 
 
+def get_category(name):
+    return Category.objects.get_or_create(name=name)[0]
+
+
+def get_condition(name):
+    return Condition.objects.get_or_create(name=name)[0]
+
+
+def get_exchanges(manager=ExchangeProposal.objects, **filters):
+    # Предложения из всех шардов в порядке создания: id разных шардов порядок не отражают
+    return sorted(
+        [i_exchange for i_alias in get_shard_aliases() for i_exchange in manager.using(i_alias).filter(**filters)],
+        key=attrgetter("created_at", "id"),
+    )
+
+
+def get_exchange(**filters):
+    (exchange,) = get_exchanges(**filters)
+    return exchange
+
+
+@contextmanager
+def assert_total_queries(test_case, number):
+    # Как assertNumQueries, но по всем базам: при нескольких шардах запросы к предложениям идут не в основную
+    with ExitStack() as stack:
+        contexts = [stack.enter_context(CaptureQueriesContext(connections[i_alias])) for i_alias in get_shard_aliases()]
+        yield
+    test_case.assertEqual(sum(len(i_context) for i_context in contexts), number)
+
+
+test_cache_dir = tempfile.TemporaryDirectory()
+test_cache_override = override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": test_cache_dir.name}}
+)
+
+
+def setUpModule():
+    # Общий файловый кеш, как в settings, но во временном каталоге: записи прошлых запусков тестам не мешают
+    test_cache_override.enable()
+
+
+def tearDownModule():
+    # Просмотры, накопленные тестами, не должны записываться после удаления тестовой БД
+    ad_views.pending.clear()
+    test_cache_override.disable()
+    test_cache_dir.cleanup()
+
+
 class TestAds(TestCase):
+    databases = "__all__"
+
     def setUp(self):
         self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
         self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        self.category = Category.objects.create(name="Test ad")
+        self.condition = Condition.objects.create(name="For tests only!")
+        self.new_category = Category.objects.create(name="New test ad")
+        self.new_condition = Condition.objects.create(name="New for tests only!")
         self.client.force_login(self.user_1)
 
     def test_valid_form_with_image(self):
@@ -16,8 +122,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         form = NewAdForm(data=form_data)
         self.assertTrue(form.is_valid())
@@ -27,8 +133,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         form = NewAdForm(data=form_data)
         self.assertTrue(form.is_valid())
@@ -38,8 +144,8 @@ class TestAds(TestCase):
             "title": "",
             "description": "Test ad description",
             "image_url": "",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         form = NewAdForm(data=form_data)
         self.assertTrue(form.has_error("title"))
@@ -50,8 +156,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "",
             "image_url": "",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         form = NewAdForm(data=form_data)
         self.assertTrue(form.has_error("description"))
@@ -63,7 +169,7 @@ class TestAds(TestCase):
             "description": "Test ad description",
             "image_url": "",
             "category": "",
-            "condition": "For tests only!"
+            "condition": self.condition.id
         }
         form = NewAdForm(data=form_data)
         self.assertTrue(form.has_error("category"))
@@ -74,7 +180,7 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "",
-            "category": "Test ad",
+            "category": self.category.id,
             "condition": ""
         }
         form = NewAdForm(data=form_data)
@@ -86,8 +192,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "not url",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         form = NewAdForm(data=form_data)
         self.assertTrue(form.has_error("image_url"))
@@ -98,8 +204,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         response_1 = self.client.post(reverse("ads:new_ad"), data=form_data)
         self.assertEqual(response_1.status_code, 302)
@@ -115,8 +221,8 @@ class TestAds(TestCase):
         form_data = {
             "title": "Test ad title.",
             "description": "Test ad description",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         response_1 = self.client.post(reverse("ads:new_ad"), data=form_data)
         self.assertEqual(response_1.status_code, 302)
@@ -134,8 +240,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         response_1 = self.client.post(reverse("ads:new_ad"), data=form_data)
         self.assertEqual(response_1.status_code, 302)
@@ -145,8 +251,8 @@ class TestAds(TestCase):
         form_data = {
             "title": "",
             "description": "Test ad description",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         response_1 = self.client.post(reverse("ads:new_ad"), data=form_data)
         self.assertEqual(response_1.status_code, 200)
@@ -157,8 +263,8 @@ class TestAds(TestCase):
         form_data = {
             "title": "Test ad title.",
             "description": "",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category.id,
+            "condition": self.condition.id
         }
         response_1 = self.client.post(reverse("ads:new_ad"), data=form_data)
         self.assertEqual(response_1.status_code, 200)
@@ -170,7 +276,7 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "category": "",
-            "condition": "For tests only!"
+            "condition": self.condition.id
         }
         response_1 = self.client.post(reverse("ads:new_ad"), data=form_data)
         self.assertEqual(response_1.status_code, 200)
@@ -181,7 +287,7 @@ class TestAds(TestCase):
         form_data = {
             "title": "Test ad title.",
             "description": "Test ad description",
-            "category": "Test ad",
+            "category": self.category.id,
             "condition": ""
         }
         response_1 = self.client.post(reverse("ads:new_ad"), data=form_data)
@@ -199,8 +305,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         for i_index in range(20):
             Ad.objects.create(user=self.user_1, **form_data)
@@ -218,8 +324,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         Ad.objects.create(user=self.user_1, **form_data)
         response = self.client.get(reverse("ads:ad_detail", kwargs={"pk": Ad.objects.last().id}))
@@ -231,8 +337,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         Ad.objects.create(user=self.user_1, **form_data)
         response = self.client.get(reverse("ads:ad_detail", kwargs={"pk": Ad.objects.last().id + 1}))
@@ -243,16 +349,16 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         Ad.objects.create(user=self.user_1, **form_data)
         form_new_data = {
             "title": "New test ad title.",
             "description": "New test ad description",
             "image_url": "https://www.python.org/static/img/psf-logo.png",
-            "category": "New test ad",
-            "condition": "New for tests only!",
+            "category": self.new_category.id,
+            "condition": self.new_condition.id,
             "_method": "PUT"
         }
         response_1 = self.client.post(reverse("ads:ad_edit", kwargs={"pk": Ad.objects.last().id}), form_new_data)
@@ -263,24 +369,24 @@ class TestAds(TestCase):
         self.assertEqual(response_2.context["ad"].title, form_new_data["title"])
         self.assertEqual(response_2.context["ad"].description, form_new_data["description"])
         self.assertEqual(response_2.context["ad"].image_url, form_new_data["image_url"])
-        self.assertEqual(response_2.context["ad"].category, form_new_data["category"])
-        self.assertEqual(response_2.context["ad"].condition, form_new_data["condition"])
+        self.assertEqual(response_2.context["ad"].category_id, form_new_data["category"])
+        self.assertEqual(response_2.context["ad"].condition_id, form_new_data["condition"])
 
     def test_edit_view_cant_edit_not_owned_ad(self):
         form_data = {
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         Ad.objects.create(user=self.user_2, **form_data)
         form_new_data = {
             "title": "New test ad title.",
             "description": "New test ad description",
             "image_url": "https://www.python.org/static/img/psf-logo.png",
-            "category": "New test ad",
-            "condition": "New for tests only!",
+            "category": self.new_category.id,
+            "condition": self.new_condition.id,
             "_method": "PUT"
         }
         response_1 = self.client.post(reverse("ads:ad_edit", kwargs={"pk": Ad.objects.last().id}), form_new_data)
@@ -299,8 +405,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         ad_to_delete = Ad.objects.create(user=self.user_1, **form_data)
         ad_to_delete_id = ad_to_delete.id
@@ -316,8 +422,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         ad_to_delete = Ad.objects.create(user=self.user_1, **form_data)
         ad_to_delete_id = ad_to_delete.id
@@ -332,8 +438,8 @@ class TestAds(TestCase):
             "title": "Test ad title.",
             "description": "Test ad description",
             "image_url": "https://www.python.org/static/img/python-logo.png",
-            "category": "Test ad",
-            "condition": "For tests only!"
+            "category": self.category,
+            "condition": self.condition
         }
         Ad.objects.create(user=self.user_2, **form_data)
         response_1 = self.client.delete(reverse("ads:ad_delete", kwargs={"pk": Ad.objects.last().id + 1}))
@@ -341,9 +447,13 @@ class TestAds(TestCase):
 
 
 class TestExchangeProposal(TestCase):
+    databases = "__all__"
 
     def generate_ad_form(self, index):
-        return {i_key: i_value.format(index) for i_key, i_value in self.ad_template_form_data.items()}
+        ad_form = {i_key: i_value.format(index) for i_key, i_value in self.ad_template_form_data.items()}
+        ad_form["category"] = get_category(ad_form["category"])
+        ad_form["condition"] = get_condition(ad_form["condition"])
+        return ad_form
 
     def setUp(self):
         self.ad_template_form_data = {
@@ -431,9 +541,9 @@ class TestExchangeProposal(TestCase):
 
         response_2 = self.client.post(reverse("ads:exchange_confirmation"))
         self.assertEqual(response_2.status_code, 302)
-        self.assertEqual(ExchangeProposal.objects.last().ad_sender, self.ad_1)
-        self.assertEqual(ExchangeProposal.objects.last().ad_receiver, self.ad_2)
-        self.assertRedirects(response_2, reverse("ads:exchange_detail", kwargs={"pk": ExchangeProposal.objects.last().id}))
+        self.assertEqual(get_exchanges()[-1].ad_sender, self.ad_1)
+        self.assertEqual(get_exchanges()[-1].ad_receiver, self.ad_2)
+        self.assertRedirects(response_2, reverse("ads:exchange_detail", kwargs={"pk": get_exchanges()[-1].id}))
 
     def test_create_view_cant_create_with_correct_form_without_login(self):
         self.client.logout()
@@ -491,15 +601,16 @@ class TestExchangeProposal(TestCase):
 
         response_2 = self.client.post(reverse("ads:exchange_confirmation"))
         self.assertEqual(response_2.status_code, 302)
-        self.assertEqual(ExchangeProposal.objects.last().ad_sender, self.ad_1)
-        self.assertEqual(ExchangeProposal.objects.last().ad_receiver, self.ad_2)
-        self.assertRedirects(response_2, reverse("ads:exchange_detail", kwargs={"pk": ExchangeProposal.objects.last().id}))
+        self.assertEqual(get_exchanges()[-1].ad_sender, self.ad_1)
+        self.assertEqual(get_exchanges()[-1].ad_receiver, self.ad_2)
+        self.assertRedirects(response_2, reverse("ads:exchange_detail", kwargs={"pk": get_exchanges()[-1].id}))
 
         response_3 = self.client.post(reverse("ads:new_exchange"), data=exchange_form_data)
         self.assertEqual(response_3.status_code, 200)
         self.assertEqual(response_3.context["form"].errors["ad_sender"][0], f"Предложение обмена {self.ad_1.id} на {self.ad_2.id} уже существует")
-        self.assertIn("Предложение обмена 1", response_3.context["form"].errors["ad_sender"][1])
-        self.assertIn(reverse("ads:exchange_detail", kwargs={"pk": 1}), response_3.context["form"].errors["ad_sender"][1])
+        exchange_id = get_exchanges()[-1].id
+        self.assertIn(f"Предложение обмена {exchange_id}", response_3.context["form"].errors["ad_sender"][1])
+        self.assertIn(reverse("ads:exchange_detail", kwargs={"pk": exchange_id}), response_3.context["form"].errors["ad_sender"][1])
 
         self.client.force_login(self.user_2)
         counter_exchange_form_data = {
@@ -510,8 +621,8 @@ class TestExchangeProposal(TestCase):
         response_4 = self.client.post(reverse("ads:new_exchange"), data=counter_exchange_form_data)
         self.assertEqual(response_4.status_code, 200)
         self.assertEqual(response_4.context["form"].errors["ad_sender"][0], f"Предложение обмена {self.ad_2.id} на {self.ad_1.id} уже существует")
-        self.assertIn("Предложение обмена 1", response_3.context["form"].errors["ad_sender"][1])
-        self.assertIn(reverse("ads:exchange_detail", kwargs={"pk": 1}), response_3.context["form"].errors["ad_sender"][1])
+        self.assertIn(f"Предложение обмена {exchange_id}", response_3.context["form"].errors["ad_sender"][1])
+        self.assertIn(reverse("ads:exchange_detail", kwargs={"pk": exchange_id}), response_3.context["form"].errors["ad_sender"][1])
 
     def test_create_view_cant_propose_not_owned_ad(self):
         exchange_form_data = {
@@ -606,9 +717,9 @@ class TestExchangeProposal(TestCase):
         }
         ExchangeProposal.objects.create(**exchange_form_data)
 
-        response = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": ExchangeProposal.objects.last().id}))
+        response = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": get_exchanges()[-1].id}))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.context["exchange_proposal"], ExchangeProposal.objects.last())
+        self.assertEqual(response.context["exchange_proposal"], get_exchanges()[-1])
         self.assertEqual(response.context["exchange_proposal"].ad_sender, self.ad_1)
         self.assertEqual(response.context["exchange_proposal"].ad_receiver, self.ad_2)
         self.assertEqual(response.context["exchange_proposal"].comment, "Test comment")
@@ -621,7 +732,7 @@ class TestExchangeProposal(TestCase):
         }
         ExchangeProposal.objects.create(**exchange_form_data)
 
-        response = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": ExchangeProposal.objects.last().id}))
+        response = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": get_exchanges()[-1].id}))
         self.assertEqual(response.status_code, 403)
 
     def test_edit_view_can_edit_with_correct_form(self):
@@ -639,15 +750,27 @@ class TestExchangeProposal(TestCase):
             "ad_receiver": ad_5.id,
             "comment": "New test comment"
         }
-        response_1 = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": ExchangeProposal.objects.last().id}), new_exchange_form_data)
+        response_1 = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": get_exchanges()[-1].id}), new_exchange_form_data)
         self.assertEqual(response_1.status_code, 302)
-        self.assertRedirects(response_1, reverse("ads:exchange_detail", kwargs={"pk": ExchangeProposal.objects.last().id}))
+        self.assertRedirects(response_1, reverse("ads:exchange_detail", kwargs={"pk": get_exchanges()[-1].id}))
 
-        response_2 = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": ExchangeProposal.objects.last().id}))
+        response_2 = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": get_exchanges()[-1].id}))
         self.assertEqual(response_2.context["exchange_proposal"].ad_sender.id, new_exchange_form_data["ad_sender"])
         self.assertEqual(response_2.context["exchange_proposal"].ad_receiver.id, new_exchange_form_data["ad_receiver"])
         self.assertEqual(response_2.context["exchange_proposal"].comment, new_exchange_form_data["comment"])
 
+    def test_edit_view_does_not_index_proposal_as_ad(self):
+        exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test comment")
+        AdTerm.objects.all().delete()
+        Task.objects.all().delete()
+        response = self.client.post(
+            reverse("ads:exchange_edit", kwargs={"pk": exchange.id}),
+            {"ad_sender": self.ad_1.id, "ad_receiver": self.ad_3.id, "comment": "New test comment"},
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(AdTerm.objects.exists())
+        self.assertFalse(Task.objects.filter(name="refresh_similar_ads").exists())
+
     def test_edit_view_cant_edit_not_owned_ad(self):
         exchange_form_data = {
             "ad_sender": self.ad_2,
@@ -663,7 +786,7 @@ class TestExchangeProposal(TestCase):
             "ad_receiver": ad_5.id,
             "comment": "New test comment"
         }
-        response_1 = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": ExchangeProposal.objects.last().id}), new_exchange_form_data_1)
+        response_1 = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": get_exchanges()[-1].id}), new_exchange_form_data_1)
         self.assertEqual(response_1.status_code, 403)
         self.client.force_login(self.user_3)
 
@@ -672,11 +795,11 @@ class TestExchangeProposal(TestCase):
             "ad_receiver": ad_5.id,
             "comment": "New test comment"
         }
-        response_2 = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": ExchangeProposal.objects.last().id}), new_exchange_form_data_2)
+        response_2 = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": get_exchanges()[-1].id}), new_exchange_form_data_2)
         self.assertEqual(response_2.status_code, 403)
 
         self.client.force_login(self.user_2)
-        response_3 = self.client.get(reverse("ads:exchange_edit", kwargs={"pk": ExchangeProposal.objects.last().id}))
+        response_3 = self.client.get(reverse("ads:exchange_edit", kwargs={"pk": get_exchanges()[-1].id}))
         self.assertEqual(response_3.status_code, 200)
         self.assertEqual(response_3.context["exchange_proposal"].ad_sender, exchange_form_data["ad_sender"])
         self.assertEqual(response_3.context["exchange_proposal"].ad_receiver, exchange_form_data["ad_receiver"])
@@ -696,7 +819,7 @@ class TestExchangeProposal(TestCase):
             "ad_receiver": ad_5.id,
             "comment": "New test comment"
         }
-        response = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": ExchangeProposal.objects.last().id}), new_exchange_form_data)
+        response = self.client.post(reverse("ads:exchange_edit", kwargs={"pk": get_exchanges()[-1].id}), new_exchange_form_data)
         self.assertEqual(response.status_code, 403)
 
     def test_delete_view_can_delete_exchange(self):
@@ -745,5 +868,1806 @@ class TestExchangeProposal(TestCase):
             "comment": "Test comment"
         }
         ExchangeProposal.objects.create(**exchange_form_data)
-        response_1 = self.client.delete(reverse("ads:ad_delete", kwargs={"pk": ExchangeProposal.objects.last().id + 1}))
+        response_1 = self.client.delete(reverse("ads:ad_delete", kwargs={"pk": get_exchanges()[-1].id + 1}))
         self.assertTrue(response_1.status_code, 403)
+
+
+class TestAdsApi(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.form_data = {
+            "title": "Test ad title.",
+            "description": "Test ad description",
+            "image_url": "https://www.python.org/static/img/python-logo.png",
+            "category": get_category("Test ad"),
+            "condition": get_condition("For tests only!")
+        }
+
+    def test_api_list_can_select_fields(self):
+        ad = Ad.objects.create(user=self.user_1, **self.form_data)
+        response = self.client.get(reverse("ads:api_ads"), {"fields": "id,title"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"results": [{"id": ad.id, "title": ad.title}], "next": None})
+
+    def test_api_list_hides_duplicates_like_catalogue(self):
+        ad = Ad.objects.create(user=self.user_1, **self.form_data)
+        duplicate = Ad.objects.create(user=self.user_1, **self.form_data)
+        Ad.objects.filter(pk=duplicate.id).update(duplicate_of=ad)
+        response = self.client.get(reverse("ads:api_ads"), {"fields": "id"})
+        self.assertEqual(response.json()["results"], [{"id": ad.id}])
+
+    def test_api_list_cant_select_unknown_fields(self):
+        response = self.client.get(reverse("ads:api_ads"), {"fields": "id,password"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_list_can_paginate_with_cursor(self):
+        for i_index in range(20):
+            Ad.objects.create(user=self.user_1, **self.form_data)
+        expected_ids = list(Ad.objects.order_by("-created_at", "-id").values_list("id", flat=True))
+
+        received_ids = []
+        params = {"fields": "id", "limit": 7}
+        for i_page in range(3):
+            response = self.client.get(reverse("ads:api_ads"), params)
+            self.assertEqual(response.status_code, 200)
+            received_ids.extend(i_item["id"] for i_item in response.json()["results"])
+            params["cursor"] = response.json()["next"]
+        self.assertIsNone(params["cursor"])
+        self.assertEqual(received_ids, expected_ids)
+
+    def test_api_list_uses_list_filters(self):
+        Ad.objects.create(user=self.user_1, **self.form_data)
+        other_ad = Ad.objects.create(user=self.user_1, **dict(self.form_data, category=get_category("Other")))
+        response = self.client.get(reverse("ads:api_ads"), {"fields": "id,category", "category": other_ad.category_id})
+        self.assertEqual(response.json()["results"], [{"id": other_ad.id, "category": "Other"}])
+
+        response = self.client.get(reverse("ads:api_ads"), {"category": "Other"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_list_returns_not_modified_for_same_etag(self):
+        Ad.objects.create(user=self.user_1, **self.form_data)
+        response_1 = self.client.get(reverse("ads:api_ads"))
+        self.assertIn("ETag", response_1)
+
+        response_2 = self.client.get(reverse("ads:api_ads"), headers={"If-None-Match": response_1["ETag"]})
+        self.assertEqual(response_2.status_code, 304)
+
+    def test_api_detail_can_get_ad(self):
+        ad = Ad.objects.create(user=self.user_1, **self.form_data)
+        response = self.client.get(reverse("ads:api_ad_detail", kwargs={"pk": ad.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["title"], ad.title)
+        self.assertEqual(response.json()["user"], self.user_1.id)
+        self.assertEqual(response.json()["created_at"], ad.created_at.isoformat())
+
+        response = self.client.get(reverse("ads:api_ad_detail", kwargs={"pk": ad.id + 1}))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestOutbox(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Ad 1", description="Ad 1", category=get_category("Test"), condition=get_condition("New"))
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Ad 2", description="Ad 2", category=get_category("Test"), condition=get_condition("New"))
+
+    def test_outbox_records_create_update_and_delete(self):
+        position = OutboxEvent.objects.last().id
+        ad = Ad.objects.get(pk=self.ad_1.id)
+        ad.title = "New title"
+        ad.save()
+        ad.save()
+        ad.delete()
+
+        events = changes_since(position)
+        self.assertEqual([i_event.kind for i_event in events], ["updated", "deleted"])
+        self.assertEqual(events[0].payload["changes"], {"title": ["Ad 1", "New title"]})
+        self.assertEqual(events[1].payload["fields"]["title"], "New title")
+
+    def test_outbox_records_status_transitions_and_cascades(self):
+        exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        exchange = get_exchange(pk=exchange.id)
+        exchange.set_status("accepted")
+        self.ad_1.delete()
+
+        events = changes_since(0, models=["exchangeproposal"])
+        self.assertEqual([i_event.kind for i_event in events], ["created", "status", "deleted"])
+        self.assertEqual(events[1].payload["changes"]["status"], [ExchangeStatus.WAITING, ExchangeStatus.ACCEPTED])
+        self.assertTrue(all(i_event.object_id == exchange.id for i_event in events))
+
+    def test_outbox_sequence_is_increasing(self):
+        events = changes_since(0)
+        self.assertEqual([i_event.object_id for i_event in events], [self.ad_1.id, self.ad_2.id])
+        self.assertLess(events[0].id, events[1].id)
+        self.assertEqual(changes_since(events[0].id), [events[1]])
+
+    def test_compaction_keeps_unread_events(self):
+        save_cursor("indexer", OutboxEvent.objects.first().id)
+        OutboxEvent.objects.update(created_at=timezone.now() - timedelta(days=30))
+
+        self.assertEqual(compact_outbox(retention_days=7), 1)
+        self.assertEqual(list(OutboxEvent.objects.values_list("object_id", flat=True)), [self.ad_2.id])
+
+    def test_changes_command_saves_consumer_cursor(self):
+        output = StringIO()
+        call_command("outbox_changes", consumer="indexer", batch_size=1, stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(get_cursor("indexer"), OutboxEvent.objects.last().id)
+
+    def test_changes_api_is_staff_only(self):
+        self.client.force_login(self.user_1)
+        response = self.client.get(reverse("ads:api_changes"))
+        self.assertEqual(response.status_code, 403)
+
+        self.user_1.is_staff = True
+        self.user_1.save()
+        response = self.client.get(reverse("ads:api_changes"), {"since": 0, "limit": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"][0]["object_id"], self.ad_1.id)
+        self.assertEqual(response.json()["next"], response.json()["results"][0]["id"])
+
+
+TEST_TASK_CALLS = []
+
+
+@task("test_collect")
+def collect_for_tests(value):
+    TEST_TASK_CALLS.append(value)
+
+
+@task("test_fail", max_attempts=2, retry_delay=30)
+def fail_for_tests():
+    raise RuntimeError("Test error")
+
+
+@task("test_limited", concurrency=1)
+def limited_for_tests():
+    pass
+
+
+class TestTasks(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        TEST_TASK_CALLS.clear()
+
+    def test_worker_runs_queued_tasks(self):
+        enqueue("test_collect", value=1)
+        enqueue("test_collect", value=2)
+        enqueue("test_collect", delay=60, value=3)
+
+        self.assertEqual(run_pending_tasks(), 2)
+        self.assertEqual(TEST_TASK_CALLS, [1, 2])
+        self.assertEqual(Task.objects.filter(status="done").count(), 2)
+        self.assertEqual(Task.objects.filter(status="queued").count(), 1)
+
+    def test_cant_enqueue_unknown_task(self):
+        with self.assertRaises(ValueError):
+            enqueue("test_unknown")
+
+    def test_failed_task_is_retried_with_backoff(self):
+        task_record = enqueue("test_fail")
+        self.assertEqual(run_pending_tasks(), 1)
+        task_record.refresh_from_db()
+        self.assertEqual(task_record.status, "queued")
+        self.assertIn("Test error", task_record.last_error)
+        self.assertGreater(task_record.run_at, timezone.now() + timedelta(seconds=20))
+
+        Task.objects.update(run_at=timezone.now())
+        self.assertEqual(run_pending_tasks(), 1)
+        task_record.refresh_from_db()
+        self.assertEqual(task_record.status, "failed")
+        self.assertEqual(task_record.attempts, 2)
+
+    def test_concurrency_limit_and_expired_lease(self):
+        enqueue("test_limited")
+        enqueue("test_limited")
+
+        first_task = claim_task("worker-1")
+        self.assertIsNotNone(first_task)
+        self.assertIsNone(claim_task("worker-2"))
+
+        Task.objects.filter(pk=first_task.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        reclaimed_task = claim_task("worker-2")
+        self.assertEqual(reclaimed_task.pk, first_task.pk)
+        self.assertEqual(reclaimed_task.attempts, 2)
+
+        # Старый обработчик уже потерял аренду и не перезапишет результат
+        self.assertTrue(run_task(first_task))
+        self.assertEqual(Task.objects.get(pk=first_task.pk).status, "running")
+
+    def test_task_is_not_leased_after_last_attempt(self):
+        task_record = enqueue("test_fail")
+        for i_attempt in [1, 2]:
+            claimed = claim_task("worker-1")
+            self.assertEqual(claimed.attempts, i_attempt)
+            # Обработчик пропал, не завершив задачу
+            Task.objects.filter(pk=task_record.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(claim_task("worker-2"))
+        task_record.refresh_from_db()
+        self.assertEqual((task_record.status, task_record.attempts), ("failed", 2))
+        self.assertIn("Аренда истекла", task_record.last_error)
+
+    def test_lease_is_renewed_while_task_runs(self):
+        enqueue("test_collect", value=1)
+        claimed = claim_task("worker-1", lease_seconds=30)
+        Task.objects.filter(pk=claimed.pk).update(locked_until=timezone.now() + timedelta(seconds=1))
+        stop = Mock(**{"wait.side_effect": [False, True]})
+        renew_lease(claimed, timedelta(seconds=30), stop)
+        stop.wait.assert_called_with(10)
+        self.assertGreater(Task.objects.get(pk=claimed.pk).locked_until, timezone.now() + timedelta(seconds=20))
+
+        # Задачу забрал другой обработчик: продление прекращается
+        Task.objects.filter(pk=claimed.pk).update(locked_by="worker-2")
+        stop = Mock(**{"wait.return_value": False})
+        renew_lease(claimed, timedelta(seconds=30), stop)
+        self.assertEqual(stop.wait.call_count, 1)
+
+    def test_latency_stats(self):
+        enqueue("test_collect", value=1)
+        Task.objects.update(run_at=timezone.now() - timedelta(seconds=5))
+        run_pending_tasks()
+        stats = get_task_latency_stats()
+        self.assertEqual(stats["test_collect"]["count"], 1)
+        self.assertGreaterEqual(stats["test_collect"]["median"], 5)
+
+
+class TestPurge(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {
+            "description": "Test ad description",
+            "category": get_category("Test ad"),
+            "condition": get_condition("For tests only!"),
+        }
+        self.ads_1 = [Ad.objects.create(user=self.user_1, title=f"Ad 1.{i_index}", **ad_data) for i_index in range(3)]
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Ad 2", **ad_data)
+        for i_ad in self.ads_1:
+            ExchangeProposal.objects.create(ad_sender=i_ad, ad_receiver=self.ad_2, comment="Test comment")
+        self.client.force_login(self.user_1)
+
+    def test_delete_view_hides_ad_and_purges_in_background(self):
+        ad = self.ads_1[0]
+        response = self.client.post(reverse("ads:ad_delete", kwargs={"pk": ad.id}))
+        self.assertRedirects(response, reverse("ads:ads"))
+
+        self.assertTrue(Ad.all_objects.filter(pk=ad.id).exists())
+        self.assertEqual(self.client.get(reverse("ads:ad_detail", kwargs={"pk": ad.id})).status_code, 404)
+        self.assertEqual(len(self.client.get(reverse("ads:ads")).context["ads"]), 3)
+        self.assertEqual(len(self.client.get(reverse("ads:exchanges")).context["exchanges_list"]), 2)
+
+        run_pending_tasks()
+        self.assertFalse(Ad.all_objects.filter(pk=ad.id).exists())
+        self.assertEqual(len(get_exchanges(ExchangeProposal.all_objects)), 2)
+
+    def test_ad_form_cant_change_deleted_at(self):
+        self.assertNotIn("deleted_at", NewAdForm().fields)
+
+    def test_user_purge_deletes_dependents_in_batches(self):
+        soft_delete_user(self.user_1)
+        self.assertFalse(User.objects.get(pk=self.user_1.id).is_active)
+        self.assertEqual(Ad.objects.count(), 1)
+        self.assertEqual(get_exchanges(), [])
+
+        Task.objects.update(payload={"user_id": self.user_1.id, "batch_size": 2})
+        self.assertEqual(run_pending_tasks(), 4)
+        self.assertFalse(User.objects.filter(pk=self.user_1.id).exists())
+        self.assertEqual(list(Ad.all_objects.all()), [self.ad_2])
+        self.assertEqual(get_exchanges(ExchangeProposal.all_objects), [])
+
+    def test_soft_delete_records_events_in_batches(self):
+        with patch("ads.purge.record_changes", side_effect=record_changes) as record_mock:
+            with atomic(get_shard_aliases()):
+                self.assertEqual(soft_delete_ads(Ad.all_objects.filter(user=self.user_1), batch_size=2), 3)
+        self.assertTrue(all(len(i_call.args[0]) <= 2 for i_call in record_mock.call_args_list))
+
+        events = OutboxEvent.objects.filter(kind="soft_deleted").order_by("id")
+        ads_ids = [i_ad.id for i_ad in self.ads_1]
+        self.assertEqual([i_event.object_id for i_event in events if i_event.model == "ad"], ads_ids)
+        self.assertEqual(
+            sorted(i_event.object_id for i_event in events if i_event.model == "exchangeproposal"),
+            sorted(i_exchange.id for i_exchange in get_exchanges(ExchangeProposal.all_objects)),
+        )
+        self.assertTrue(all(i_event.payload["fields"]["deleted_at"] for i_event in events))
+        self.assertEqual(Ad.objects.count(), 1)
+        self.assertEqual(get_exchanges(), [])
+
+
+class TestArchive(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {
+            "description": "Test ad description",
+            "category": get_category("Test ad"),
+            "condition": get_condition("For tests only!"),
+        }
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Ad 1", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Ad 2", **ad_data)
+        self.ad_3 = Ad.objects.create(user=self.user_2, title="Ad 3", **ad_data)
+        self.old_exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Old")
+        self.old_exchange.set_status("accepted")
+        self.new_exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_3, comment="New")
+        self.new_exchange.set_status("rejected")
+        ExchangeProposal.objects.using(self.old_exchange._state.db).filter(pk=self.old_exchange.id).update(
+            closed_at=timezone.now() - timedelta(days=60)
+        )
+        self.client.force_login(self.user_2)
+
+    def test_set_status_sets_closed_at(self):
+        self.assertIsNotNone(self.new_exchange.closed_at)
+        self.new_exchange.set_status("waiting")
+        self.assertIsNone(self.new_exchange.closed_at)
+
+    def test_status_is_stored_as_code_and_filtered_by_key(self):
+        self.new_exchange.set_status("waiting")
+        self.assertEqual(get_exchange(status=ExchangeStatus.WAITING), self.new_exchange)
+        self.assertEqual(self.new_exchange.status_key, "waiting")
+        self.assertEqual(self.new_exchange.get_status_display(), "ожидает")
+        with self.assertRaises(ValueError):
+            self.new_exchange.set_status("unknown")
+
+        response = self.client.get(reverse("ads:exchanges"), {"status": "waiting"})
+        self.assertEqual(list(response.context["exchanges_list"]), [self.new_exchange])
+        response = self.client.get(reverse("ads:exchanges"), {"status": "unknown"})
+        self.assertEqual(list(response.context["exchanges_list"]), [])
+
+    def test_archive_moves_only_old_closed_proposals(self):
+        self.assertEqual(archive_proposals(older_than_days=30, batch_size=1), 1)
+        self.assertEqual(get_exchanges(), [self.new_exchange])
+
+        archived = ArchivedExchangeProposal.objects.get()
+        self.assertEqual(archived.id, self.old_exchange.id)
+        self.assertEqual(archived.ad_sender_title, "Ad 1")
+        self.assertEqual(archived.receiver_user_id, self.user_2.id)
+        self.assertEqual(archived.status, ExchangeStatus.ACCEPTED)
+        self.assertEqual(OutboxEvent.objects.filter(object_id=archived.id).last().kind, "archived")
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).incoming_accepted, 1)
+        self.assertEqual(rebuild_user_summary(self.user_2.pk).incoming_accepted, 1)
+
+    def test_archive_view_shows_user_history(self):
+        archive_proposals(older_than_days=30)
+        response = self.client.get(reverse("ads:exchange_archive"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([i_exchange.id for i_exchange in response.context["archived_exchanges_list"]], [self.old_exchange.id])
+        self.assertEqual(len(self.client.get(reverse("ads:exchanges")).context["exchanges_list"]), 1)
+
+        User.objects.create_user(username="test_user_3", password="test_user_password")
+        self.client.force_login(User.objects.get(username="test_user_3"))
+        response = self.client.get(reverse("ads:exchange_archive"))
+        self.assertEqual(len(response.context["archived_exchanges_list"]), 0)
+
+
+class TestAdViews(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        ad_data = {
+            "description": "Test ad description",
+            "category": get_category("Test ad"),
+            "condition": get_condition("For tests only!"),
+        }
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Ad 1", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_1, title="Ad 2", **ad_data)
+        self.client.force_login(self.user_1)
+        ad_views.flush()
+
+    def test_views_are_buffered_and_flushed_in_one_update(self):
+        with self.settings(AD_VIEWS_FLUSH_INTERVAL=3600):
+            for i_index in range(3):
+                self.client.get(reverse("ads:ad_detail", kwargs={"pk": self.ad_1.id}))
+            self.client.get(reverse("ads:ad_detail", kwargs={"pk": self.ad_2.id}))
+        self.assertEqual(Ad.objects.get(pk=self.ad_1.id).views_count, 0)
+
+        with self.assertNumQueries(1):
+            ad_views.flush()
+        self.assertEqual(Ad.objects.get(pk=self.ad_1.id).views_count, 3)
+        self.assertEqual(Ad.objects.get(pk=self.ad_2.id).views_count, 1)
+
+    def test_edit_does_not_roll_back_flushed_views(self):
+        load_ad = AdEditView.get_object
+
+        def load_then_flush(view, *args, **kwargs):
+            # Сброс счетчиков попадает между загрузкой объявления в форму и его сохранением
+            ad = load_ad(view, *args, **kwargs)
+            ad_views.hit(self.ad_1.id)
+            ad_views.flush()
+            return ad
+
+        form_data = {
+            "title": "Ad 1 edited",
+            "description": "Test ad description",
+            "category": self.ad_1.category_id,
+            "condition": self.ad_1.condition_id,
+        }
+        with patch.object(AdEditView, "get_object", load_then_flush):
+            response = self.client.post(reverse("ads:ad_edit", kwargs={"pk": self.ad_1.id}), form_data)
+        self.assertRedirects(response, reverse("ads:ad_detail", kwargs={"pk": self.ad_1.id}))
+        ad = Ad.objects.get(pk=self.ad_1.id)
+        self.assertEqual((ad.title, ad.views_count), ("Ad 1 edited", 1))
+        self.assertGreater(ad.popularity, self.ad_1.popularity)
+
+    def test_list_view_can_order_by_popularity(self):
+        ad_views.hit(self.ad_1.id)
+        ad_views.flush()
+        response = self.client.get(reverse("ads:ads"), {"ordering": "-popularity"})
+        self.assertEqual(list(response.context["ads"]), [self.ad_1, self.ad_2])
+
+    def test_flusher_writes_views_without_new_hits(self):
+        flushed = threading.Event()
+        with patch.object(ad_views, "flush", side_effect=flushed.set), self.settings(AD_VIEWS_FLUSH_INTERVAL=0.01):
+            ad_views.start_flusher()
+            try:
+                self.assertTrue(flushed.wait(5))
+            finally:
+                ad_views.stop_flusher()
+
+    def test_recent_views_outweigh_old_views(self):
+        old_weight = get_popularity_weight(timezone.now() - timedelta(days=14))
+        Ad.objects.filter(pk=self.ad_1.id).update(popularity=3 * old_weight)
+        ad_views.hit(self.ad_2.id)
+        ad_views.flush()
+        self.assertEqual(list(Ad.objects.order_by("-popularity")), [self.ad_2, self.ad_1])
+
+
+class TestUserSummary(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {
+            "description": "Test ad description",
+            "category": get_category("Test ad"),
+            "condition": get_condition("For tests only!"),
+        }
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Ad 1", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Ad 2", **ad_data)
+        self.ad_3 = Ad.objects.create(user=self.user_2, title="Ad 3", **ad_data)
+
+    def get_counters(self, user):
+        summary = UserSummary.objects.get(pk=user.pk)
+        return {i_field: getattr(summary, i_field) for i_field in UserSummary.COUNTER_FIELDS}
+
+    def assert_matches_rebuild(self):
+        for i_user in (self.user_1, self.user_2):
+            counters = self.get_counters(i_user)
+            rebuild_user_summary(i_user.pk)
+            self.assertEqual(counters, self.get_counters(i_user))
+
+    def test_counters_follow_proposal_lifecycle(self):
+        exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        self.assertEqual(UserSummary.objects.get(pk=self.user_1.pk).outgoing_waiting, 1)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).incoming_waiting, 1)
+
+        exchange = get_exchange(pk=exchange.id)
+        exchange.set_status("rejected")
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).incoming_rejected, 1)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).incoming_waiting, 0)
+
+        exchange.ad_sender, exchange.ad_receiver = exchange.ad_receiver, exchange.ad_sender
+        exchange.set_status("waiting")
+        self.assertEqual(UserSummary.objects.get(pk=self.user_1.pk).incoming_waiting, 1)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).outgoing_waiting, 1)
+        self.assert_matches_rebuild()
+
+        exchange.delete()
+        self.assertEqual(UserSummary.objects.get(pk=self.user_1.pk).incoming_waiting, 0)
+        self.assert_matches_rebuild()
+
+    def test_counters_follow_soft_delete(self):
+        ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_3, comment="Test")
+        soft_delete_user(self.user_1)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).incoming_waiting, 0)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_1.pk).ads_count, 0)
+        self.assert_matches_rebuild()
+
+    def test_views_read_flags_from_summary(self):
+        response = self.client.get(reverse("ads:ad_detail", kwargs={"pk": self.ad_1.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context["user_have_ads"])
+
+        self.client.force_login(self.user_2)
+        response = self.client.get(reverse("ads:ad_detail", kwargs={"pk": self.ad_1.id}))
+        self.assertTrue(response.context["user_have_ads"])
+
+        ExchangeProposal.objects.create(ad_sender=self.ad_2, ad_receiver=self.ad_1, comment="Test")
+        self.client.force_login(self.user_1)
+        response = self.client.get(reverse("ads:exchanges"))
+        self.assertEqual(response.context["summary"].incoming_waiting, 1)
+        self.assertContains(response, "Ожидают вашего ответа: 1")
+
+
+class TestSavedSearches(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        self.client.force_login(self.user_1)
+
+    def create_ad(self, **ad_data):
+        self.client.force_login(self.user_2)
+        form_data = {
+            "description": "Test ad description",
+            "category": get_category("Спорт").id,
+            "condition": get_condition("Новое").id,
+            **ad_data,
+        }
+        self.client.post(reverse("ads:new_ad"), data=form_data)
+        self.client.post(reverse("ads:ad_confirmation"))
+        self.client.force_login(self.user_1)
+        run_pending_tasks()
+        return Ad.objects.last()
+
+    def test_can_save_search_from_list_filters(self):
+        response = self.client.post(reverse("ads:new_saved_search"), {"search": "Горный велосипед", "category": get_category("Спорт").id})
+        self.assertRedirects(response, reverse("ads:saved_searches"))
+        saved_search = SavedSearch.objects.get()
+        self.assertEqual(saved_search.user, self.user_1)
+        self.assertEqual(saved_search.index_key, "вел")
+
+        self.client.post(reverse("ads:new_saved_search"), {"search": "", "category": ""})
+        self.assertEqual(SavedSearch.objects.count(), 1)
+
+    def test_new_ad_is_matched_only_against_candidate_searches(self):
+        self.client.post(reverse("ads:new_saved_search"), {"search": "горный велосипед"})
+        self.client.post(
+            reverse("ads:new_saved_search"), {"category": get_category("Спорт").id, "condition": get_condition("Б/у").id}
+        )
+        self.client.post(reverse("ads:new_saved_search"), {"search": "самокат"})
+
+        ad = self.create_ad(title="Велосипед горный, почти новый")
+        self.assertEqual(
+            list(SavedSearchMatch.objects.values_list("saved_search__search", "ad")),
+            [("горный велосипед", ad.id)],
+        )
+
+        other_ad = self.create_ad(title="Ролики", condition=get_condition("Б/у").id)
+        response = self.client.get(reverse("ads:saved_searches"))
+        self.assertEqual([i_match.ad for i_match in response.context["matches"]], [other_ad, ad])
+
+    def test_latin_and_prefix_searches_are_matched_like_list_search(self):
+        for i_search in ["velosiped", "ipho", "велосип", "самокат"]:
+            self.client.post(reverse("ads:new_saved_search"), {"search": i_search})
+
+        bike = self.create_ad(title="Велосипед горный")
+        phone = self.create_ad(title="iPhone 12")
+        matches = set(SavedSearchMatch.objects.values_list("saved_search__search", "ad"))
+        self.assertEqual(matches, {("velosiped", bike.id), ("велосип", bike.id), ("ipho", phone.id)})
+        for i_search, i_ad_id in matches:
+            self.assertEqual(list(search_ads(Ad.objects.all(), i_search).values_list("id", flat=True)), [i_ad_id])
+
+    def test_own_ads_are_not_matched(self):
+        SavedSearch.objects.create(user=self.user_2, search="велосипед", index_key="вел")
+        self.create_ad(title="Велосипед")
+        self.assertEqual(SavedSearchMatch.objects.count(), 0)
+
+    def test_can_delete_only_own_search(self):
+        saved_search = SavedSearch.objects.create(user=self.user_2, search="велосипед", index_key="вел")
+        response = self.client.post(reverse("ads:saved_search_delete", kwargs={"pk": saved_search.id}))
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(SavedSearch.objects.exists())
+
+
+class TestSimilarAds(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {"description": "Test ad description", "condition": get_condition("Б/у")}
+        sport = get_category("Спорт")
+        self.bike = Ad.objects.create(user=self.user_1, title="Горный велосипед", category=sport, **ad_data)
+        self.other_bike = Ad.objects.create(user=self.user_2, title="Велосипед детский", category=sport, **ad_data)
+        self.book = Ad.objects.create(user=self.user_2, title="Книга рецептов", category=get_category("Книги"), **ad_data)
+
+    def test_build_similar_ads_ranks_neighbours(self):
+        self.assertEqual(build_similar_ads(chunk_size=2), 3)
+        neighbours = list(SimilarAd.objects.filter(ad=self.bike).order_by("rank").values_list("similar", flat=True))
+        self.assertEqual(neighbours, [self.other_bike.id, self.book.id])
+        self.assertFalse(SimilarAd.objects.filter(ad=self.bike, similar=self.bike).exists())
+
+    def test_new_ad_refreshes_own_and_neighbours_lists(self):
+        build_similar_ads()
+        self.client.force_login(self.user_2)
+        form_data = {
+            "title": "Велосипед горный",
+            "description": "Test ad description",
+            "category": get_category("Спорт").id,
+            "condition": get_condition("Новое").id,
+        }
+        self.client.post(reverse("ads:new_ad"), data=form_data)
+        self.client.post(reverse("ads:ad_confirmation"))
+        run_pending_tasks()
+        new_bike = Ad.objects.last()
+
+        self.assertEqual(SimilarAd.objects.get(ad=new_bike, rank=0).similar, self.bike)
+        self.assertEqual(SimilarAd.objects.get(ad=self.bike, rank=0).similar, new_bike)
+
+    def test_detail_view_reads_precomputed_neighbours(self):
+        build_similar_ads()
+        soft_delete_ad(self.book)
+        with self.assertNumQueries(1):
+            self.assertEqual([i_ad.title for i_ad in get_similar_ads(self.bike)], ["Велосипед детский"])
+        self.client.force_login(self.user_2)
+        response = self.client.get(reverse("ads:ad_detail", kwargs={"pk": self.bike.id}))
+        self.assertEqual(response.context["similar_ads"], [self.other_bike])
+        self.assertContains(response, "Велосипед детский")
+
+
+class TestDuplicateAds(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        self.description = "Продаю горный велосипед в хорошем состоянии, недавно менял цепь и тормоза"
+        self.ad_data = {"category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad = Ad.objects.create(user=self.user_1, title="Горный велосипед", description=self.description, **self.ad_data)
+        index_ad(self.ad)
+
+    def get_form_data(self, **ad_data):
+        return {
+            "title": "Горный велосипед",
+            "description": self.description,
+            "category": self.ad_data["category"].id,
+            "condition": self.ad_data["condition"].id,
+            **ad_data,
+        }
+
+    def test_own_near_duplicate_is_blocked(self):
+        self.client.force_login(self.user_1)
+        form_data = self.get_form_data(description=self.description + ", торг")
+        response = self.client.post(reverse("ads:new_ad"), data=form_data)
+        self.assertContains(response, f"Вы уже разместили похожее объявление {self.ad.id}")
+
+        response = self.client.post(reverse("ads:new_ad"), data=self.get_form_data(title="Книга", description="Сборник рецептов"))
+        self.assertRedirects(response, reverse("ads:ad_confirmation"))
+
+    def test_own_ad_can_be_edited(self):
+        self.client.force_login(self.user_1)
+        form_data = self.get_form_data(description=self.description + ", торг")
+        response = self.client.post(reverse("ads:ad_edit", kwargs={"pk": self.ad.id}), form_data)
+        self.assertRedirects(response, reverse("ads:ad_detail", kwargs={"pk": self.ad.id}))
+
+    def test_other_users_duplicate_is_flagged_and_hidden(self):
+        self.client.force_login(self.user_2)
+        self.client.post(reverse("ads:new_ad"), data=self.get_form_data(description=self.description + ", торг"))
+        self.client.post(reverse("ads:ad_confirmation"))
+        duplicate = Ad.objects.last()
+        self.assertEqual(duplicate.duplicate_of, self.ad)
+        self.assertEqual(list(self.client.get(reverse("ads:ads")).context["ads"]), [self.ad])
+
+    def test_dedupe_ads_flags_existing_duplicates(self):
+        duplicate = Ad.objects.create(
+            user=self.user_2, title="Горный велосипед!", description=self.description, **self.ad_data
+        )
+        other = Ad.objects.create(user=self.user_2, title="Книга", description="Сборник рецептов", **self.ad_data)
+        self.assertIsNone(duplicate.duplicate_of)
+
+        self.assertEqual(dedupe_ads(chunk_size=2), 1)
+        self.assertEqual(Ad.objects.get(pk=duplicate.id).duplicate_of, self.ad)
+        self.assertIsNone(Ad.objects.get(pk=other.id).duplicate_of)
+        self.assertIsNone(Ad.objects.get(pk=self.ad.id).duplicate_of)
+
+
+class TestSuggestions(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        settings_override = override_settings(SUGGEST_INDEX_DIR=index_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username="test_user_1", password="test_user_password")
+        ad_data = {"user": self.user, "description": "Test ad description", "condition": get_condition("Б/у")}
+        self.bike = Ad.objects.create(title="Горный велосипед", category=get_category("Спорт"), **ad_data)
+        Ad.objects.create(title="Детский велосипед", category=get_category("Спорт"), **ad_data)
+        Ad.objects.create(title="Велотренажер", category=get_category("Спорт и отдых"), **ad_data)
+
+    def get_suggestions(self, query):
+        return self.client.get(reverse("ads:api_suggest"), {"q": query}).json()
+
+    def test_suggestions_are_ranked_by_frequency(self):
+        rebuild_suggestions()
+        with self.assertNumQueries(0):
+            suggestions = self.get_suggestions("горный вел")
+        self.assertEqual(suggestions["terms"], ["велосипед", "велотренажер"])
+        self.assertEqual(self.get_suggestions("СПО")["categories"], ["Спорт", "Спорт и отдых"])
+        self.assertEqual(self.get_suggestions("горный "), {"terms": [], "categories": []})
+
+    def test_index_is_updated_from_outbox(self):
+        update_suggestions()
+        self.assertEqual(self.get_suggestions("вело")["terms"], ["велосипед", "велотренажер"])
+
+        self.bike.title = "Горный самокат"
+        self.bike.save()
+        Ad.objects.create(
+            user=self.user, title="Велотренажер", description="Test", category=get_category("Дом"),
+            condition=get_condition("Б/у"),
+        )
+        self.assertTrue(update_suggestions())
+        self.assertFalse(update_suggestions())
+        suggestions = self.get_suggestions("вело")
+        self.assertEqual(suggestions["terms"], ["велотренажер", "велосипед"])
+        self.assertEqual(self.get_suggestions("са")["terms"], ["самокат"])
+
+    def test_soft_deleted_ad_is_subtracted_once(self):
+        update_suggestions()
+        soft_delete_ad(self.bike)
+        self.assertEqual(OutboxEvent.objects.filter(object_id=self.bike.id).latest("id").kind, "soft_deleted")
+        update_suggestions()
+        self.assertEqual(SuggestTerm.objects.get(kind="term", key="велосипед").weight, 1)
+        self.assertFalse(SuggestTerm.objects.filter(key="горный").exists())
+
+        run_pending_tasks()
+        update_suggestions()
+        self.assertEqual(SuggestTerm.objects.get(kind="term", key="велосипед").weight, 1)
+
+
+class TestSearch(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user_1", password="test_user_password")
+        ad_data = {"user": self.user, "condition": get_condition("Б/у")}
+        sport = get_category("Спорт")
+        self.bike = Ad.objects.create(title="Горный велосипед", description="Почти новый", category=sport, **ad_data)
+        self.tree = Ad.objects.create(title="Ёлка искусственная", description="Высота 2 м", category=get_category("Дом"), **ad_data)
+        self.bikes = Ad.objects.create(title="Детские велосипеды", description="Два штуки", category=sport, **ad_data)
+
+    def search(self, query):
+        response = self.client.get(reverse("ads:ads"), {"search": query, "ordering": "created_at"})
+        return list(response.context["ads"])
+
+    def test_search_ignores_case_yo_and_word_forms(self):
+        self.assertEqual(self.search("ВЕЛОСИПЕДЫ"), [self.bike, self.bikes])
+        self.assertEqual(self.search("елки"), [self.tree])
+        self.assertEqual(self.search("горные велосипеды"), [self.bike])
+
+    def test_last_word_matches_prefix_and_latin_is_transliterated(self):
+        self.assertEqual(self.search("вело"), [self.bike, self.bikes])
+        self.assertEqual(self.search("вело "), [])
+        self.assertEqual(self.search("velosiped"), [self.bike, self.bikes])
+
+    def test_index_follows_edits(self):
+        self.bike.title = "Горный самокат"
+        self.bike.save()
+        self.assertEqual(self.search("велосипед"), [self.bikes])
+        self.assertEqual(self.search("самокаты"), [self.bike])
+        self.assertEqual(AdTerm.objects.filter(ad=self.bike, term="велосипед").count(), 0)
+
+
+class TestDictionaries(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.sport = get_category("Спорт")
+        self.books = get_category("Книги")
+        self.used = get_condition("Б/у")
+        ad_data = {"user": self.user, "description": "Test ad description", "condition": self.used}
+        self.bike = Ad.objects.create(title="Велосипед", category=self.sport, **ad_data)
+        self.book = Ad.objects.create(title="Книга", category=self.books, **ad_data)
+
+    def test_list_filters_and_facets_use_dictionary_ids(self):
+        response = self.client.get(reverse("ads:ads"), {"category": self.sport.id, "condition": self.used.id})
+        self.assertEqual(list(response.context["ads"]), [self.bike])
+        self.assertEqual(list(response.context["categories_list"]), [self.books, self.sport])
+
+        response = self.client.get(reverse("ads:ads"), {"category": "Спорт"})
+        self.assertEqual(list(response.context["ads"]), [])
+
+    def test_new_ad_form_offers_choices(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("ads:new_ad"))
+        self.assertContains(response, f'<option value="{self.books.id}">Книги</option>')
+
+        form_data = {"title": "Мяч", "description": "Футбольный", "category": self.sport.id, "condition": 999}
+        response = self.client.post(reverse("ads:new_ad"), data=form_data)
+        self.assertTrue(response.context["form"].has_error("condition"))
+
+
+class TestVersions(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {"description": "Test ad description", "category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", **ad_data)
+        self.exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+
+    def test_stale_instance_save_raises_conflict(self):
+        first = Ad.objects.get(pk=self.ad_1.id)
+        second = Ad.objects.get(pk=self.ad_1.id)
+        first.title = "Горный велосипед"
+        first.save()
+        self.assertEqual(first.version, 1)
+
+        second.title = "Шоссейный велосипед"
+        with self.assertRaises(VersionConflictError):
+            second.save()
+        self.assertEqual(Ad.objects.get(pk=self.ad_1.id).title, "Горный велосипед")
+
+    def test_ad_edit_with_stale_version_returns_conflict(self):
+        self.client.force_login(self.user_1)
+        form_data = {
+            "title": "Горный велосипед",
+            "description": "Test ad description",
+            "category": self.ad_1.category_id,
+            "condition": self.ad_1.condition_id,
+            "version": 0,
+        }
+        Ad.objects.filter(pk=self.ad_1.id).update(version=1)
+        response = self.client.post(reverse("ads:ad_edit", kwargs={"pk": self.ad_1.id}), form_data)
+        self.assertEqual(response.status_code, 409)
+        self.assertContains(response, "Запись изменили", status_code=409)
+        self.assertEqual(response.context["form"]["version"].value(), 1)
+        self.assertEqual(Ad.objects.get(pk=self.ad_1.id).title, "Велосипед")
+
+        form_data["version"] = 1
+        response = self.client.post(reverse("ads:ad_edit", kwargs={"pk": self.ad_1.id}), form_data)
+        self.assertRedirects(response, reverse("ads:ad_detail", kwargs={"pk": self.ad_1.id}))
+        self.assertEqual(Ad.objects.get(pk=self.ad_1.id).version, 2)
+
+    def test_status_change_with_stale_version_returns_conflict(self):
+        self.client.force_login(self.user_2)
+        url = reverse("ads:exchange_detail", kwargs={"pk": self.exchange.id})
+        get_exchange(pk=self.exchange.id).set_status("rejected")
+        response = self.client.post(url, {"set-status-button": "accept", "version": 0})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(get_exchange(pk=self.exchange.id).status_key, "rejected")
+
+    def test_recreate_swaps_direction_of_the_same_pair(self):
+        self.exchange.set_status("rejected")
+        self.client.force_login(self.user_2)
+        url = reverse("ads:exchange_detail", kwargs={"pk": self.exchange.id})
+        response = self.client.post(url, {"set-status-button": "recreate", "version": 1})
+        self.assertRedirects(response, url)
+        exchange = get_exchange(pk=self.exchange.id)
+        self.assertEqual((exchange.ad_sender, exchange.ad_receiver, exchange.status), (self.ad_2, self.ad_1, ExchangeStatus.WAITING))
+
+
+class TestRequestLoaders(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {"description": "Test ad description", "category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", **ad_data)
+        self.client.force_login(self.user_1)
+
+    def test_loader_batches_and_memoises(self):
+        loaders = RequestLoaders()
+        loaders.ads.prime(self.ad_1.id, "not an id")
+        with self.assertNumQueries(2):
+            ad_1, ad_2, missing = loaders.load_ads([self.ad_1.id, str(self.ad_2.id), 999])
+            self.assertEqual((ad_1.user, ad_2.user, missing), (self.user_1, self.user_2, None))
+        with self.assertNumQueries(0):
+            self.assertEqual(loaders.load_ad(self.ad_2.id).category.name, "Спорт")
+
+    def test_propose_confirm_flow_runs_fixed_number_of_queries(self):
+        form_data = {"ad_sender": self.ad_1.id, "ad_receiver": self.ad_2.id, "comment": "Test"}
+        self.client.get(reverse("ads:new_exchange"))
+        # Сессия, пользователь, оба товара одним запросом, проверка существующих пар, запись сессии
+        with assert_total_queries(self, 7):
+            response = self.client.post(reverse("ads:new_exchange"), form_data)
+        self.assertRedirects(response, reverse("ads:exchange_confirmation"))
+        with assert_total_queries(self, 4):
+            self.client.get(reverse("ads:exchange_confirmation"))
+        # Вставка идет в точке сохранения: конфликт пары не обрывает транзакцию запроса;
+        # владельцы товаров уже в предложении, счетчики обновляются без выборки товаров.
+        # Шард пары вне основной базы открывает свою точку сохранения
+        shard_savepoint = 0 if get_pair_shard(self.user_1.id, self.user_2.id) == DEFAULT_DB_ALIAS else 2
+        with assert_total_queries(self, 10 + shard_savepoint):
+            self.client.post(reverse("ads:exchange_confirmation"))
+        exchange = get_exchange()
+        with assert_total_queries(self, 5):
+            self.client.get(reverse("ads:exchange_detail", kwargs={"pk": exchange.id}))
+
+
+class TestOwnAdsPicker(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        self.ad_data = {"description": "Test ad description", "category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", **self.ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", **self.ad_data)
+        self.client.force_login(self.user_1)
+
+    def test_form_offers_cached_own_ads(self):
+        response = self.client.get(reverse("ads:new_exchange"))
+        self.assertContains(response, f'<option value="{self.ad_1.id}">{self.ad_1.id}: Велосипед</option>', html=True)
+        self.assertNotContains(response, "Самокат")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_own_ads(self.user_1.id), [(self.ad_1.id, "Велосипед")])
+
+    def test_own_ads_cache_is_invalidated(self):
+        get_own_ads(self.user_1.id)
+        ad_3 = Ad.objects.create(user=self.user_1, title="Ролики", **self.ad_data)
+        self.assertEqual(get_own_ads(self.user_1.id), [(self.ad_1.id, "Велосипед"), (ad_3.id, "Ролики")])
+
+        ad_3.title = "Коньки"
+        ad_3.save()
+        self.assertEqual(get_own_ads(self.user_1.id)[1], (ad_3.id, "Коньки"))
+
+        soft_delete_ad(self.ad_1)
+        self.assertEqual(get_own_ads(self.user_1.id), [(ad_3.id, "Коньки")])
+
+    def test_own_ads_are_not_cached_in_process_memory(self):
+        with self.settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}):
+            for _ in range(2):
+                with self.assertNumQueries(1):
+                    self.assertEqual(get_own_ads(self.user_1.id), [(self.ad_1.id, "Велосипед")])
+
+    def test_foreign_ad_error_lists_cached_ids(self):
+        get_own_ads(self.user_1.id)
+        form_data = {"ad_sender": self.ad_2.id, "ad_receiver": self.ad_2.id, "comment": "Test"}
+        form = NewExchangeProposalForm(data=form_data, user=self.user_1)
+        with self.assertNumQueries(1):
+            self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors["ad_sender"], [f"Этот товар вам не принадлежит. Список доступных товаров: {self.ad_1.id}"])
+
+
+class TestBatchExchangeProposals(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        self.user_3 = User.objects.create_user(username="test_user_3", password="test_user_password")
+        ad_data = {"description": "Test ad description", "category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", **ad_data)
+        self.ad_3 = Ad.objects.create(user=self.user_3, title="Ролики", **ad_data)
+        self.ad_4 = Ad.objects.create(user=self.user_3, title="Коньки", **ad_data)
+        self.client.force_login(self.user_1)
+
+    def test_batch_creates_pairs_and_reports_results(self):
+        ExchangeProposal.objects.create(ad_sender=self.ad_3, ad_receiver=self.ad_1, comment="Reverse")
+        form_data = {
+            "ad_senders": [self.ad_1.id],
+            "ad_receivers": f"{self.ad_2.id}, {self.ad_3.id} {self.ad_4.id} {self.ad_1.id} 999",
+            "comment": "Batch",
+        }
+        response = self.client.post(reverse("ads:exchange_batch"), form_data)
+        self.assertEqual(response.status_code, 200)
+        results = {i_result["ad_receiver_id"]: i_result["result"] for i_result in response.context["results"]}
+        self.assertEqual(
+            results,
+            {self.ad_2.id: "created", self.ad_3.id: "exists", self.ad_4.id: "created", self.ad_1.id: "own_ad", 999: "not_found"},
+        )
+        self.assertEqual(
+            {i_exchange.ad_receiver_id for i_exchange in get_exchanges(comment="Batch")}, {self.ad_2.id, self.ad_4.id}
+        )
+        self.assertEqual(UserSummary.objects.get(pk=self.user_1.pk).outgoing_waiting, 2)
+        self.assertEqual(rebuild_user_summary(self.user_3.pk).incoming_waiting, 1)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_3.pk).incoming_waiting, 1)
+        self.assertEqual(OutboxEvent.objects.filter(model="exchangeproposal", kind="created").count(), 3)
+
+    def test_batch_validates_all_pairs_with_fixed_queries(self):
+        get_own_ads(self.user_1.id)
+        form_data = {"ad_senders": [self.ad_1.id], "ad_receivers": f"{self.ad_2.id} {self.ad_3.id} {self.ad_4.id}", "comment": "Batch"}
+        self.client.post(reverse("ads:exchange_batch"), form_data)
+        for i_exchange in get_exchanges(ExchangeProposal.all_objects):
+            i_exchange.delete()
+        # Сессия, пользователь, товары, существующие пары, вставка в своей точке сохранения, outbox, счетчики
+        # трех пользователей и точка сохранения: число запросов не зависит от числа пар. Все пары user_1 лежат
+        # в одном шарде, и если это не основная база, в нем своя точка сохранения
+        shard_savepoint = 0 if get_pair_shard(self.user_1.id, self.user_2.id) == DEFAULT_DB_ALIAS else 2
+        with assert_total_queries(self, 13 + shard_savepoint):
+            self.client.post(reverse("ads:exchange_batch"), form_data)
+        self.assertEqual(len(get_exchanges()), 3)
+
+    def test_pair_inserted_meanwhile_is_reported_as_existing(self):
+        ExchangeProposal.objects.create(ad_sender=self.ad_3, ad_receiver=self.ad_1, comment="Meanwhile")
+        # Проверка пар не видит строку параллельного запроса: ее ловит уникальный индекс при вставке
+        with patch("ads.batch.get_existing_pairs", return_value={}):
+            results = create_proposals(self.user_1, [self.ad_1.id], [self.ad_2.id, self.ad_3.id], "Batch", RequestLoaders())
+        self.assertEqual([i_result["result"] for i_result in results], ["created", "exists"])
+        self.assertEqual([i_exchange.id for i_exchange in get_exchanges(comment="Batch")], [results[0]["exchange_id"]])
+        self.assertEqual(
+            list(OutboxEvent.objects.filter(kind="created", payload__fields__comment="Batch").values_list("object_id", flat=True)),
+            [results[0]["exchange_id"]],
+        )
+        self.assertEqual(UserSummary.objects.get(pk=self.user_1.pk).outgoing_waiting, 1)
+
+    def test_batch_rejects_foreign_sender(self):
+        form_data = {"ad_senders": [self.ad_2.id], "ad_receivers": str(self.ad_3.id), "comment": "Batch"}
+        response = self.client.post(reverse("ads:exchange_batch"), form_data)
+        self.assertTrue(response.context["form"].has_error("ad_senders"))
+        self.assertEqual(get_exchanges(), [])
+
+
+class TestUnorderedPairs(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {"description": "Test ad description", "category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", **ad_data)
+        self.exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+
+    def test_reverse_pair_violates_unique_index(self):
+        self.assertEqual((self.exchange.pair_low, self.exchange.pair_high), ExchangeProposal.get_pair_key(self.ad_2.id, self.ad_1.id))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ExchangeProposal.objects.create(ad_sender=self.ad_2, ad_receiver=self.ad_1, comment="Reverse")
+        self.exchange.delete()
+        ExchangeProposal.objects.create(ad_sender=self.ad_2, ad_receiver=self.ad_1, comment="Reverse")
+
+    def test_form_finds_reverse_pair_with_one_query(self):
+        self.client.force_login(self.user_2)
+        loaders = RequestLoaders()
+        form = NewExchangeProposalForm(
+            data={"ad_sender": self.ad_2.id, "ad_receiver": self.ad_1.id, "comment": "Reverse"},
+            user=self.user_2,
+            loaders=loaders,
+            is_edit=True,
+        )
+        loaders.load_ads([self.ad_1.id, self.ad_2.id])
+        get_own_ads(self.user_2.id)
+        with assert_total_queries(self, 1):
+            self.assertFalse(form.is_valid())
+        self.assertIn("уже существует", form.errors["ad_sender"][0])
+
+    def test_confirmation_of_pair_created_meanwhile_returns_conflict(self):
+        self.client.force_login(self.user_2)
+        form_data = {"ad_sender": self.ad_2.id, "ad_receiver": self.ad_1.id, "comment": "Reverse"}
+        self.exchange.delete()
+        self.client.post(reverse("ads:new_exchange"), form_data)
+        ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Meanwhile")
+        response = self.client.post(reverse("ads:exchange_confirmation"))
+        self.assertContains(response, "уже существует", status_code=409)
+        self.assertEqual(get_exchanges(ad_sender=self.ad_2), [])
+
+
+@override_settings(EXCHANGE_EVENTS_POLL_INTERVAL=0.05)
+class TestExchangeEvents(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        ad_data = {"description": "Test ad description", "category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", **ad_data)
+
+    async def read_event(self, stream):
+        return await asyncio.wait_for(anext(stream), 5)
+
+    async def test_new_proposal_and_answer_are_pushed(self):
+        await self.async_client.aforce_login(self.user_2)
+        receiver_stream = aiter((await self.async_client.get(reverse("ads:exchange_events"))).streaming_content)
+        self.assertEqual(await self.read_event(receiver_stream), b"retry: 3000\n\n")
+        exchange = await sync_to_async(ExchangeProposal.objects.create)(
+            ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test"
+        )
+        message = (await self.read_event(receiver_stream)).decode()
+        self.assertIn("event: incoming", message)
+        self.assertIn(f'"exchange_id":{exchange.id}', message)
+
+        await self.async_client.aforce_login(self.user_1)
+        sender_stream = aiter((await self.async_client.get(reverse("ads:exchange_events"))).streaming_content)
+        await self.read_event(sender_stream)
+        await sync_to_async(exchange.set_status)("accepted")
+        message = (await self.read_event(sender_stream)).decode()
+        self.assertIn("event: status", message)
+        self.assertIn('"status":"accepted"', message)
+        await receiver_stream.aclose()
+        await sender_stream.aclose()
+
+    async def test_closed_stream_unsubscribes(self):
+        stream = stream_events(self.user_1.id)
+        await self.read_event(stream)
+        self.assertEqual(set(broker.subscribers), {self.user_1.id})
+        await stream.aclose()
+        self.assertFalse(broker.subscribers)
+        self.assertIsNone(broker.tailer)
+
+    async def test_reconnect_replays_missed_events(self):
+        first = await sync_to_async(ExchangeProposal.objects.create)(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        last_event_id = await OutboxEvent.objects.filter(object_id=first.id, model="exchangeproposal").values_list("id", flat=True).aget()
+        await sync_to_async(first.set_status)("rejected")
+        await self.async_client.aforce_login(self.user_1)
+        response = await self.async_client.get(reverse("ads:exchange_events"), headers={"Last-Event-ID": str(last_event_id)})
+        stream = aiter(response.streaming_content)
+        await self.read_event(stream)
+        self.assertIn('"status":"rejected"', (await self.read_event(stream)).decode())
+        await stream.aclose()
+
+    async def test_replay_reads_backlog_past_one_batch(self):
+        exchange = await sync_to_async(ExchangeProposal.objects.create)(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        last_event_id = await OutboxEvent.objects.filter(object_id=exchange.id, model="exchangeproposal").values_list("id", flat=True).aget()
+        for i_status in ["rejected", "waiting", "accepted"]:
+            await sync_to_async(exchange.set_status)(i_status)
+        with patch("ads.notifications.REPLAY_BATCH_SIZE", 1):
+            stream = stream_events(self.user_1.id, last_event_id)
+            await self.read_event(stream)
+            messages = [(await self.read_event(stream)) for _ in range(2)]
+            await stream.aclose()
+        self.assertIn('"status":"rejected"', messages[0])
+        self.assertIn('"status":"accepted"', messages[1])
+
+    async def test_replay_older_than_window_sends_reset(self):
+        exchange = await sync_to_async(ExchangeProposal.objects.create)(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        last_event_id = await OutboxEvent.objects.filter(object_id=exchange.id, model="exchangeproposal").values_list("id", flat=True).aget()
+        for i_status in ["rejected", "waiting"]:
+            await sync_to_async(exchange.set_status)(i_status)
+        end_position = await OutboxEvent.objects.order_by("id").values_list("id", flat=True).alast()
+        with patch("ads.notifications.REPLAY_WINDOW", 1):
+            for i_event_id in [last_event_id, end_position + 1]:
+                stream = stream_events(self.user_1.id, i_event_id)
+                await self.read_event(stream)
+                self.assertEqual(await self.read_event(stream), f"id: {end_position}\nevent: reset\ndata: {{}}\n\n")
+                await stream.aclose()
+
+    async def test_replayed_event_is_not_sent_again_from_queue(self):
+        exchange = await sync_to_async(ExchangeProposal.objects.create)(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        last_event_id = await OutboxEvent.objects.filter(object_id=exchange.id, model="exchangeproposal").values_list("id", flat=True).aget()
+        stream = stream_events(self.user_1.id, last_event_id)
+        await self.read_event(stream)
+        # Событие после подписки попадает в очередь соединения и в досылку
+        await sync_to_async(exchange.set_status)("rejected")
+        while not broker.subscribers[self.user_1.id] or not next(iter(broker.subscribers[self.user_1.id])).qsize():
+            await asyncio.sleep(0.01)
+        self.assertIn('"status":"rejected"', await self.read_event(stream))
+        await sync_to_async(exchange.set_status)("accepted")
+        self.assertIn('"status":"accepted"', await self.read_event(stream))
+        await stream.aclose()
+
+    async def test_comment_edit_is_pushed_to_receiver(self):
+        exchange = await sync_to_async(ExchangeProposal.objects.create)(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        stream = stream_events(self.user_2.id)
+        await self.read_event(stream)
+        exchange.comment = "Новый комментарий"
+        await sync_to_async(exchange.save)()
+        message = await self.read_event(stream)
+        await stream.aclose()
+        self.assertIn("event: updated", message)
+        self.assertIn(f'"exchange_id":{exchange.id}', message)
+
+    def test_requires_login_and_asgi(self):
+        self.assertEqual(self.client.get(reverse("ads:exchange_events")).status_code, 403)
+        self.client.force_login(self.user_1)
+        self.assertEqual(self.client.get(reverse("ads:exchange_events")).status_code, 204)
+
+
+class ImageOriginHandler(BaseHTTPRequestHandler):
+    # Локальная замена внешнего сервера изображений: считает обращения, может отвечать с задержкой
+    # и отдавать тело по 16 байт с паузой trickle
+    hits = []
+    hosts = []
+    delay = 0
+    trickle = 0
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        self.hosts.append(self.headers["Host"])
+        time.sleep(self.delay)
+        if not self.path.startswith("/photo.png"):
+            self.send_error(404)
+            return
+        image = BytesIO()
+        Image.new("RGB", (2000, 1000), "orange").save(image, "PNG")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(image.getvalue())))
+        self.end_headers()
+        if not self.trickle:
+            self.wfile.write(image.getvalue())
+            return
+        try:
+            for i_start in range(0, len(image.getvalue()), 16):
+                self.wfile.write(image.getvalue()[i_start:i_start + 16])
+                time.sleep(self.trickle)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImageProxy(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.origin = ThreadingHTTPServer(("127.0.0.1", 0), ImageOriginHandler)
+        threading.Thread(target=cls.origin.serve_forever, daemon=True).start()
+        cls.origin_url = f"http://127.0.0.1:{cls.origin.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.origin.shutdown()
+        cls.origin.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = override_settings(IMAGE_CACHE_DIR=cache_dir.name, IMAGE_PROXY_ALLOW_PRIVATE=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        ImageOriginHandler.hits = []
+        ImageOriginHandler.hosts = []
+        ImageOriginHandler.delay = 0
+        ImageOriginHandler.trickle = 0
+        self.user = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.ad = Ad.objects.create(
+            user=self.user, title="Велосипед", description="Test ad description", image_url=self.origin_url + "/photo.png",
+            category=get_category("Спорт"), condition=get_condition("Б/у"),
+        )
+
+    def test_thumbnail_is_fetched_once_and_resized(self):
+        response = self.client.get(self.ad.thumbnail_url)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(Image.open(BytesIO(b"".join(response.streaming_content))).size, (320, 160))
+        self.client.get(self.ad.thumbnail_url)
+        self.assertEqual(len(ImageOriginHandler.hits), 1)
+        self.assertContains(self.client.get(reverse("ads:ad_detail", kwargs={"pk": self.ad.id})), self.ad.image_proxy_url)
+
+    def test_concurrent_requests_are_coalesced(self):
+        ImageOriginHandler.delay = 0.3
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            paths = set(executor.map(lambda i_number: get_thumbnail(self.ad.image_url, "large"), range(5)))
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(len(ImageOriginHandler.hits), 1)
+
+    def test_least_recently_used_thumbnails_are_evicted(self):
+        paths = [get_thumbnail(f"{self.origin_url}/photo.png?n={i_number}", "small") for i_number in range(3)]
+        for i_age, i_path in zip([30, 20, 10], paths):
+            os.utime(i_path, (time.time() - i_age, time.time() - i_age))
+        get_thumbnail(f"{self.origin_url}/photo.png?n=0", "small")
+        self.assertEqual(evict_cache(int(paths[0].stat().st_size * 2 / 0.9) + 1), 1)
+        self.assertEqual([i_path.exists() for i_path in paths], [True, False, True])
+        self.assertEqual([i_path.with_suffix(".lock").exists() for i_path in paths], [True, False, True])
+
+    def test_busy_lock_file_is_kept_and_replaced_after_removal(self):
+        path = get_thumbnail(self.ad.image_url, "small")
+        path.unlink()
+        lock_path = path.with_suffix(".lock")
+        # Пока блокировку держит загрузка, файл не удаляется
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            evict_cache(10 ** 9)
+            self.assertTrue(lock_path.exists())
+        evict_cache(10 ** 9)
+        self.assertFalse(lock_path.exists())
+        self.assertEqual(get_thumbnail(self.ad.image_url, "small"), path)
+        self.assertEqual(len(ImageOriginHandler.hits), 2)
+
+    def test_slow_origin_is_cut_off_by_total_deadline(self):
+        # Каждое чтение укладывается в таймаут сокета, но вся загрузка - нет
+        ImageOriginHandler.trickle = 0.02
+        start = time.monotonic()
+        with override_settings(IMAGE_FETCH_TIMEOUT=0.5):
+            self.assertIsNone(get_thumbnail(self.ad.image_url, "small"))
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    @override_settings(IMAGE_CACHE_ACCEL_PREFIX="/image-cache/")
+    def test_cached_file_is_served_by_nginx(self):
+        response = self.client.get(self.ad.image_proxy_url)
+        path = get_thumbnail(self.ad.image_url, "large")
+        self.assertEqual(response["X-Accel-Redirect"], "/image-cache/" + f"{path.parent.name}/{path.name}")
+        self.assertEqual(response.content, b"")
+
+    def test_failures_are_remembered_and_private_hosts_rejected(self):
+        self.assertEqual(self.client.get(reverse("ads:ad_image", kwargs={"pk": self.ad.id, "size": "huge"})).status_code, 404)
+        Ad.objects.filter(pk=self.ad.id).update(image_url=self.origin_url + "/missing.png")
+        url = reverse("ads:ad_image", kwargs={"pk": self.ad.id, "size": "small"})
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(len(ImageOriginHandler.hits), 1)
+        with override_settings(IMAGE_PROXY_ALLOW_PRIVATE=False):
+            self.assertIsNone(get_thumbnail(self.origin_url + "/photo.png?private", "small"))
+        self.assertEqual(len(ImageOriginHandler.hits), 1)
+
+    def test_connection_uses_checked_address(self):
+        # Второй ответ DNS (rebinding) указывает во внутреннюю сеть: подключение идет к проверенному адресу
+        port = self.origin.server_address[1]
+        answers = ["93.184.216.34", "127.0.0.1"]
+        resolved = []
+        connected = []
+        system_getaddrinfo = socket.getaddrinfo
+        system_create_connection = socket.create_connection
+
+        def getaddrinfo(host, *args, **kwargs):
+            if host != "images.test":
+                return system_getaddrinfo(host, *args, **kwargs)
+            resolved.append(answers.pop(0))
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (resolved[-1], port))]
+
+        def create_connection(address, *args, **kwargs):
+            connected.append(address)
+            if address[0] != "127.0.0.1":
+                raise ConnectionRefusedError
+            return system_create_connection(address, *args, **kwargs)
+
+        url = f"http://images.test:{port}/photo.png"
+        with patch("socket.getaddrinfo", getaddrinfo), patch("socket.create_connection", create_connection):
+            with override_settings(IMAGE_PROXY_ALLOW_PRIVATE=False):
+                self.assertIsNone(get_thumbnail(url, "small"))
+            self.assertEqual(resolved, ["93.184.216.34"])
+            self.assertEqual(connected, [("93.184.216.34", port)])
+
+            self.assertIsNotNone(get_thumbnail(url, "large"))
+        self.assertEqual(ImageOriginHandler.hosts, [f"images.test:{port}"])
+
+
+class TestPrerender(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        prerender_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(prerender_dir.cleanup)
+        settings_override = override_settings(PRERENDER_DIR=prerender_dir.name, AD_VIEWS_FLUSH_INTERVAL=3600)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.root = Path(prerender_dir.name) / "ads"
+        self.user = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.category = get_category("Спорт")
+        ad_data = {"user": self.user, "description": "Test ad description", "condition": get_condition("Б/у")}
+        start = timezone.now() - timedelta(days=1)
+        self.ads = []
+        for i_number in range(20):
+            ad = Ad.objects.create(title=f"Вещь {i_number}", category=self.category, **ad_data)
+            Ad.objects.filter(pk=ad.id).update(created_at=start + timedelta(minutes=i_number))
+            self.ads.append(ad)
+        self.other = Ad.objects.create(title="Книга", category=get_category("Книги"), **ad_data)
+        ad_views.pending.clear()
+
+    def get_written(self):
+        return sorted(
+            i_path.relative_to(self.root).as_posix() for i_path in self.root.rglob("*.html") if i_path.stat().st_mtime > 0
+        )
+
+    def age_files(self):
+        for i_path in self.root.rglob("*.html"):
+            os.utime(i_path, (0, 0))
+
+    def test_full_render_writes_catalogue_and_detail_pages(self):
+        prerender_all()
+        category_dir = f"category-{self.category.id}"
+        self.assertTrue({"page-1.html", "page-2.html", f"{category_dir}/page-2.html"} <= set(self.get_written()))
+        self.assertIn("Вещь 19", (self.root / "page-1.html").read_text())
+        detail = (self.root / str(self.ads[0].id) / "index.html").read_text()
+        self.assertIn("Вещь 0", detail)
+        self.assertIn(reverse("ads:ad_view", kwargs={"pk": self.ads[0].id}), detail)
+        self.assertFalse(ad_views.pending)
+
+    def test_edit_rerenders_only_pages_showing_the_ad(self):
+        prerender_all()
+        self.age_files()
+        oldest = Ad.objects.get(pk=self.ads[0].id)
+        oldest.title = "Старый велосипед"
+        oldest.save()
+        update_prerendered()
+        category_dir = f"category-{self.category.id}"
+        self.assertEqual(self.get_written(), [f"{oldest.id}/index.html", f"{category_dir}/page-2.html", "page-2.html"])
+        self.assertIn("Старый велосипед", (self.root / "page-2.html").read_text())
+
+    def test_new_and_deleted_ads_shift_listings(self):
+        prerender_all()
+        self.age_files()
+        # Страницы обновляются по событию soft_deleted, не дожидаясь окончательного удаления задачей
+        soft_delete_ad(Ad.all_objects.get(pk=self.other.id))
+        update_prerendered()
+        self.assertFalse((self.root / str(self.other.id)).joinpath("index.html").exists())
+        self.assertEqual(self.get_written(), [f"category-{self.other.category_id}/page-1.html", "page-1.html", "page-2.html"])
+
+        self.age_files()
+        newest = Ad.objects.create(
+            user=self.user, title="Новая вещь", description="Test ad description", category=self.category,
+            condition=get_condition("Б/у"),
+        )
+        update_prerendered()
+        category_dir = f"category-{self.category.id}"
+        self.assertEqual(
+            self.get_written(),
+            [f"{newest.id}/index.html", f"{category_dir}/page-1.html", f"{category_dir}/page-2.html", "page-1.html", "page-2.html"],
+        )
+
+    def test_prerendered_page_reports_view(self):
+        response = self.client.post(reverse("ads:ad_view", kwargs={"pk": self.ads[0].id}))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(ad_views.pending[self.ads[0].id], 1)
+
+    def test_view_report_for_unknown_or_deleted_ad_is_not_counted(self):
+        soft_delete_ad(Ad.all_objects.get(pk=self.other.id))
+        for i_ad_id in [self.other.id, 999999]:
+            response = self.client.post(reverse("ads:ad_view", kwargs={"pk": i_ad_id}))
+            self.assertEqual(response.status_code, 404)
+        self.assertFalse(ad_views.pending)
+
+    @override_settings(AD_VIEWS_RATE_LIMIT=2)
+    def test_view_reports_are_limited_per_ip(self):
+        url = reverse("ads:ad_view", kwargs={"pk": self.ads[0].id})
+        # Начало X-Forwarded-For задает клиент, и его смена лимит не обходит
+        statuses = [
+            self.client.post(url, headers={"X-Forwarded-For": f"10.0.0.{i_index}, 192.0.2.7"}).status_code
+            for i_index in range(3)
+        ]
+        self.assertEqual(statuses, [204, 204, 429])
+        self.assertEqual(self.client.post(url, headers={"X-Forwarded-For": "192.0.2.8"}).status_code, 204)
+        self.assertEqual(ad_views.pending[self.ads[0].id], 3)
+
+
+def normalize_html(content):
+    # Движки по-разному экранируют апостроф и расставляют пробелы вокруг тегов, CSRF-токен маскируется заново
+    text = content.decode().replace("&#39;", "&#x27;")
+    text = re.sub(r'name="csrfmiddlewaretoken" value="\w+"', 'name="csrfmiddlewaretoken"', text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class TestJinja2Templates(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.other_user = User.objects.create_user(username="test_user_2", password="test_user_password")
+        condition = get_condition("Б/у")
+        for i_number in range(20):
+            category = get_category("Спорт" if i_number % 2 else "Книги")
+            Ad.objects.create(
+                user=self.user if i_number % 3 else self.other_user, title=f"Вещь <{i_number}> 'с кавычками'",
+                description="Test ad description", category=category, condition=condition,
+            )
+        ads = list(Ad.objects.order_by("id"))
+        ExchangeProposal.objects.create(ad_sender=ads[1], ad_receiver=ads[0], comment="Обмен")
+        ExchangeProposal.objects.create(ad_sender=ads[3], ad_receiver=ads[4], comment="Обмен")
+        ad_views.pending.clear()
+
+    def get_both(self, url, params=None, method="get"):
+        # Одна и та же страница через представление с каждым из движков ADS_TEMPLATE_ENGINE
+        pages = []
+        for i_engine in ["django", "jinja2"]:
+            with self.settings(ADS_TEMPLATE_ENGINE=i_engine):
+                response = getattr(self.client, method)(url, params)
+            self.assertEqual(response.status_code, 200)
+            pages.append(normalize_html(response.content))
+        return pages
+
+    def test_ads_list_matches_django_templates(self):
+        category = get_category("Спорт")
+        for i_params in [{}, {"page": 2}, {"category": category.id, "ordering": "title"}, {"search": "Вещь"}]:
+            django_html, jinja_html = self.get_both(reverse("ads:ads"), i_params)
+            self.assertIn("Вещь", jinja_html)
+            self.assertEqual(jinja_html, django_html)
+
+    def test_ads_list_for_owner_matches_django_templates(self):
+        self.client.login(username="test_user_1", password="test_user_password")
+        django_html, jinja_html = self.get_both(reverse("ads:ads"), {"condition": get_condition("Б/у").id})
+        self.assertIn("csrfmiddlewaretoken", jinja_html)
+        self.assertEqual(jinja_html, django_html)
+
+    def test_exchange_list_matches_django_templates(self):
+        self.client.login(username="test_user_1", password="test_user_password")
+        for i_params in [{}, {"is_sender": "sender"}, {"status": "waiting", "ordering": "created_at"}]:
+            django_html, jinja_html = self.get_both(reverse("ads:exchanges"), i_params)
+            self.assertIn("Статус:", jinja_html)
+            self.assertEqual(jinja_html, django_html)
+
+    def test_other_pages_match_django_templates(self):
+        self.client.login(username="test_user_1", password="test_user_password")
+        own_ad, other_ad = Ad.objects.filter(user=self.user).first(), Ad.objects.filter(user=self.other_user).first()
+        exchange = get_exchanges()[0]
+        SavedSearch.objects.create(user=self.user, search="вещь", category=get_category("Спорт"))
+        ArchivedExchangeProposal.objects.create(
+            id=exchange.id + 100, ad_sender_id=own_ad.id, ad_receiver_id=other_ad.id, ad_sender_title="Старая вещь",
+            ad_receiver_title="Другая вещь", sender_user_id=self.user.id, receiver_user_id=self.other_user.id,
+            comment="Архив", status=ExchangeStatus.ACCEPTED, created_at=timezone.now(), closed_at=timezone.now(),
+        )
+        urls = [
+            reverse("home"), reverse("ads:ad_detail", args=[own_ad.id]), reverse("ads:ad_detail", args=[other_ad.id]),
+            reverse("ads:new_ad"), reverse("ads:ad_edit", args=[own_ad.id]), reverse("ads:ad_delete", args=[own_ad.id]),
+            reverse("ads:saved_searches"), reverse("ads:exchange_archive"), reverse("ads:new_exchange"),
+            reverse("ads:new_exchange", args=[other_ad.id]), reverse("ads:exchange_batch"),
+            reverse("ads:exchange_detail", args=[exchange.id]), reverse("ads:exchange_edit", args=[exchange.id]),
+            reverse("ads:exchange_delete", args=[exchange.id]),
+        ]
+        with self.settings(AD_VIEWS_FLUSH_INTERVAL=3600):
+            for i_url in urls:
+                django_html, jinja_html = self.get_both(i_url)
+                self.assertEqual(jinja_html, django_html, i_url)
+
+    def test_form_errors_match_django_templates(self):
+        self.client.login(username="test_user_1", password="test_user_password")
+        other_ad = Ad.objects.filter(user=self.other_user).first()
+        forms = [
+            (reverse("ads:new_ad"), {"title": ""}),
+            (reverse("ads:new_exchange"), {"ad_sender": other_ad.id, "ad_receiver": other_ad.id, "comment": ""}),
+            (reverse("ads:exchange_batch"), {"ad_receivers": "999", "comment": "Batch"}),
+        ]
+        for i_url, i_data in forms:
+            django_html, jinja_html = self.get_both(i_url, i_data, method="post")
+            self.assertIn("ad-error", jinja_html)
+            self.assertEqual(jinja_html, django_html, i_url)
+
+    def test_anonymous_home_matches_django_templates(self):
+        django_html, jinja_html = self.get_both(reverse("home"))
+        self.assertIn("Авторизация", jinja_html)
+        self.assertEqual(jinja_html, django_html)
+
+    def test_bench_command(self):
+        out = StringIO()
+        call_command("bench_templates", repeat=2, user="test_user_1", stdout=out)
+        self.assertIn("ads:exchanges [jinja2]", out.getvalue())
+
+
+@override_settings(EXCHANGE_SHARDS=2)
+class TestExchangeShards(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        # У пользователя 1 самый большой id: его пары лежат в шардах собеседников, а они в разных шардах
+        users = [
+            User.objects.create_user(username=f"test_user_{i_number}", password="test_user_password") for i_number in range(8)
+        ]
+        self.user_1, self.user_2 = users[-1], users[0]
+        self.user_3 = next(i_user for i_user in users[1:-1] if get_user_shard(i_user.pk) != get_user_shard(self.user_2.pk))
+        self.shard_2, self.shard_3 = get_user_shard(self.user_2.pk), get_user_shard(self.user_3.pk)
+        ad_data = {"description": "Test ad description", "category": get_category("Спорт"), "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", **ad_data)
+        self.ad_3 = Ad.objects.create(user=self.user_3, title="Ролики", **ad_data)
+
+    def get_shard_ids(self, alias):
+        return set(ExchangeProposal.all_objects.using(alias).values_list("id", flat=True))
+
+    def test_proposal_is_stored_in_pair_shard(self):
+        exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        self.assertEqual(exchange._state.db, self.shard_2)
+        self.assertEqual(get_pair_shard(self.user_2.pk, self.user_1.pk), self.shard_2)
+        self.assertEqual(self.get_shard_ids(self.shard_2), {exchange.id})
+        self.assertEqual(self.get_shard_ids(self.shard_3), set())
+        self.assertEqual(exchange.id >> SHARD_ID_BITS, get_shard_index(self.shard_2))
+        self.assertEqual((exchange.sender_user_id, exchange.receiver_user_id), (self.user_1.pk, self.user_2.pk))
+        self.assertEqual(OutboxEvent.objects.get(model="exchangeproposal", object_id=exchange.id).kind, "created")
+
+    def test_reversed_pair_is_blocked_by_unique_index(self):
+        ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        # Без проверки формы: встречную пару останавливает уникальный индекс того же шарда
+        with self.assertRaises(IntegrityError), transaction.atomic(using=self.shard_2):
+            ExchangeProposal.objects.create(ad_sender=self.ad_2, ad_receiver=self.ad_1, comment="Reverse")
+        self.client.force_login(self.user_2)
+        form_data = {"ad_sender": self.ad_2.id, "ad_receiver": self.ad_1.id, "comment": "Reverse"}
+        response = self.client.post(reverse("ads:new_exchange"), form_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["form"].has_error("ad_sender"))
+
+    def test_list_merges_shards(self):
+        incoming = ExchangeProposal.objects.create(ad_sender=self.ad_3, ad_receiver=self.ad_1, comment="Incoming")
+        outgoing = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Outgoing")
+        self.assertEqual((incoming._state.db, outgoing._state.db), (self.shard_3, self.shard_2))
+        self.client.force_login(self.user_1)
+        response = self.client.get(reverse("ads:exchanges"), {"is_sender": "receiver"})
+        self.assertEqual(list(response.context["exchanges_list"]), [incoming])
+        response = self.client.get(reverse("ads:exchanges"))
+        self.assertEqual(list(response.context["exchanges_list"]), [outgoing, incoming])
+        response = self.client.get(reverse("ads:exchanges"), {"ordering": "created_at"})
+        self.assertEqual(list(response.context["exchanges_list"]), [incoming, outgoing])
+        self.assertEqual(response.context["paginator"].count, 2)
+
+    def test_detail_view_finds_proposal_in_other_shard(self):
+        exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        self.client.force_login(self.user_1)
+        response = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": exchange.id}))
+        self.assertEqual(response.context["exchange_proposal"], exchange)
+        response = self.client.get(reverse("ads:exchange_detail", kwargs={"pk": exchange.id + 1}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_counter_proposal_stays_in_pair_shard(self):
+        exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        exchange.set_status("rejected")
+        self.client.force_login(self.user_2)
+        url = reverse("ads:exchange_detail", kwargs={"pk": exchange.id})
+        response = self.client.post(url, {"set-status-button": "recreate", "version": 1})
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        recreated = ExchangeProposal.objects.using(self.shard_2).get(pk=exchange.id)
+        self.assertEqual((recreated.ad_sender, recreated.ad_receiver, recreated.status_key), (self.ad_2, self.ad_1, "waiting"))
+        self.assertEqual(recreated.version, 2)
+        self.assertEqual(OutboxEvent.objects.filter(model="exchangeproposal", object_id=exchange.id).last().kind, "status")
+        summary = UserSummary.objects.get(pk=self.user_1.pk)
+        self.assertEqual((summary.outgoing_rejected, summary.incoming_waiting), (0, 1))
+        self.assertEqual(rebuild_user_summary(self.user_1.pk).incoming_waiting, 1)
+
+    def test_redirected_proposal_moves_to_new_pair_shard_with_same_id(self):
+        exchange = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        exchange.ad_receiver = self.ad_3
+        exchange.save()
+        self.assertEqual(exchange._state.db, self.shard_3)
+        self.assertEqual(self.get_shard_ids(self.shard_2), set())
+        self.assertEqual(ExchangeProposal.objects.using(self.shard_3).get(pk=exchange.id).ad_receiver, self.ad_3)
+        self.assertEqual(OutboxEvent.objects.filter(model="exchangeproposal", object_id=exchange.id).last().kind, "updated")
+
+    def test_batch_writes_each_pair_to_pair_shard(self):
+        self.client.force_login(self.user_1)
+        ExchangeProposal.objects.create(ad_sender=self.ad_3, ad_receiver=self.ad_1, comment="Reverse")
+        form_data = {"ad_senders": [self.ad_1.id], "ad_receivers": f"{self.ad_2.id} {self.ad_3.id}", "comment": "Batch"}
+        response = self.client.post(reverse("ads:exchange_batch"), form_data)
+        results = {i_result["ad_receiver_id"]: i_result["result"] for i_result in response.context["results"]}
+        self.assertEqual(results, {self.ad_2.id: "created", self.ad_3.id: "exists"})
+        created = ExchangeProposal.objects.using(self.shard_2).get(comment="Batch")
+        self.assertEqual(created.ad_receiver, self.ad_2)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).incoming_waiting, 1)
+
+    def test_deleting_ads_removes_proposals_from_every_shard(self):
+        first = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        ExchangeProposal.objects.create(ad_sender=self.ad_3, ad_receiver=self.ad_1, comment="Test")
+        soft_delete_ad(self.ad_1)
+        self.assertTrue(ExchangeProposal.all_objects.using(self.shard_2).get(pk=first.id).deleted_at)
+        self.assertEqual(UserSummary.objects.get(pk=self.user_2.pk).incoming_waiting, 0)
+        run_pending_tasks()
+        self.assertEqual(self.get_shard_ids(self.shard_2) | self.get_shard_ids(self.shard_3), set())
+
+        ExchangeProposal.objects.create(ad_sender=self.ad_3, ad_receiver=self.ad_2, comment="Test")
+        self.ad_2.delete()
+        self.assertEqual(self.get_shard_ids(self.shard_2) | self.get_shard_ids(self.shard_3), set())
+
+    def test_archive_moves_closed_proposals_from_every_shard(self):
+        first = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        second = ExchangeProposal.objects.create(ad_sender=self.ad_3, ad_receiver=self.ad_1, comment="Test")
+        for i_exchange in (first, second):
+            i_exchange.set_status("accepted")
+            ExchangeProposal.objects.using(i_exchange._state.db).filter(pk=i_exchange.id).update(
+                closed_at=timezone.now() - timedelta(days=60)
+            )
+        self.assertEqual(archive_proposals(older_than_days=30), 2)
+        archived = ArchivedExchangeProposal.objects.get(pk=first.id)
+        self.assertEqual((archived.ad_receiver_title, archived.receiver_user_id), ("Самокат", self.user_2.pk))
+        self.assertEqual(ArchivedExchangeProposal.objects.count(), 2)
+
+    def test_rebalance_moves_proposals_placed_by_receiver(self):
+        # До правила пар предложение лежало в шарде получателя
+        exchange = ExchangeProposal(ad_sender=self.ad_2, ad_receiver=self.ad_3, comment="Old")
+        exchange.set_user_ids()
+        ExchangeProposal.objects.using(self.shard_3).bulk_create([exchange])
+        out = StringIO()
+        call_command("rebalance_shards", stdout=out)
+        self.assertIn("Перенесено предложений: 1", out.getvalue())
+        self.assertEqual(self.get_shard_ids(self.shard_2), {exchange.id})
+        self.assertEqual(self.get_shard_ids(self.shard_3), set())
+
+    def test_unrouted_query_fails_loudly(self):
+        ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        with self.assertRaises(ShardNotSelectedError):
+            ExchangeProposal.objects.count()
+        with self.assertRaises(ShardNotSelectedError):
+            list(ExchangeProposal.all_objects.filter(ad_sender=self.ad_1))
+
+
+class TestRollups(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.user_1 = User.objects.create_user(username="test_user_1", password="test_user_password")
+        self.user_2 = User.objects.create_user(username="test_user_2", password="test_user_password")
+        self.sport = get_category("Спорт")
+        self.books = get_category("Книги")
+        ad_data = {"description": "Test ad description", "condition": get_condition("Б/у")}
+        self.ad_1 = Ad.objects.create(user=self.user_1, title="Велосипед", category=self.sport, **ad_data)
+        self.ad_2 = Ad.objects.create(user=self.user_2, title="Самокат", category=self.sport, **ad_data)
+        self.ad_3 = Ad.objects.create(user=self.user_2, title="Книга", category=self.books, **ad_data)
+        accepted = ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_2, comment="Test")
+        accepted.created_at = timezone.now() - timedelta(hours=2)
+        accepted.set_status("accepted")
+        ExchangeProposal.objects.create(ad_sender=self.ad_1, ad_receiver=self.ad_3, comment="Test").set_status("rejected")
+
+    def test_rollups_count_each_event_once(self):
+        self.assertEqual(update_rollups(batch_size=2), 7)
+        ads_created = AdRollup.objects.filter(period=RollupPeriod.DAY).values_list("category_id", "ads_created")
+        self.assertEqual(dict(ads_created), {self.sport.id: 2, self.books.id: 1})
+        rollup = ExchangeRollup.objects.get(period=RollupPeriod.DAY)
+        self.assertEqual(rollup.start, get_period_start(timezone.now(), RollupPeriod.DAY))
+        self.assertEqual((rollup.proposals_created, rollup.proposals_accepted, rollup.proposals_rejected), (2, 1, 1))
+        self.assertTrue(6000 < get_histogram_median(rollup.accept_histogram) < 8000)
+        self.assertEqual(sum(ExchangeRollup.objects.filter(period=RollupPeriod.HOUR).values_list("proposals_created", flat=True)), 2)
+
+        # Повторный запуск продолжает с водяного знака и учитывает только новые события
+        self.assertEqual(update_rollups(), 0)
+        Ad.objects.create(user=self.user_1, title="Словарь", category=self.books, description="Test", condition=self.ad_1.condition)
+        self.assertEqual(update_rollups(), 1)
+        self.assertEqual(AdRollup.objects.get(period=RollupPeriod.DAY, category_id=self.books.id).ads_created, 2)
+
+    def test_legacy_payloads_are_counted(self):
+        update_rollups()
+        created_at = timezone.now() - timedelta(hours=1)
+        for i_status in ["accepted", "rejected"]:
+            OutboxEvent.objects.create(
+                model="exchangeproposal",
+                object_id=self.ad_1.id,
+                kind="status",
+                payload={
+                    "fields": {"status": i_status, "created_at": created_at, "closed_at": timezone.now()},
+                    "changes": {"status": ["waiting", i_status]},
+                },
+            )
+        # Событие объявления до справочника категорий: вместо ключа название
+        OutboxEvent.objects.create(
+            model="ad", object_id=self.ad_1.id, kind="created", payload={"fields": {"category": "Книги"}}
+        )
+        self.assertEqual(update_rollups(), 3)
+        self.assertEqual(AdRollup.objects.get(period=RollupPeriod.DAY, category_id=self.books.id).ads_created, 2)
+        rollup = ExchangeRollup.objects.get(period=RollupPeriod.DAY)
+        self.assertEqual((rollup.proposals_accepted, rollup.proposals_rejected), (2, 2))
+        self.assertEqual(sum(rollup.accept_histogram.values()), 2)
+
+    def test_histogram_median_is_close_to_exact_and_mergeable(self):
+        durations = [90, 300, 1800, 7200, 86400]
+        histogram = Counter(str(get_histogram_bucket(i_seconds)) for i_seconds in durations)
+        median = get_histogram_median(histogram)
+        self.assertAlmostEqual(median, 1800, delta=1800 * 0.19)
+        halves = [Counter(str(get_histogram_bucket(i_seconds)) for i_seconds in i_part) for i_part in (durations[:2], durations[2:])]
+        self.assertEqual(get_histogram_median(merge_histograms(halves)), median)
+        self.assertIsNone(get_histogram_median({}))
+        self.assertEqual(format_duration(median), "29 мин")
+
+    def test_dashboard_reads_only_rollups(self):
+        update_rollups()
+        self.client.force_login(User.objects.create_superuser(username="admin", password="test_user_password"))
+        with CaptureQueriesContext(connections["default"]) as queries:
+            response = self.client.get(reverse("admin:ads_exchangerollup_changelist"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([i_query["sql"] for i_query in queries if re.search(r'"ads_(ad|exchangeproposal)"', i_query["sql"])], [])
+        self.assertEqual(response.context["totals"]["proposals_accepted"], 1)
+        self.assertEqual(response.context["categories"], [("Спорт", 2), ("Книги", 1)])
+        self.assertContains(response, "1 ч 5")
+
+        response = self.client.get(reverse("admin:ads_exchangerollup_changelist"), {"period": "hour"})
+        self.assertEqual(response.context["period"], RollupPeriod.HOUR)
+        self.assertEqual(response.context["totals"]["proposals_created"], 2)
+
+    def test_exported_columns_are_analyzed_with_numpy(self):
+        with tempfile.TemporaryDirectory() as columns_dir:
+            path = str(Path(columns_dir) / "columns.npz")
+            call_command("export_columns", path, "--chunk-size", "2", stdout=StringIO())
+            tables = load_columns(path)
+            out = StringIO()
+            call_command("analyze_columns", path, stdout=out)
+        self.assertEqual(sorted(tables["ads"]["id"]), [self.ad_1.id, self.ad_2.id, self.ad_3.id])
+        self.assertEqual(len(tables["proposals"]["id"]), 2)
+        stats = get_category_stats(tables)
+        self.assertEqual([stats[self.sport.id][i_name] for i_name in ["ads", "proposals", "accepted", "rejected"]], [2, 1, 1, 0])
+        self.assertAlmostEqual(stats[self.sport.id]["accept_median"], 7200, delta=5)
+        self.assertEqual(stats[self.books.id]["rejected"], 1)
+        self.assertIsNone(stats[self.books.id]["accept_median"])
+        self.assertIn("Спорт: объявлений 2, предложений 1, принято 1, отклонено 0, доля принятых 100%", out.getvalue())
+
+
+def add_two_shard_variants(test_classes):
+    # Классы, которые работают с предложениями, прогоняются еще раз с двумя шардами: запрос без выбора шарда
+    # в коде тогда падает с ShardNotSelectedError, а не читает молча одну основную базу
+    for i_test_class in test_classes:
+        name = f"{i_test_class.__name__}TwoShards"
+        globals()[name] = override_settings(EXCHANGE_SHARDS=2)(type(name, (i_test_class,), {}))
+
+
+add_two_shard_variants([
+    TestExchangeProposal, TestOutbox, TestPurge, TestArchive, TestUserSummary, TestVersions, TestRequestLoaders,
+    TestOwnAdsPicker, TestBatchExchangeProposals, TestUnorderedPairs, TestExchangeEvents, TestRollups,
+    TestJinja2Templates,
+])
@@ -0,0 +1,85 @@
+import re
+
+word_pattern = re.compile(r"\w+")
+cyrillic_pattern = re.compile(r"[а-я]")
+latin_pattern = re.compile(r"^[a-z]+$")
+
+# Окончания существительных, прилагательных и глаголов, от длинных к коротким
+RUSSIAN_ENDINGS = sorted(
+    [
+        "иями", "ями", "ами", "иях", "ого", "его", "ому", "ему", "ыми", "ими", "ешь", "ишь", "ете", "ите", "ать",
+        "ять", "ить", "еть", "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ую", "юю",
+        "ов", "ев", "ей", "ам", "ям", "ах", "ях", "ом", "ем", "ию", "ия", "ть", "ь", "а", "я", "о", "е", "и", "ы",
+        "у", "ю", "й",
+    ],
+    key=len,
+    reverse=True,
+)
+REFLEXIVE_ENDINGS = ("ся", "сь")
+MIN_STEM_LENGTH = 3
+# Ключ сохраненного поиска - транслитерированное начало слова: латинский запрос, его транслитерация
+# и начало слова попадают на один ключ со словом объявления
+INDEX_KEY_LENGTH = 3
+
+TRANSLITERATION = [
+    ("shch", "щ"), ("sch", "щ"), ("yo", "е"), ("zh", "ж"), ("kh", "х"), ("ts", "ц"), ("ch", "ч"), ("sh", "ш"),
+    ("yu", "ю"), ("ya", "я"), ("ye", "е"), ("yi", "ый"), ("yy", "ый"), ("iy", "ий"), ("a", "а"), ("b", "б"), ("v", "в"), ("g", "г"), ("d", "д"), ("e", "е"),
+    ("z", "з"), ("i", "и"), ("y", "ы"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"), ("p", "п"),
+    ("r", "р"), ("s", "с"), ("t", "т"), ("u", "у"), ("f", "ф"), ("h", "х"), ("c", "к"), ("w", "в"), ("x", "кс"),
+    ("j", "й"), ("q", "к"),
+]
+transliteration_pattern = re.compile("|".join(i_latin for i_latin, _ in TRANSLITERATION))
+transliteration_map = dict(TRANSLITERATION)
+
+
+def normalize(text):
+    return text.casefold().replace("ё", "е")
+
+
+def tokenize(text):
+    return word_pattern.findall(normalize(text))
+
+
+def stem(term):
+    # Облегченный стеммер: отрезается одно окончание, если остается основа не короче MIN_STEM_LENGTH
+    if not cyrillic_pattern.search(term):
+        return term
+    for i_ending in REFLEXIVE_ENDINGS:
+        if term.endswith(i_ending) and len(term) - len(i_ending) >= MIN_STEM_LENGTH:
+            term = term[:-len(i_ending)]
+            break
+    for i_ending in RUSSIAN_ENDINGS:
+        if term.endswith(i_ending) and len(term) - len(i_ending) >= MIN_STEM_LENGTH:
+            term = term[:-len(i_ending)]
+            break
+    if term.endswith("ь") and len(term) > MIN_STEM_LENGTH:
+        term = term[:-1]
+    return term
+
+
+def transliterate(term):
+    return transliteration_pattern.sub(lambda i_match: transliteration_map[i_match.group()], term)
+
+
+def get_search_terms(text):
+    return [stem(i_term) for i_term in tokenize(text)]
+
+
+def get_query_variants(text):
+    # Для каждого слова запроса: основа и, для латиницы, основа транслитерации ("velosiped" -> "велосипед")
+    variants = []
+    for i_term in tokenize(text):
+        term_variants = {stem(i_term)}
+        if latin_pattern.match(i_term):
+            term_variants.add(stem(transliterate(i_term)))
+        variants.append(term_variants)
+    return variants
+
+
+def get_index_key(term):
+    return transliterate(term[:INDEX_KEY_LENGTH])
+
+
+def get_term_index_keys(term):
+    # Все ключи, под которыми слово объявления может найтись: начало запроса бывает короче INDEX_KEY_LENGTH
+    return {transliterate(term[:i_length]) for i_length in range(1, INDEX_KEY_LENGTH + 1)}
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from . import views
+from . import api, views
 
 app_name = "ads"
 urlpatterns = [
@@ -8,13 +8,25 @@ urlpatterns = [
     path("new_ad/", views.CreateAdView.as_view(), name="new_ad"),
     path("new_ad/confirmation/", views.AdConfirmationView.as_view(), name="ad_confirmation"),
     path("<int:pk>/", views.AdDetailView.as_view(), name="ad_detail"),
+    path("<int:pk>/view/", views.AdViewHitView.as_view(), name="ad_view"),
+    path("<int:pk>/image/<str:size>/", views.AdImageView.as_view(), name="ad_image"),
     path("edit/<int:pk>/", views.AdEditView.as_view(), name="ad_edit"),
     path("delete/<int:pk>/", views.AdDeleteView.as_view(), name="ad_delete"),
+    path("searches/", views.SavedSearchListView.as_view(), name="saved_searches"),
+    path("searches/new/", views.SavedSearchCreateView.as_view(), name="new_saved_search"),
+    path("searches/delete/<int:pk>/", views.SavedSearchDeleteView.as_view(), name="saved_search_delete"),
     path("exchange/", views.ExchangeProposalListView.as_view(), name="exchanges"),
+    path("exchange/events/", views.ExchangeEventsView.as_view(), name="exchange_events"),
+    path("exchange/archive/", views.ExchangeProposalArchiveView.as_view(), name="exchange_archive"),
     path("exchange/<int:pk>/", views.ExchangeProposalDetailView.as_view(), name="exchange_detail"),
     path("exchange/new/<int:ad_id>", views.CreateExchangeProposalView.as_view(), name="new_exchange"),
     path("exchange/new/", views.CreateExchangeProposalView.as_view(), name="new_exchange"),
+    path("exchange/batch/", views.ExchangeProposalBatchView.as_view(), name="exchange_batch"),
     path("exchange/confirmation/", views.ExchangeProposalConfirmationView.as_view(), name="exchange_confirmation"),
     path("exchange/edit/<int:pk>/", views.ExchangeProposalEditView.as_view(), name="exchange_edit"),
     path("exchange/delete/<int:pk>/", views.ExchangeProposalDeleteView.as_view(), name="exchange_delete"),
+    path("api/ads/", api.AdsApiView.as_view(), name="api_ads"),
+    path("api/ads/<int:pk>/", api.AdDetailApiView.as_view(), name="api_ad_detail"),
+    path("api/changes/", api.ChangesApiView.as_view(), name="api_changes"),
+    path("api/suggest/", api.SuggestApiView.as_view(), name="api_suggest"),
 ]
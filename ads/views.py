@@ -1,70 +1,136 @@
 import re
 
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
 from django.shortcuts import get_object_or_404, redirect
 from django.views import generic
 from django.urls import reverse_lazy
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.db import IntegrityError, transaction
 from django.db.models import Q
-from django.http import HttpResponseRedirect
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 
-from .forms import NewAdForm, NewExchangeProposalForm
-from .models import Ad, ExchangeProposal
+from .archive import get_user_archive
+from .batch import BATCH_RESULTS, create_proposals
+from .counters import ad_views, allow_view_hit, get_client_ip
+from .dedupe import index_ad
+from .filters import filter_ads, get_ads_ordering, get_catalogue_ads
+from .forms import BatchExchangeProposalForm, NewAdForm, NewExchangeProposalForm, SavedSearchForm
+from .images import THUMBNAIL_CONTENT_TYPE, THUMBNAIL_SIZES, get_thumbnail, get_url_version
+from .models import Ad, Category, Condition, ExchangeProposal, SavedSearch, SavedSearchMatch, VersionConflictError
+from .notifications import stream_events
+from .purge import soft_delete_ad
+from .shards import MergedQuerySets, get_lookup_shards, get_shard_aliases
+from .similar import get_similar_ads
+from .summary import get_user_summary
+from .tasks import enqueue
 
 
-class HomeView(generic.TemplateView):
+def get_model_fields(model, tmp_data):
+    return {model._meta.get_field(i_key).attname: i_value for i_key, i_value in tmp_data.items()}
+
+
+def get_tmp_ad_fields(tmp_ad_data):
+    # В сессии справочники хранятся по id: category -> category_id
+    return get_model_fields(Ad, tmp_ad_data)
+
+
+def get_tmp_exchange_fields(tmp_exchange_data):
+    # В сессии товары хранятся по id: ad_sender -> ad_sender_id
+    return get_model_fields(ExchangeProposal, tmp_exchange_data)
+
+
+def load_exchange_ads(request, exchange):
+    # Товары и их владельцы берутся из загрузчиков запроса, общих с формой
+    exchange.ad_sender, exchange.ad_receiver = request.loaders.load_ads([exchange.ad_sender_id, exchange.ad_receiver_id])
+    return exchange
+
+
+def get_exchange_or_404(pk):
+    for i_alias in get_lookup_shards(pk):
+        exchange = ExchangeProposal.objects.using(i_alias).filter(pk=pk).first()
+        if exchange is not None:
+            return exchange
+    raise Http404("Предложение обмена не найдено")
+
+
+class TemplateEngineMixin:
+    # Шаблоны ads есть для обоих движков, страницу рисует выбранный в ADS_TEMPLATE_ENGINE
+    @property
+    def template_engine(self):
+        return settings.ADS_TEMPLATE_ENGINE
+
+
+class VersionConflictMixin:
+    conflict_message = "Запись изменили, пока вы ее редактировали. Проверьте данные и отправьте форму еще раз."
+
+    def form_conflict(self, form, message=None):
+        # 409: форма показывается снова с введенными данными и актуальной версией записи
+        current_version = (
+            type(self.object).all_objects.using(self.object._state.db).filter(pk=self.object.pk)
+            .values_list("version", flat=True).first()
+        )
+        form.set_current_version(current_version or 0)
+        form.add_error(None, message or self.conflict_message)
+        return self.render_to_response(self.get_context_data(form=form), status=409)
+
+
+class HomeView(TemplateEngineMixin, generic.TemplateView):
     template_name = "ads/index.html"
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["summary"] = get_user_summary(self.request.user)
+        return context
+
 
-class AllAddsView(generic.ListView):
+class AllAddsView(TemplateEngineMixin, generic.ListView):
     page_pattern = re.compile(r"page=\d+&?")
     template_name = "ads/ads_list.html"
     context_object_name = "ads"
     paginate_by = 15
 
     def get_queryset(self):
-        ads_queryset = Ad.objects.all()
-
-        category = self.request.GET.get("category")
-        if category:
-            ads_queryset = ads_queryset.filter(category=category)
-
-        condition = self.request.GET.get("condition")
-        if condition:
-            ads_queryset = ads_queryset.filter(condition=condition)
-
-        ordering = self.request.GET.get("ordering", "-created_at")
-        if ordering in {"created_at", "-created_at", "title", "-title"}:
+        ads_queryset = get_catalogue_ads().select_related("category", "condition")
+        try:
+            ads_queryset = filter_ads(ads_queryset, self.request.GET)
+        except ValueError:
+            return Ad.objects.none()
+
+        ordering = get_ads_ordering(self.request.GET)
+        if ordering:
             ads_queryset = ads_queryset.order_by(ordering)
 
-        search = self.request.GET.get("search")
-        if search:
-            ads_queryset = ads_queryset.filter(
-                Q(title__contains=search) |
-                Q(category__contains=search) |
-                Q(description__contains=search)
-            )
-
         return ads_queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["categories_list"] = Ad.objects.values_list("category", flat=True).distinct()
-        context["conditions_list"] = Ad.objects.values_list("condition", flat=True).distinct()
+        context["categories_list"] = Category.objects.all()
+        context["conditions_list"] = Condition.objects.all()
         query_params = self.request.GET.urlencode()
         query_params = re.sub(self.page_pattern, "", query_params)
         context["current_params"] = query_params
         return context
 
 
-class CreateAdView(LoginRequiredMixin, generic.CreateView):
+class CreateAdView(LoginRequiredMixin, TemplateEngineMixin, generic.CreateView):
     model = Ad
     form_class = NewAdForm
     template_name = "ads/ad_form.html"
     login_url = reverse_lazy("users:login")
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs["user"] = self.request.user
+        return kwargs
+
     def form_valid(self, form):
-        self.request.session["tmp_ad_data"] = form.cleaned_data
+        self.request.session["tmp_ad_data"] = {
+            i_key: getattr(i_value, "pk", i_value) for i_key, i_value in form.cleaned_data.items()
+        }
         return redirect("ads:ad_confirmation")
 
     def dispatch(self, request, *args, **kwargs):
@@ -82,7 +148,7 @@ class CreateAdView(LoginRequiredMixin, generic.CreateView):
         return initial
 
 
-class AdConfirmationView(LoginRequiredMixin, generic.CreateView):
+class AdConfirmationView(LoginRequiredMixin, TemplateEngineMixin, generic.CreateView):
     model = Ad
     template_name = "ads/ad_detail.html"
     form_class = NewAdForm
@@ -93,7 +159,7 @@ class AdConfirmationView(LoginRequiredMixin, generic.CreateView):
         tmp_ad_data = self.request.session.get("tmp_ad_data")
         if not tmp_ad_data:
             raise PermissionDenied("Данные не найдены")
-        tmp_ad = Ad(user=self.request.user, **tmp_ad_data)
+        tmp_ad = Ad(user=self.request.user, **get_tmp_ad_fields(tmp_ad_data))
         tmp_ad.id = "___"
         context["ad"] = tmp_ad
         context["is_owner"] = tmp_ad.user == self.request.user
@@ -104,30 +170,81 @@ class AdConfirmationView(LoginRequiredMixin, generic.CreateView):
         tmp_ad_data = request.session.get("tmp_ad_data")
         if not tmp_ad_data:
             return redirect("ads:new_ad")
-        ad = Ad.objects.create(user=request.user, **tmp_ad_data)
+        with transaction.atomic():
+            ad = Ad.objects.create(user=request.user, **get_tmp_ad_fields(tmp_ad_data))
+            index_ad(ad)
+            enqueue("percolate_ad", ad_id=ad.id)
+            enqueue("refresh_similar_ads", ad_id=ad.id)
         return redirect("ads:ad_detail", pk=ad.id)
 
 
-class AdDetailView(generic.DetailView):
+class AdImageView(generic.View):
+    # Миниатюра внешнего изображения: загружается один раз, дальше отдается из кеша на диске
+    def get(self, request, pk, size):
+        if size not in THUMBNAIL_SIZES:
+            raise Http404("Неизвестный размер изображения")
+        image_url = Ad.objects.filter(pk=pk).values_list("image_url", flat=True).first()
+        if not image_url:
+            raise Http404("У объявления нет изображения")
+        path = get_thumbnail(image_url, size)
+        if path is None:
+            raise Http404("Изображение недоступно")
+        if settings.IMAGE_CACHE_ACCEL_PREFIX:
+            response = HttpResponse(content_type=THUMBNAIL_CONTENT_TYPE)
+            cache_path = path.relative_to(settings.IMAGE_CACHE_DIR).as_posix()
+            response["X-Accel-Redirect"] = settings.IMAGE_CACHE_ACCEL_PREFIX + cache_path
+        else:
+            try:
+                response = FileResponse(open(path, "rb"), content_type=THUMBNAIL_CONTENT_TYPE)
+            except FileNotFoundError:
+                raise Http404("Изображение недоступно")
+        # Адрес с актуальной версией не меняется, пока не изменится image_url
+        if request.GET.get("v") == get_url_version(image_url):
+            response["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response["Cache-Control"] = "public, max-age=300"
+        return response
+
+
+class AdDetailView(TemplateEngineMixin, generic.DetailView):
     model = Ad
     template_name = "ads/ad_detail.html"
     context_object_name = "ad"
+    # Заранее отрисованная страница не считает просмотр сама: его присылает браузер на ads:ad_view
+    count_view = True
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["user_have_ads"] = Ad.objects.filter(user=self.request.user).exists()
+        context["user_have_ads"] = get_user_summary(self.request.user).ads_count > 0
         context["is_owner"] = self.object.user == self.request.user
         context["is_confirmation"] = False
+        context["similar_ads"] = get_similar_ads(self.object)
+        context["is_prerendered"] = not self.count_view
 
         return context
 
     def get_object(self):
         pk=self.kwargs.get("pk")
-        ad = get_object_or_404(Ad, pk=pk)
+        ad = get_object_or_404(Ad.objects.select_related("category", "condition"), pk=pk)
+        if self.count_view:
+            ad_views.hit(ad.id)
         return ad
 
 
-class AdEditView(LoginRequiredMixin, generic.UpdateView):
+@method_decorator(csrf_exempt, name="dispatch")
+class AdViewHitView(generic.View):
+    # Просмотр страницы, которую отдал nginx: адрес без входа и CSRF, поэтому число просмотров с одного IP
+    # ограничено, а в счетчик попадают только существующие объявления (один запрос по первичному ключу)
+    def post(self, request, pk):
+        if not allow_view_hit(get_client_ip(request)):
+            return HttpResponse(status=429)
+        if not Ad.objects.filter(pk=pk).exists():
+            raise Http404("Объявление не найдено")
+        ad_views.hit(pk)
+        return HttpResponse(status=204)
+
+
+class AdEditView(LoginRequiredMixin, VersionConflictMixin, TemplateEngineMixin, generic.UpdateView):
     model = Ad
     template_name = "ads/ad_form.html"
     form_class = NewAdForm
@@ -146,11 +263,28 @@ class AdEditView(LoginRequiredMixin, generic.UpdateView):
         context["is_edit"] = True
         return context
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs["user"] = self.request.user
+        return kwargs
+
+    def form_valid(self, form):
+        try:
+            with transaction.atomic():
+                response = super().form_valid(form)
+                if {"title", "description"} & set(form.changed_data):
+                    index_ad(self.object)
+                if {"title", "description", "category"} & set(form.changed_data):
+                    enqueue("refresh_similar_ads", ad_id=self.object.id)
+        except VersionConflictError:
+            return self.form_conflict(form)
+        return response
+
     def get_success_url(self):
         return reverse_lazy("ads:ad_detail", kwargs={"pk": self.object.id})
 
 
-class AdDeleteView(LoginRequiredMixin, generic.DeleteView):
+class AdDeleteView(LoginRequiredMixin, TemplateEngineMixin, generic.DeleteView):
     model = Ad
     template_name = "ads/ad_detail.html"
     login_url = reverse_lazy("users:login")
@@ -170,8 +304,58 @@ class AdDeleteView(LoginRequiredMixin, generic.DeleteView):
     def get_success_url(self):
         return reverse_lazy("ads:ads")
 
+    def form_valid(self, form):
+        soft_delete_ad(self.object)
+        return HttpResponseRedirect(self.get_success_url())
+
+    def delete(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return self.form_valid(None)
+
+
+class SavedSearchListView(LoginRequiredMixin, TemplateEngineMixin, generic.ListView):
+    template_name = "ads/saved_searches.html"
+    context_object_name = "saved_searches"
+    login_url = reverse_lazy("users:login")
+
+    def get_queryset(self):
+        return SavedSearch.objects.filter(user=self.request.user).select_related("category", "condition").order_by("-created_at")
 
-class ExchangeProposalListView(LoginRequiredMixin, generic.ListView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["matches"] = SavedSearchMatch.objects.filter(
+            saved_search__user=self.request.user, ad__deleted_at__isnull=True
+        ).select_related("ad", "saved_search__category", "saved_search__condition").order_by("-created_at")[:50]
+        return context
+
+
+class SavedSearchCreateView(LoginRequiredMixin, TemplateEngineMixin, generic.CreateView):
+    model = SavedSearch
+    form_class = SavedSearchForm
+    template_name = "ads/saved_searches.html"
+    login_url = reverse_lazy("users:login")
+    success_url = reverse_lazy("ads:saved_searches")
+    http_method_names = ["post"]
+
+    def form_valid(self, form):
+        form.instance.user = self.request.user
+        return super().form_valid(form)
+
+    def form_invalid(self, form):
+        return redirect("ads:saved_searches")
+
+
+class SavedSearchDeleteView(LoginRequiredMixin, generic.DeleteView):
+    model = SavedSearch
+    login_url = reverse_lazy("users:login")
+    success_url = reverse_lazy("ads:saved_searches")
+    http_method_names = ["post"]
+
+    def get_queryset(self):
+        return SavedSearch.objects.filter(user=self.request.user)
+
+
+class ExchangeProposalListView(LoginRequiredMixin, TemplateEngineMixin, generic.ListView):
     page_pattern = re.compile(r"page=\d+&?")
     model = ExchangeProposal
     template_name = "ads/exchange_list.html"
@@ -181,7 +365,8 @@ class ExchangeProposalListView(LoginRequiredMixin, generic.ListView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["user_have_exchanges"] = Ad.objects.filter(user=self.request.user).exists()
+        context["summary"] = get_user_summary(self.request.user)
+        context["user_have_exchanges"] = context["summary"].ads_count > 0
         context["status_dict"] = ExchangeProposal.ALLOWED_STATUSES
         query_params = self.request.GET.urlencode()
         query_params = re.sub(self.page_pattern, "", query_params)
@@ -189,29 +374,72 @@ class ExchangeProposalListView(LoginRequiredMixin, generic.ListView):
         return context
 
     def get_queryset(self):
-
+        # Предложения пользователя лежат в шардах пар с каждым собеседником: список собирается из всех шардов
+        user_id = self.request.user.pk
         is_sender = self.request.GET.get("is_sender")
         if is_sender == "sender":
-            exchanges_queryset = ExchangeProposal.objects.filter(ad_sender__user=self.request.user).all()
+            user_filter = Q(sender_user_id=user_id)
         elif is_sender == "receiver":
-            exchanges_queryset = ExchangeProposal.objects.filter(ad_receiver__user=self.request.user).all()
+            user_filter = Q(receiver_user_id=user_id)
         else:
-            exchanges_queryset = ExchangeProposal.objects.filter(
-                Q(ad_sender__user=self.request.user) | Q(ad_receiver__user=self.request.user)
-            ).all()
+            user_filter = Q(sender_user_id=user_id) | Q(receiver_user_id=user_id)
 
         status = self.request.GET.get("status")
-        if status:
-            exchanges_queryset = exchanges_queryset.filter(status=status)
+        ordering = self.request.GET.get("ordering")
+        if ordering not in {"created_at", "-created_at"}:
+            ordering = "-created_at"
+        querysets = []
+        for i_alias in get_shard_aliases():
+            exchanges_queryset = ExchangeProposal.objects.using(i_alias).filter(user_filter)
+            if status in ExchangeProposal.STATUS_CODES:
+                exchanges_queryset = exchanges_queryset.filter(status=ExchangeProposal.STATUS_CODES[status])
+            elif status:
+                exchanges_queryset = exchanges_queryset.none()
+            querysets.append(exchanges_queryset.order_by(ordering, ordering.replace("created_at", "id")))
+
+        if len(querysets) == 1:
+            return querysets[0]
+        return MergedQuerySets(querysets, ordering)
+
+
+class ExchangeEventsView(generic.View):
+    # Асинхронное представление: ожидающее событий соединение не занимает поток, поэтому только через config.asgi
+    async def get(self, request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            raise PermissionDenied("Уведомления доступны только после входа")
+        if not isinstance(request, ASGIRequest):
+            # Под WSGI поток навсегда ушел бы в ожидание; 204 останавливает переподключения EventSource
+            return HttpResponse(status=204)
+        last_event_id = request.headers.get("Last-Event-ID", "")
+        response = StreamingHttpResponse(
+            stream_events(user.pk, int(last_event_id) if last_event_id.isdigit() else None),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
 
-        ordering = self.request.GET.get("ordering", "-created_at")
-        if ordering in {"created_at", "-created_at"}:
-            exchanges_queryset = exchanges_queryset.order_by(ordering)
 
-        return exchanges_queryset
+class ExchangeProposalArchiveView(LoginRequiredMixin, TemplateEngineMixin, generic.ListView):
+    page_pattern = re.compile(r"page=\d+&?")
+    template_name = "ads/exchange_archive.html"
+    context_object_name = "archived_exchanges_list"
+    paginate_by = 15
+    login_url = reverse_lazy("users:login")
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query_params = self.request.GET.urlencode()
+        query_params = re.sub(self.page_pattern, "", query_params)
+        context["current_params"] = query_params
+        return context
+
+    def get_queryset(self):
+        return get_user_archive(self.request.user).order_by("-closed_at", "-id")
 
 
-class CreateExchangeProposalView(LoginRequiredMixin, generic.CreateView):
+class CreateExchangeProposalView(LoginRequiredMixin, TemplateEngineMixin, generic.CreateView):
     model = ExchangeProposal
     form_class = NewExchangeProposalForm
     template_name = "ads/exchange_form.html"
@@ -226,15 +454,20 @@ class CreateExchangeProposalView(LoginRequiredMixin, generic.CreateView):
         return initial
 
     def form_valid(self, form):
+        ad_sender, ad_receiver = form.cleaned_data["ad_sender"], form.cleaned_data["ad_receiver"]
         self.request.session["tmp_exchange_data"] = form.cleaned_data
-        self.request.session["tmp_exchange_data"]["ad_sender"] = form.cleaned_data["ad_sender"].id
-        self.request.session["tmp_exchange_data"]["ad_receiver"] = form.cleaned_data["ad_receiver"].id
+        self.request.session["tmp_exchange_data"]["ad_sender"] = ad_sender.id
+        self.request.session["tmp_exchange_data"]["ad_receiver"] = ad_receiver.id
+        # Владельцы нужны для выбора шарда при подтверждении, без повторной загрузки товаров
+        self.request.session["tmp_exchange_data"]["sender_user_id"] = ad_sender.user_id
+        self.request.session["tmp_exchange_data"]["receiver_user_id"] = ad_receiver.user_id
         return redirect("ads:exchange_confirmation")
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs["user"] = self.request.user
         kwargs["is_edit"] = True
+        kwargs["loaders"] = self.request.loaders
         return kwargs
 
     def dispatch(self, request, *args, **kwargs):
@@ -244,7 +477,7 @@ class CreateExchangeProposalView(LoginRequiredMixin, generic.CreateView):
             return super().dispatch(request, *args, **kwargs)
 
 
-class ExchangeProposalConfirmationView(LoginRequiredMixin, generic.CreateView):
+class ExchangeProposalConfirmationView(LoginRequiredMixin, TemplateEngineMixin, generic.CreateView):
     model = ExchangeProposal
     template_name = "ads/exchange_detail.html"
     form_class = NewExchangeProposalForm
@@ -255,9 +488,7 @@ class ExchangeProposalConfirmationView(LoginRequiredMixin, generic.CreateView):
         tmp_exchange_data = self.request.session.get("tmp_exchange_data")
         if not tmp_exchange_data:
             raise PermissionDenied("Данные не найдены")
-        tmp_exchange_data["ad_sender"] = Ad.objects.get(pk=tmp_exchange_data["ad_sender"])
-        tmp_exchange_data["ad_receiver"] = Ad.objects.get(pk=tmp_exchange_data["ad_receiver"])
-        tmp_exchange = ExchangeProposal(**tmp_exchange_data)
+        tmp_exchange = load_exchange_ads(self.request, ExchangeProposal(**get_tmp_exchange_fields(tmp_exchange_data)))
         tmp_exchange.id = "___"
         tmp_exchange.created_at = "_" * 15
         context["exchange_proposal"] = tmp_exchange
@@ -269,13 +500,42 @@ class ExchangeProposalConfirmationView(LoginRequiredMixin, generic.CreateView):
         tmp_exchange_data = request.session.get("tmp_exchange_data")
         if not tmp_exchange_data:
             return redirect("ads:new_exchange")
-        tmp_exchange_data["ad_sender"] = Ad.objects.get(pk=tmp_exchange_data["ad_sender"])
-        tmp_exchange_data["ad_receiver"] = Ad.objects.get(pk=tmp_exchange_data["ad_receiver"])
-        exchange = ExchangeProposal.objects.create(**tmp_exchange_data)
+        try:
+            with transaction.atomic():
+                exchange = ExchangeProposal.objects.create(**get_tmp_exchange_fields(tmp_exchange_data))
+        except IntegrityError:
+            # Пару в любом направлении успели создать между проверкой формы и подтверждением
+            self.object = None
+            context = self.get_context_data(form=None)
+            context["conflict_error"] = "Предложение обмена этими товарами уже существует."
+            return self.render_to_response(context, status=409)
         return redirect("ads:exchange_detail", pk=exchange.id)
 
 
-class ExchangeProposalDetailView(LoginRequiredMixin, generic.DetailView):
+class ExchangeProposalBatchView(LoginRequiredMixin, TemplateEngineMixin, generic.FormView):
+    form_class = BatchExchangeProposalForm
+    template_name = "ads/exchange_batch.html"
+    login_url = reverse_lazy("users:login")
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs["user"] = self.request.user
+        return kwargs
+
+    def form_valid(self, form):
+        results = create_proposals(
+            self.request.user,
+            form.cleaned_data["ad_senders"],
+            form.cleaned_data["ad_receivers"],
+            form.cleaned_data["comment"],
+            self.request.loaders,
+        )
+        for i_result in results:
+            i_result["result_display"] = BATCH_RESULTS[i_result["result"]]
+        return self.render_to_response(self.get_context_data(form=form, results=results))
+
+
+class ExchangeProposalDetailView(LoginRequiredMixin, TemplateEngineMixin, generic.DetailView):
     model = ExchangeProposal
     template_name = "ads/exchange_detail.html"
     context_object_name = "exchange_proposal"
@@ -288,7 +548,7 @@ class ExchangeProposalDetailView(LoginRequiredMixin, generic.DetailView):
         return context
 
     def get_object(self, queryset=None):
-        exchange = super().get_object(queryset=queryset)
+        exchange = load_exchange_ads(self.request, get_exchange_or_404(self.kwargs.get("pk")))
 
         current_user = self.request.user
         is_owner = (exchange.ad_sender.user == current_user)
@@ -301,8 +561,13 @@ class ExchangeProposalDetailView(LoginRequiredMixin, generic.DetailView):
 
     def post(self, request, *args, **kwargs):
         exchange = self.get_object()
-        if request.user == exchange.ad_receiver.user:
-            action = request.POST.get("set-status-button", None)
+        if request.user != exchange.ad_receiver.user:
+            raise PermissionDenied("Только получатель может изменять статус предложения")
+        version = request.POST.get("version", "")
+        if version.isdigit():
+            exchange.version = int(version)
+        action = request.POST.get("set-status-button", None)
+        try:
             if action == "accept":
                 exchange.set_status("accepted")
             elif action == "reject":
@@ -310,12 +575,18 @@ class ExchangeProposalDetailView(LoginRequiredMixin, generic.DetailView):
             elif action == "recreate":
                 exchange.ad_sender, exchange.ad_receiver = exchange.ad_receiver, exchange.ad_sender
                 exchange.set_status("waiting")
-            return HttpResponseRedirect(reverse_lazy("ads:exchange_detail", kwargs={"pk": exchange.id}))
-        else:
-            raise PermissionDenied("Только получатель может изменять статус предложения")
+        except VersionConflictError:
+            return self.render_conflict("Предложение изменилось, пока вы его просматривали. Проверьте актуальный статус.")
+        return HttpResponseRedirect(reverse_lazy("ads:exchange_detail", kwargs={"pk": exchange.id}))
+
+    def render_conflict(self, message):
+        self.object = self.get_object()
+        context = self.get_context_data(object=self.object)
+        context["conflict_error"] = message
+        return self.render_to_response(context, status=409)
 
 
-class ExchangeProposalEditView(LoginRequiredMixin, generic.UpdateView):
+class ExchangeProposalEditView(LoginRequiredMixin, VersionConflictMixin, TemplateEngineMixin, generic.UpdateView):
     model = ExchangeProposal
     form_class = NewExchangeProposalForm
     template_name = "ads/exchange_form.html"
@@ -331,23 +602,33 @@ class ExchangeProposalEditView(LoginRequiredMixin, generic.UpdateView):
         context["is_edit"] = True
         return context
 
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs["user"] = self.request.user
+        kwargs["loaders"] = self.request.loaders
+        return kwargs
+
     def get_object(self, queryset=None):
-        exchange = get_object_or_404(ExchangeProposal, pk=self.kwargs.get("pk"))
+        exchange = load_exchange_ads(self.request, get_exchange_or_404(self.kwargs.get("pk")))
         if exchange.ad_sender.user != self.request.user:
             raise PermissionDenied("У вас нет прав для изменения владельца объявления")
         return exchange
 
     def form_valid(self, form):
-        response = super().form_valid(form)
+        # Комментарий уже перенесен формой в объект, все изменения сохраняются одним условным UPDATE
+        self.object = form.instance
         self.object.ad_sender = form.cleaned_data.get("ad_sender")
         self.object.ad_receiver = form.cleaned_data.get("ad_receiver")
-        self.object.comment = form.cleaned_data.get("comment")
-        self.object.set_status("waiting")
-        self.object.save()
-        return response
+        try:
+            self.object.set_status("waiting")
+        except VersionConflictError:
+            return self.form_conflict(form)
+        except IntegrityError:
+            return self.form_conflict(form, "Предложение обмена этими товарами уже существует.")
+        return HttpResponseRedirect(self.get_success_url())
 
 
-class ExchangeProposalDeleteView(LoginRequiredMixin, generic.DeleteView):
+class ExchangeProposalDeleteView(LoginRequiredMixin, TemplateEngineMixin, generic.DeleteView):
     model = ExchangeProposal
     template_name = "ads/exchange_detail.html"
     context_object_name = "exchange_proposal"
@@ -360,7 +641,7 @@ class ExchangeProposalDeleteView(LoginRequiredMixin, generic.DeleteView):
         return context
 
     def get_object(self, queryset=None):
-        exchange = get_object_or_404(ExchangeProposal, pk=self.kwargs.get("pk"))
+        exchange = load_exchange_ads(self.request, get_exchange_or_404(self.kwargs.get("pk")))
         if exchange.ad_sender.user != self.request.user:
             raise PermissionDenied("У вас не достаточно прав для изменения объявления")
         return exchange
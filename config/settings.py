@@ -56,6 +56,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "ads.middleware.RequestLoadersMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -75,8 +76,25 @@ TEMPLATES = [
             ],
         },
     },
+    {
+        # Шаблоны приложения ads есть и в варианте для Jinja2 (ads/jinja2/): каким движком рисовать страницы,
+        # задает ADS_TEMPLATE_ENGINE
+        "BACKEND": "django.template.backends.jinja2.Jinja2",
+        "DIRS": [],
+        "APP_DIRS": True,
+        "OPTIONS": {
+            "environment": "ads.jinja_env.environment",
+            "context_processors": [
+                "django.contrib.auth.context_processors.auth",
+                "django.contrib.messages.context_processors.messages",
+            ],
+        },
+    },
 ]
 
+# Движок шаблонов страниц ads: "django" или "jinja2". Отрисовку в обоих сравнивает manage.py bench_templates
+ADS_TEMPLATE_ENGINE = os.getenv("DJANGO_ADS_TEMPLATE_ENGINE") or "django"
+
 WSGI_APPLICATION = "config.wsgi.application"
 
 
@@ -90,6 +108,19 @@ DATABASES = {
     }
 }
 
+# Предложения обмена делятся по паре владельцев товаров между основной базой и EXCHANGE_SHARDS - 1
+# дополнительными файлами: запись в разные файлы не ждет одну блокировку SQLite
+# Хотя бы один запасной шард объявлен всегда: тесты прогоняют предложения и с двумя шардами через
+# override_settings(EXCHANGE_SHARDS=2), а неиспользуемая база не открывается
+EXCHANGE_SHARDS = int(os.getenv("DJANGO_EXCHANGE_SHARDS") or 1)
+for i_shard in range(1, max(EXCHANGE_SHARDS, 2)):
+    DATABASES[f"exchange_{i_shard}"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": DATABASE_DIR / f"exchange_{i_shard}.sqlite3",
+    }
+
+DATABASE_ROUTERS = ["ads.shards.ExchangeShardRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -133,6 +164,45 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Закрытые предложения обмена старше этого срока переносятся в архив (manage.py archive_exchanges)
+EXCHANGE_ARCHIVE_AFTER_DAYS = int(os.getenv("DJANGO_EXCHANGE_ARCHIVE_AFTER_DAYS") or 30)
+
+# Просмотры объявлений копятся в памяти процесса и записываются одним UPDATE не чаще раза в интервал
+AD_VIEWS_FLUSH_INTERVAL = int(os.getenv("DJANGO_AD_VIEWS_FLUSH_INTERVAL") or 10)
+AD_VIEWS_MAX_PENDING = 1000
+# Просмотров заранее отрисованных страниц в минуту с одного IP-адреса, остальные отклоняются с кодом 429
+AD_VIEWS_RATE_LIMIT = 60
+AD_POPULARITY_HALF_LIFE_DAYS = 7
+
+# Снимки префиксного индекса подсказок, общие для всех процессов gunicorn через mmap
+SUGGEST_INDEX_DIR = Path(os.getenv("DJANGO_SUGGEST_INDEX_DIR") or DATABASE_DIR / "suggest")
+
+# Кеш общий для процессов gunicorn, uvicorn и обработчика задач: сброс в одном процессе видят остальные.
+# Кеш в памяти процесса для этого не подходит, с ним список своих объявлений не кешируется (ads/own_ads.py)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("DJANGO_CACHE_DIR") or DATABASE_DIR / "cache",
+    }
+}
+
+# Миниатюры внешних изображений объявлений: кеш на общем томе с ограничением размера (LRU).
+# Если задан префикс, файлы отдает nginx по X-Accel-Redirect, иначе само приложение
+IMAGE_CACHE_DIR = Path(os.getenv("DJANGO_IMAGE_CACHE_DIR") or DATABASE_DIR / "images")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("DJANGO_IMAGE_CACHE_MAX_MB") or 500) * 1024 * 1024
+IMAGE_CACHE_ACCEL_PREFIX = os.getenv("DJANGO_IMAGE_CACHE_ACCEL_PREFIX", "")
+IMAGE_FETCH_TIMEOUT = 5
+IMAGE_FETCH_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_PROXY_ALLOW_PRIVATE = False
+
+# Заранее отрисованные страницы каталога и объявлений для анонимных посетителей (отдает nginx)
+PRERENDER_DIR = Path(os.getenv("DJANGO_PRERENDER_DIR") or DATABASE_DIR / "prerendered")
+PRERENDER_MAX_PAGES = int(os.getenv("DJANGO_PRERENDER_MAX_PAGES") or 20)
+
+# Уведомления о предложениях через SSE (только под config.asgi): интервал чтения outbox и пинг простаивающих соединений
+EXCHANGE_EVENTS_POLL_INTERVAL = float(os.getenv("DJANGO_EXCHANGE_EVENTS_POLL_INTERVAL") or 2)
+EXCHANGE_EVENTS_KEEPALIVE = 15
+
 LOGIN_REDIRECT_URL = "home"
 LOGOUT_REDIRECT_URL = "home"
 
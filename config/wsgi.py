@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
 application = get_wsgi_application()
+
+# Буфер просмотров объявлений записывается по таймеру, а не только при следующем просмотре
+from ads.counters import ad_views
+
+ad_views.start_flusher()